@@ -0,0 +1,362 @@
+"""End-to-end throughput benchmark for the update handlers.
+
+Drives `translate_message`, `/setlang` and the voice pipeline against the
+in-process fakes from `fakes.py` and reports messages/sec, p50/p99 latency,
+the number of external calls per update and how long and how often the event
+loop was blocked (see loop_watchdog.py):
+
+    python benchmark.py --chats 50 --members 12 --languages 8 --messages 2000
+    python benchmark.py --translate-latency 0.05 --json bench.json
+    python benchmark.py --baseline bench.json   # exit code 1 on a regression
+    python benchmark.py --cold-start            # also time importing the bot in a fresh interpreter
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from telegram import Update
+
+import config
+from fakes import FakeContext, FakeServices
+from loop_watchdog import LOOP_BLOCK_THRESHOLD, LOOP_WATCHDOG_INTERVAL, LoopWatchdog
+
+LANGUAGES = ["en", "fr", "es", "de", "it", "pt", "sw", "nl", "pl", "tr", "ru", "ja", "zh-CN", "ar", "hi", "ko"]
+SCENARIOS = ["translate", "assistant", "setlang", "voice"]
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of `values`, `q` in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(updates, errors, seconds, latencies, calls, loop=None):
+    result = {
+        "updates": updates,
+        "errors": errors,
+        "seconds": round(seconds, 4),
+        "throughput": round(updates / seconds, 2) if seconds else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "calls": calls,
+        "calls_per_update": round(sum(calls.values()) / updates, 3) if updates else 0.0,
+    }
+    if loop is not None:
+        # Event loop lag and stalls seen by loop_watchdog.py during the run
+        result["loop_lag_p99_ms"] = loop["lag"]["p99_ms"]
+        result["loop_lag_max_ms"] = loop["lag"]["max_ms"]
+        result["loop_lag"] = loop["lag"]["buckets"]
+        result["blocked"] = loop["blocked"]
+        result["blocked_by_handler"] = loop["blocked_by_handler"]
+    return result
+
+
+def _chat_id(index):
+    return -1000000 - index
+
+
+def _user_id(chat_index, member_index):
+    return chat_index * 1000 + member_index + 1
+
+
+def make_update(bot, update_id, chat_id, user_id, message_id, text=None, voice=None, chat_type="group"):
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": chat_type, "title": f"Chat {chat_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if voice is not None:
+        message["voice"] = voice
+    return Update.de_json({"update_id": update_id, "message": message}, bot)
+
+
+class Workload:
+    """Seeds the fakes with chats and members and builds the updates for each scenario."""
+
+    def __init__(self, services, chats, members, languages, seed=0):
+        self.services = services
+        self.chats = chats
+        self.members = members
+        self.languages = languages
+        self.random = random.Random(seed)
+        self._update_ids = iter(range(1, sys.maxsize))
+
+    async def seed_group_chats(self):
+        store = self.services.store
+        for c in range(self.chats):
+            chat_id = _chat_id(c)
+            await store.save_chat(chat_id, {'title': f"Chat {chat_id}"})
+            for m in range(self.members):
+                lang = self.languages[(c + m) % len(self.languages)]
+                await store.set_member(chat_id, _user_id(c, m), {'preferred_language': lang})
+            self.services.bot.member_counts[str(chat_id)] = self.members + 1
+        self.services.calls.reset()
+
+    def _jobs(self, count, build):
+        jobs = []
+        for i in range(count):
+            c = i % self.chats
+            m = self.random.randrange(self.members)
+            update, args = build(i, _chat_id(c), _user_id(c, m))
+            jobs.append((update, FakeContext(self.services.bot, args)))
+        return jobs
+
+    def translate_jobs(self, count):
+        words = ["habari", "hello", "bonjour", "the", "tide", "is", "high", "tonight", "octopus", "karibu"]
+
+        # Roughly how often group chats see replies that need no translation, and links inside text
+        reactions = ["👍", "😂😂", "https://example.com/watch?v=1", "+1", "@someone"]
+
+        def build(i, chat_id, user_id):
+            if self.random.random() < 0.1:
+                text = self.random.choice(reactions)
+            else:
+                text = " ".join(self.random.choice(words) for _ in range(self.random.randint(3, 12)))
+                if self.random.random() < 0.1:
+                    text += " https://example.com/a"
+            return make_update(self.services.bot, next(self._update_ids), chat_id, user_id, i + 1, text=text), None
+        return self._jobs(count, build)
+
+    def assistant_jobs(self, count):
+        bot = self.services.bot
+
+        def build(i, chat_id, user_id):
+            private_chat = user_id
+            bot.member_counts[str(private_chat)] = 2
+            update = make_update(bot, next(self._update_ids), private_chat, user_id, i + 1,
+                                 text="Mambo Said, how is the ocean today?", chat_type="private")
+            return update, None
+        return self._jobs(count, build)
+
+    def setlang_jobs(self, count):
+        def build(i, chat_id, user_id):
+            lang = self.random.choice(self.languages)
+            update = make_update(self.services.bot, next(self._update_ids), chat_id, user_id, i + 1,
+                                 text=f"/setlang {lang}")
+            return update, [lang]
+        return self._jobs(count, build)
+
+    def voice_jobs(self, count):
+        def build(i, chat_id, user_id):
+            voice = {"file_id": f"voice-{i}", "file_unique_id": f"u-{i}", "duration": 3}
+            return make_update(self.services.bot, next(self._update_ids), chat_id, user_id, i + 1, voice=voice), None
+        return self._jobs(count, build)
+
+
+async def run_jobs(handler, jobs, concurrency):
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(update, context):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await handler(update, context)
+            except Exception as e:
+                errors += 1
+                print(f"[ERROR] Handler {handler.__name__} failed: {e}", file=sys.__stderr__)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one(update, context) for update, context in jobs))
+    return time.perf_counter() - start, latencies, errors
+
+
+async def run_scenario(name, services, workload, count, concurrency, quiet=True,
+                       block_threshold=LOOP_BLOCK_THRESHOLD):
+    import handlers
+    import commands
+    import profiling
+
+    handler, jobs = {
+        "translate": (handlers.translate_message, workload.translate_jobs),
+        "assistant": (handlers.translate_message, workload.assistant_jobs),
+        "setlang": (commands.set_lang, workload.setlang_jobs),
+        "voice": (commands.transcribe_voice_message, workload.voice_jobs),
+    }[name]
+    jobs = jobs(count)
+    services.calls.reset()
+    # Wrapped like in main.py, so that stalls are attributed to the handler
+    handler = profiling.profiled(handler)
+    watchdog = LoopWatchdog(interval=min(LOOP_WATCHDOG_INTERVAL, block_threshold), threshold=block_threshold)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+        watchdog.start()
+        try:
+            seconds, latencies, errors = await run_jobs(handler, jobs, concurrency)
+        finally:
+            watchdog.stop()
+    return summarize(len(jobs), errors, seconds, latencies, services.calls.snapshot(), loop=watchdog.stats())
+
+
+COLD_START_MODULES = ["main"]
+COLD_START_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+print(time.perf_counter() - start)
+"""
+
+
+def measure_cold_start(modules=COLD_START_MODULES, runs=3):
+    """Median milliseconds a fresh interpreter takes to import `modules`, i.e. to get ready for an update."""
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", COLD_START_SCRIPT, *modules], capture_output=True, text=True,
+                             check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return {"import_ms": round(statistics.median(samples) * 1000, 3), "modules": list(modules), "runs": runs}
+
+
+async def run_benchmark(args):
+    services = FakeServices(
+        LANGUAGES[:args.languages],
+        firestore_latency=args.firestore_latency,
+        translate_latency=args.translate_latency,
+        openai_latency=args.openai_latency,
+        convert_latency=args.convert_latency,
+        telegram_latency=args.telegram_latency,
+        storage=args.storage,
+    )
+    message_limit = config.MESSAGE_LIMIT
+    config.MESSAGE_LIMIT = float("inf")  # the benchmark measures throughput, not the daily quota
+    results = {}
+    try:
+        with services:
+            workload = Workload(services, args.chats, args.members, LANGUAGES[:args.languages], seed=args.seed)
+            await workload.seed_group_chats()
+            if args.warm_up:
+                import helpers
+
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    await helpers.warm_up_member_cache()
+                services.calls.reset()
+            for name in args.scenarios:
+                results[name] = await run_scenario(name, services, workload, args.messages, args.concurrency,
+                                                   quiet=not args.verbose, block_threshold=args.block_threshold)
+    finally:
+        config.MESSAGE_LIMIT = message_limit
+    return results
+
+
+def format_report(results):
+    cold_start = results.get("cold_start")
+    results = {name: r for name, r in results.items() if name != "cold_start"}
+    lines = [f"{'scenario':<12}{'updates':>9}{'errors':>8}{'msg/s':>11}{'p50 ms':>10}{'p99 ms':>10}{'calls/upd':>11}"
+             f"{'lag p99':>9}{'blocked':>9}"]
+    for name, r in results.items():
+        lines.append(f"{name:<12}{r['updates']:>9}{r['errors']:>8}{r['throughput']:>11.1f}"
+                     f"{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['calls_per_update']:>11.2f}"
+                     f"{r.get('loop_lag_p99_ms', 0):>9.1f}{r.get('blocked', 0):>9}")
+    for name, r in results.items():
+        if r.get("blocked"):
+            lines.append(f"\nevent loop blocked ({name}, more than --block-threshold in one callback):")
+            for handler, count in r["blocked_by_handler"].items():
+                lines.append(f"  {handler:<32}{count:>8}")
+    for name, r in results.items():
+        lines.append(f"\nexternal calls ({name}):")
+        for call, count in r["calls"].items():
+            lines.append(f"  {call:<32}{count:>8}")
+    if cold_start:
+        lines.append(f"\ncold start: importing {', '.join(cold_start['modules'])} took {cold_start['import_ms']:.1f} ms")
+    return "\n".join(lines)
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regressions of `results` against a previous `--json` report."""
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if name == "cold_start":
+            if r["import_ms"] > base["import_ms"] * (1 + tolerance):
+                regressions.append(f"cold start: {r['import_ms']} ms > baseline {base['import_ms']} ms")
+            continue
+        if r["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {r['throughput']} < baseline {base['throughput']}")
+        if r["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {r['p99_ms']} ms > baseline {base['p99_ms']} ms")
+        if r["calls_per_update"] > base["calls_per_update"]:
+            regressions.append(f"{name}: {r['calls_per_update']} calls/update > baseline {base['calls_per_update']}")
+        if r["errors"] > base["errors"]:
+            regressions.append(f"{name}: {r['errors']} errors > baseline {base['errors']}")
+        if r.get("blocked", 0) > base.get("blocked", r.get("blocked", 0)):
+            regressions.append(f"{name}: event loop blocked {r['blocked']} times > baseline {base['blocked']}")
+        # Lag is bucketed, so a one bucket step within the tolerance isn't a regression
+        if "loop_lag_p99_ms" in base and \
+                r.get("loop_lag_p99_ms", 0) > max(base["loop_lag_p99_ms"] * (1 + tolerance), base["loop_lag_p99_ms"] + 5):
+            regressions.append(f"{name}: loop lag p99 {r['loop_lag_p99_ms']} ms > baseline {base['loop_lag_p99_ms']} ms")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the bot handlers against in-process fakes.")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--languages", type=int, default=6, help=f"at most {len(LANGUAGES)}")
+    parser.add_argument("--messages", type=int, default=500, help="updates per scenario")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="updates in flight; 1 matches the default sequential Application")
+    parser.add_argument("--storage", choices=["firestore", "memory", "sqlite"], default="firestore",
+                        help="back helpers.store with the Firestore fake or a local backend")
+    parser.add_argument("--firestore-latency", type=float, default=0.0, help="seconds per Firestore RPC")
+    parser.add_argument("--translate-latency", type=float, default=0.0, help="seconds per Translate call")
+    parser.add_argument("--openai-latency", type=float, default=0.0, help="seconds per OpenAI call")
+    parser.add_argument("--convert-latency", type=float, default=0.0, help="seconds per ogg to mp3 conversion")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds per Bot API call")
+    parser.add_argument("--block-threshold", type=float, default=LOOP_BLOCK_THRESHOLD,
+                        help="seconds the event loop may be stuck in one callback before it counts as blocked")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against a previous --json report")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative throughput/p99 regression against the baseline")
+    parser.add_argument("--warm-up", action="store_true",
+                        help="load the member cache before the run, as main.py does at start-up")
+    parser.add_argument("--cold-start", action="store_true",
+                        help="also measure how long a fresh interpreter takes to import the bot")
+    parser.add_argument("--verbose", action="store_true", help="keep the handlers' output")
+    args = parser.parse_args(argv)
+    args.languages = max(1, min(args.languages, len(LANGUAGES)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run_benchmark(args))
+    if args.cold_start:
+        results["cold_start"] = measure_cold_start()
+    print(format_report(results))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"[REGRESSION] {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""In-process state of the chats the bot is in, within a memory budget.
+
+Everything the bot keeps in memory about a chat lives in one `ChatState`
+record: the members and their settings, the index of who reads which
+language, the chat's member count, today's message count and when the chat
+was last active. Records use `__slots__`, so thousands of them cost little
+more than the data they hold, and `ChatStates` keeps them in least recently
+used order. When the approximate size of all records exceeds the budget, the
+chats that have been idle longest are evicted:
+
+    states = ChatStates(budget=64 * 1024 * 1024)
+    state = states.get(chat_id)     # created if missing, marked as active
+    states.resize(state)            # after changing what it holds
+    states.stats()                  # {'entries': ..., 'bytes': ..., ...}
+
+Evicted state is rebuilt on the chat's next message: members are read from
+storage again and the member count is asked from Telegram again. Today's
+message count can't be read back from anywhere, so it outlives the record:
+it is kept aside, two ints per chat, until the UTC day is over, and MESSAGE_LIMIT
+holds however small the budget is.
+"""
+import sys
+import time
+from collections import OrderedDict
+
+import config
+from counters import DAY
+
+CHAT_STATE_MEMORY_BUDGET = getattr(config, 'CHAT_STATE_MEMORY_BUDGET', 64 * 1024 * 1024)
+
+
+def _sizeof(value):
+    """Approximate deep size of the plain dicts, lists and strings a record holds."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_sizeof(key) + _sizeof(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_sizeof(item) for item in value)
+    return size
+
+
+class ChatState:
+    __slots__ = ("chat_id", "members", "languages", "languages_at", "member_count", "member_count_at",
+                 "message_day", "message_count", "last_active", "size")
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        # user id -> member data, None until read from storage
+        self.members = None
+        # user id -> resolved language, None when it has to be resolved again
+        self.languages = None
+        self.languages_at = 0.0
+        self.member_count = None
+        self.member_count_at = 0.0
+        self.message_day = 0
+        self.message_count = 0
+        self.last_active = 0.0
+        self.size = 0
+
+    def count_message(self, now):
+        day = int(now // DAY)
+        if day != self.message_day:
+            # A new UTC day starts a new count
+            self.message_day, self.message_count = day, 0
+        self.message_count += 1
+        return self.message_count
+
+    def messages_today(self, now):
+        return self.message_count if int(now // DAY) == self.message_day else 0
+
+    def approximate_size(self):
+        return (sys.getsizeof(self) + _sizeof(self.chat_id) + _sizeof(self.members or {})
+                + _sizeof(self.languages or {}))
+
+
+class ChatStates:
+    def __init__(self, budget=CHAT_STATE_MEMORY_BUDGET, clock=time.time):
+        self.budget = budget
+        self._clock = clock
+        self._states = OrderedDict()
+        self._bytes = 0
+        # chat id -> (day, message count) of evicted chats that got messages on the current UTC day
+        self._message_counts = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, chat_id):
+        """Returns the chat's state, creating it if needed, and marks the chat as active."""
+        key = str(chat_id)
+        state = self._states.get(key)
+        if state is None:
+            self.misses += 1
+            state = self._states[key] = ChatState(key)
+            counted = self._message_counts.pop(key, None)
+            if counted is not None:
+                state.message_day, state.message_count = counted
+            self.resize(state)
+        else:
+            self.hits += 1
+            self._states.move_to_end(key)
+        state.last_active = self._clock()
+        return state
+
+    def peek(self, chat_id):
+        """Returns the chat's state if there is one, without creating it or marking it as active."""
+        return self._states.get(str(chat_id))
+
+    def pop(self, chat_id):
+        state = self._states.pop(str(chat_id), None)
+        if state is not None:
+            self._bytes -= state.size
+        return state
+
+    def resize(self, state):
+        """Updates the accounted size of `state` after a change and evicts idle chats if over budget."""
+        if self._states.get(state.chat_id) is not state:
+            # Evicted (or replaced) while its data was being loaded; it is not accounted any more
+            return
+        size = state.approximate_size()
+        self._bytes += size - state.size
+        state.size = size
+        while self._bytes > self.budget and len(self._states) > 1:
+            key, evicted = next(iter(self._states.items()))
+            if evicted is state:
+                # Never evict the record being worked with
+                self._states.move_to_end(key)
+                continue
+            self.pop(key)
+            self.evictions += 1
+            self._keep_message_count(evicted)
+
+    def _keep_message_count(self, state):
+        day = int(self._clock() // DAY)
+        if self._message_counts and next(iter(self._message_counts.values()))[0] != day:
+            # Kept in eviction order, so a stale first entry means a new day has started
+            self._message_counts = {key: counted for key, counted in self._message_counts.items()
+                                    if counted[0] == day}
+        if state.message_count and state.message_day == day:
+            self._message_counts[state.chat_id] = (state.message_day, state.message_count)
+
+    def values(self):
+        return list(self._states.values())
+
+    def clear(self):
+        self._states.clear()
+        self._bytes = 0
+        self._message_counts.clear()
+
+    def __contains__(self, chat_id):
+        return str(chat_id) in self._states
+
+    def __len__(self):
+        return len(self._states)
+
+    def stats(self):
+        return {"entries": len(self._states), "bytes": self._bytes, "budget": self.budget,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "evicted_message_counts": len(self._message_counts)}
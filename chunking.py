@@ -0,0 +1,75 @@
+"""Sentence-aware splitting of long texts.
+
+Long messages are split twice. Before translation, `chunks()` cuts a text
+into pieces of at most `TRANSLATE_CHUNK_SIZE` characters at sentence ends, so
+that the pieces can be translated by parallel requests and put back together
+in order. After translation, `split_message()` cuts the result into parts
+Telegram accepts (`TELEGRAM_MESSAGE_LIMIT` characters), preferring paragraph,
+line, sentence and word boundaries in that order; translations often come out
+longer than the original, so a message that fit before translation may not
+fit after it.
+
+Both return pieces that concatenate back to the original text exactly.
+"""
+import re
+
+import config
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+TRANSLATE_CHUNK_SIZE = getattr(config, 'TRANSLATE_CHUNK_SIZE', 1500)
+
+# A sentence ends with terminal punctuation, optionally followed by closing quotes or brackets
+SENTENCE_END = re.compile(r"(?<=[.!?…。！？])[\"'”’»)\]]*\s+")
+BOUNDARIES = [re.compile(r"\n\s*\n\s*"), re.compile(r"\n\s*"), SENTENCE_END, re.compile(r"\s+")]
+
+
+def _pieces(text, boundary):
+    """Splits `text` after every match of `boundary`, keeping the separator at the end of each piece."""
+    pieces = []
+    position = 0
+    for match in boundary.finditer(text):
+        if match.end() < len(text):
+            pieces.append(text[position:match.end()])
+            position = match.end()
+    pieces.append(text[position:])
+    return pieces
+
+
+def _pack(text, limit, boundaries):
+    if len(text) <= limit:
+        return [text]
+    if not boundaries:
+        # No boundary left, cut anywhere
+        return [text[i:i + limit] for i in range(0, len(text), limit)]
+    parts = []
+    current = ""
+    for piece in _pieces(text, boundaries[0]):
+        if len(current) + len(piece) <= limit:
+            current += piece
+            continue
+        if current:
+            parts.append(current)
+        if len(piece) <= limit:
+            current = piece
+        else:
+            *full, current = _pack(piece, limit, boundaries[1:])
+            parts.extend(full)
+    if current:
+        parts.append(current)
+    return parts
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Splits `text` into parts of at most `limit` characters, cutting at the largest boundary that fits."""
+    return _pack(text, limit, BOUNDARIES)
+
+
+def chunks(text, size=None):
+    """Splits `text` into pieces of at most `size` characters at sentence ends (or words, for huge sentences)."""
+    return _pack(text, size or TRANSLATE_CHUNK_SIZE, BOUNDARIES[2:])
+
+
+def strip_chunk(chunk):
+    """Returns `(text, trailing whitespace)`; only the text is translated."""
+    text = chunk.rstrip()
+    return text, chunk[len(text):]
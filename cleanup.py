@@ -0,0 +1,85 @@
+"""Background removal of everything stored under a chat the bot has left.
+
+Deleting `chats/{chat}` leaves its members, messages and conversations
+behind in Firestore. `schedule()` records a cleanup job in storage and hands
+it to the worker started by `main.py`, which deletes those documents in pages
+of `CLEANUP_PAGE_SIZE` off the update-handling path. The job record keeps the
+progress, so jobs interrupted by a restart are picked up again by
+`run_worker()`. If the bot is added back before a job finishes, `cancel()`
+drops the job and the chat's new data is left alone.
+"""
+import asyncio
+import time
+
+import config
+import helpers
+
+CLEANUP_PAGE_SIZE = getattr(config, 'CLEANUP_PAGE_SIZE', 300)
+# Pause between pages so a large cleanup doesn't starve the bot's own reads and writes
+CLEANUP_PAUSE = getattr(config, 'CLEANUP_PAUSE', 0.1)
+
+_queue = None
+
+
+def _jobs():
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue()
+    return _queue
+
+
+async def schedule(chat_id):
+    await helpers.store.save_cleanup_job(chat_id, {'deleted': 0, 'started': time.time()})
+    _jobs().put_nowait(str(chat_id))
+    print(f"[INFO] Scheduled cleanup of chat {chat_id}.")
+
+
+async def cancel(chat_id):
+    if await helpers.store.get_cleanup_job(chat_id) is not None:
+        await helpers.store.delete_cleanup_job(chat_id)
+        print(f"[INFO] Cancelled cleanup of chat {chat_id}, the bot is back.")
+
+
+async def clean_chat(chat_id, page_size=CLEANUP_PAGE_SIZE, pause=CLEANUP_PAUSE):
+    """Runs a cleanup job to completion; returns the number of documents deleted, or None if cancelled."""
+    store = helpers.store
+    while True:
+        # Read the job before every page so that a cancel() takes effect between pages
+        job = await store.get_cleanup_job(chat_id)
+        if job is None:
+            return None
+        deleted = await store.delete_chat_data(chat_id, page_size)
+        if not deleted:
+            await store.delete_cleanup_job(chat_id)
+            print(f"[INFO] Cleanup of chat {chat_id} finished, {job['deleted']} documents deleted.")
+            return job['deleted']
+        job['deleted'] += deleted
+        await store.save_cleanup_job(chat_id, job)
+        print(f"[INFO] Cleanup of chat {chat_id}: {job['deleted']} documents deleted so far.")
+        await asyncio.sleep(pause)
+
+
+async def run_worker(owns=None):
+    """Resumes persisted jobs (of the chats `owns` returns True for, if given), then works through
+    newly scheduled ones forever."""
+    queue = _jobs()
+    try:
+        pending = await helpers.store.list_cleanup_jobs()
+        if owns is not None:
+            pending = [chat_id for chat_id in pending if owns(chat_id)]
+    except Exception as e:
+        print(f"[ERROR] Failed to load pending cleanup jobs: {e}")
+        pending = []
+    if pending:
+        print(f"[INFO] Resuming {len(pending)} cleanup job(s).")
+    for chat_id in pending:
+        queue.put_nowait(chat_id)
+    while True:
+        chat_id = await queue.get()
+        try:
+            await clean_chat(chat_id)
+        except Exception as e:
+            # The job stays in storage and is retried on the next start
+            print(f"[ERROR] Cleanup of chat {chat_id} failed: {e}")
+        finally:
+            queue.task_done()
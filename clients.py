@@ -0,0 +1,120 @@
+"""Process-wide registry of the external service clients.
+
+Building the Google clients resolves credentials (probing the metadata server
+when none are configured) and importing their SDKs dominates start-up, so
+nothing is imported or connected until a client is first used. Modules hold a
+`lazy(name)` proxy instead of the client itself:
+
+    store = clients.lazy("store")
+    await store.get_member(chat_id, user_id)   # builds the store on first use
+
+`warm_up()` builds everything ahead of time for long running deployments (see
+`WARM_UP_CLIENTS` in `main.py`); `install()` swaps in a ready made client, which
+is how tests and `fakes.FakeServices` inject their fakes.
+"""
+import threading
+import time
+
+_factories = {}
+_instances = {}
+_lock = threading.Lock()
+
+
+def register(name, factory):
+    """Registers `factory`, a callable without arguments, as the builder of `name`."""
+    _factories[name] = factory
+
+
+def get(name):
+    client = _instances.get(name)
+    if client is None:
+        with _lock:
+            client = _instances.get(name)
+            if client is None:
+                client = _instances[name] = _factories[name]()
+    return client
+
+
+def install(name, client):
+    """Replaces the `name` client; returns the previous one (None if it was never built)."""
+    with _lock:
+        previous = _instances.get(name)
+        if client is None:
+            _instances.pop(name, None)
+        else:
+            _instances[name] = client
+    return previous
+
+
+def reset(name=None):
+    """Drops one or all built clients; they are rebuilt on next use."""
+    with _lock:
+        if name is None:
+            _instances.clear()
+        else:
+            _instances.pop(name, None)
+
+
+def is_built(name):
+    return name in _instances
+
+
+def warm_up(names=None):
+    """Builds the given (default: all registered) clients, returns the seconds each took."""
+    timings = {}
+    for name in names or list(_factories):
+        start = time.perf_counter()
+        try:
+            get(name)
+        except Exception as e:
+            print(f"[ERROR] Failed to warm up the {name} client: {e}")
+            continue
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+class LazyClient:
+    """Stands in for a registered client and forwards attribute access to it."""
+
+    __slots__ = ("_name",)
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        # Private and special names are introspection (mock.patch probes `_is_coroutine` and
+        # `__func__`, for one) and must not build the client
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(get(self._name), attr)
+
+    def __repr__(self):
+        return f"<lazy {self._name} client{'' if is_built(self._name) else ', not built yet'}>"
+
+
+def lazy(name):
+    return LazyClient(name)
+
+
+def _translate_client():
+    import config
+
+    if getattr(config, 'TRANSLATE_TRANSPORT', 'rest') == 'sdk':
+        from google.cloud import translate_v2 as translate
+
+        return translate.Client(config.GOOGLE_API_KEY)
+    from translate_rest import AsyncTranslateClient
+
+    return AsyncTranslateClient(config.GOOGLE_API_KEY)
+
+
+def _store():
+    import config
+    from storage import create_storage
+
+    return create_storage(getattr(config, 'STORAGE_BACKEND', 'firestore'), project=config.TELEGRAM_BOT,
+                          sqlite_path=getattr(config, 'SQLITE_PATH', 'mister_said.db'))
+
+
+register("translate", _translate_client)
+register("store", _store)
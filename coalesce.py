@@ -0,0 +1,104 @@
+"""Merges bursts of short messages from one sender into a single translation.
+
+People often type a thought as several lines sent one after the other, and
+each used to go through the whole pipeline on its own: member lookup, one
+translation per language and one reply per recipient, for every line. With
+`COALESCE_WINDOW` set, `add()` holds a sender's text for that many seconds;
+every further message from the same sender in the same chat within the
+window joins the burst and pushes the flush back, up to `COALESCE_MAX_DELAY`
+after the first message or `COALESCE_MAX_MESSAGES` messages. The burst is
+then translated once, as the lines joined by newlines, and the replies answer
+its first message. The ids and texts of all its messages are passed along,
+so that an edit of any of them updates the replies (see replies.py).
+"""
+import asyncio
+
+import config
+import helpers
+
+# Seconds to wait for the next message of a burst; 0 translates every message on its own
+COALESCE_WINDOW = getattr(config, 'COALESCE_WINDOW', 0)
+COALESCE_MAX_DELAY = getattr(config, 'COALESCE_MAX_DELAY', 2.0)
+COALESCE_MAX_MESSAGES = getattr(config, 'COALESCE_MAX_MESSAGES', 10)
+
+_bursts = {}
+_tasks = set()
+
+
+class Burst:
+    __slots__ = ("update", "context", "parts", "started", "deadline")
+
+    def __init__(self, update, context, now):
+        self.update = update
+        self.context = context
+        self.parts = {}
+        self.started = now
+        self.deadline = now
+
+    def add(self, update, text, now, window, max_delay):
+        self.parts[update.effective_message.message_id] = text
+        self.deadline = min(now + window, self.started + max_delay)
+
+
+def enabled():
+    return COALESCE_WINDOW > 0
+
+
+async def add(update, context, message_text, window=None, max_delay=None, max_messages=None):
+    """Adds a message to its sender's burst, starting one if there is none."""
+    window = COALESCE_WINDOW if window is None else window
+    max_delay = COALESCE_MAX_DELAY if max_delay is None else max_delay
+    max_messages = COALESCE_MAX_MESSAGES if max_messages is None else max_messages
+    key = (update.effective_chat.id, update.effective_user.id)
+    now = asyncio.get_running_loop().time()
+    burst = _bursts.get(key)
+    if burst is None:
+        burst = _bursts[key] = Burst(update, context, now)
+        _spawn(_flush_when_quiet(key, burst))
+    burst.add(update, message_text, now, window, max_delay)
+    if len(burst.parts) >= max_messages:
+        # Flush right away; the waiting task finds the burst gone and does nothing
+        del _bursts[key]
+        _spawn(flush(burst))
+
+
+def _spawn(coroutine):
+    # Keep a reference, the event loop only holds weak ones
+    task = asyncio.create_task(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def _flush_when_quiet(key, burst):
+    loop = asyncio.get_running_loop()
+    while True:
+        delay = burst.deadline - loop.time()
+        if delay <= 0:
+            break
+        await asyncio.sleep(delay)
+    if _bursts.get(key) is burst:
+        del _bursts[key]
+        await flush(burst)
+
+
+async def flush(burst):
+    update = burst.update
+    if len(burst.parts) > 1:
+        print(f"[INFO] Coalesced {len(burst.parts)} messages from {update.effective_user.id} "
+              f"in chat {update.effective_chat.id}.")
+    try:
+        await helpers.translate_and_send_messages(update, burst.context, "\n".join(burst.parts.values()),
+                                                  parts=burst.parts)
+    except Exception as e:
+        print(f"[ERROR] Failed to translate coalesced messages in chat {update.effective_chat.id}: {e}")
+
+
+async def flush_all():
+    """Translates every pending burst now, e.g. before shutting down."""
+    bursts = list(_bursts.values())
+    _bursts.clear()
+    await asyncio.gather(*(flush(burst) for burst in bursts))
+
+
+def pending():
+    return len(_bursts)
@@ -1,6 +1,7 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from helpers import db, validate_language
+import helpers
+from helpers import validate_language
 from openai_helper import transcribe_audio
 
 
@@ -19,12 +20,13 @@ async def set_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_name = update.effective_user.full_name
     if len(context.args) > 0:
         lang = context.args[0]
-        if validate_language(lang):
+        if await validate_language(lang):
             print(f"saving language {lang} for user {user_id} in chat {chat_id}")
-            doc_ref = db.collection(u'chats').document(str(chat_id)).collection(u'members').document(str(user_id))
-            doc_ref.set({
+            await helpers.set_member(chat_id, user_id, {
                 u'preferred_language': lang
             })
+            # Also the user's default for chats where they haven't set a language
+            await helpers.set_user_language(user_id, lang)
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text=f"Preferred language for {user_name} is now set to {lang}")
         else:
@@ -39,11 +41,9 @@ async def my_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
 
-    doc_ref = db.collection(u'chats').document(str(chat_id)).collection(u'members').document(str(user_id))
-    doc = doc_ref.get()
+    user_lang = await helpers.get_user_lang(chat_id, user_id)
 
-    if doc.exists:
-        user_lang = doc.to_dict()['preferred_language']
+    if user_lang:
         await context.bot.send_message(chat_id=chat_id, text=f"Your current preferred language is {user_lang}.")
     else:
         await context.bot.send_message(chat_id=chat_id, text=f"You haven't set a preferred language yet. Please use the '/setlang [code]' command to set your preferred language.")
@@ -0,0 +1,7 @@
+"""Time windows shared by the modules that count per UTC day.
+
+Daily counts (see `ChatState.count_message` in chat_state.py) start over at
+the UTC day boundary by keeping the number of whole days since the epoch next
+to the count, so a new day needs no reset job.
+"""
+DAY = 86400
@@ -0,0 +1,92 @@
+"""Skips updates that were already handled.
+
+Telegram delivers an update again when the bot didn't confirm it, e.g. after
+a crash between handling and the next `getUpdates`, or when a webhook request
+timed out, and every handler would run a second time: the same translations,
+sent to the chat again. `skip_duplicates` is the first handler of every
+update (group -2 in main.py). It claims the update's keys, the `update_id`
+and, for messages, the chat and message id (plus the edit date for edits),
+and stops the update with `ApplicationHandlerStop` if any of them was
+claimed before, before any other handler reads storage or calls an API.
+
+Claims are kept for the last `DEDUP_SIZE` updates in memory. With
+`DEDUP_SHARED` they are also created atomically in storage, where they live
+for `DEDUP_TTL` seconds, which catches redeliveries after a restart and
+across bot processes. That costs one write per update; if the write fails,
+the update is handled anyway.
+
+An update is claimed when it arrives, so one that fails halfway is not
+handled again when it is redelivered.
+"""
+import time
+from collections import OrderedDict
+
+from telegram.ext import ApplicationHandlerStop
+
+import clients
+import config
+
+DEDUP_SIZE = getattr(config, 'DEDUP_SIZE', 10000)
+DEDUP_SHARED = getattr(config, 'DEDUP_SHARED', False)
+# Telegram keeps undelivered updates for 24 hours
+DEDUP_TTL = getattr(config, 'DEDUP_TTL', 2 * 86400)
+
+store = clients.lazy("store")
+
+_seen = OrderedDict()
+skipped = 0
+
+
+def keys(update):
+    """The update's id and, for new and edited messages, the message it carries."""
+    result = [f"update:{update.update_id}"]
+    message = update.message or update.channel_post
+    edited = update.edited_message or update.edited_channel_post
+    if message is not None:
+        result.append(f"message:{message.chat_id}:{message.message_id}")
+    elif edited is not None:
+        # Every edit of a message is a new update to handle
+        edit_date = int(edited.edit_date.timestamp()) if edited.edit_date else update.update_id
+        result.append(f"edit:{edited.chat_id}:{edited.message_id}:{edit_date}")
+    return result
+
+
+def _remember(update_keys):
+    for key in update_keys:
+        _seen[key] = True
+        _seen.move_to_end(key)
+    while len(_seen) > DEDUP_SIZE:
+        _seen.popitem(last=False)
+
+
+async def claim(update):
+    """Returns True the first time an update (or the message it carries) is seen, False afterwards."""
+    update_keys = keys(update)
+    if any(key in _seen for key in update_keys):
+        _remember(update_keys)
+        return False
+    # Remembered before the shared claim is awaited, so that a copy arriving meanwhile is caught here
+    _remember(update_keys)
+    if not DEDUP_SHARED:
+        return True
+    try:
+        # The message key covers redeliveries under a new update_id too
+        return await store.claim_update(update_keys[-1], time.time() + DEDUP_TTL)
+    except Exception as e:
+        print(f"[ERROR] Failed to claim update {update.update_id}, handling it anyway: {e}")
+        return True
+
+
+async def skip_duplicates(update, context):
+    """TypeHandler callback; ends the handling of updates that were seen before."""
+    global skipped
+    if not await claim(update):
+        skipped += 1
+        print(f"[INFO] Skipped update {update.update_id}, it was already handled.")
+        raise ApplicationHandlerStop
+
+
+def clear():
+    global skipped
+    _seen.clear()
+    skipped = 0
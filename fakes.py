@@ -0,0 +1,558 @@
+"""In-process fakes of the external services the bot talks to.
+
+The fakes mimic just enough of Firestore, Google Translate, OpenAI and the
+Telegram Bot API for the handlers to run end to end without a network. Every
+fake records its calls in a shared `CallCounter` and can inject latency: the
+Firestore, Translate and OpenAI SDKs are synchronous, so their fakes block with
+`time.sleep`, while the Telegram fake awaits `asyncio.sleep` like the real
+(httpx based) bot does.
+"""
+import asyncio
+import itertools
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+try:
+    from google.cloud.firestore_v1.transforms import Sentinel, Increment
+except ImportError:  # the fakes also run where the Firestore SDK is not installed
+    Sentinel = Increment = ()
+
+
+class CallCounter:
+    """Counts calls to external services by name, e.g. `translate.translate`."""
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def record(self, name):
+        self.counts[name] += 1
+
+    def snapshot(self):
+        return dict(sorted(self.counts.items()))
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def reset(self):
+        self.counts.clear()
+
+
+class _LatencyMixin:
+    def _rpc(self, name):
+        self.calls.record(name)
+        if self.latency:
+            time.sleep(self.latency)
+
+
+# --- Firestore ---
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data.get(field) if self._data else None
+
+
+class FakeDocumentRef:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path[-1]
+
+    @property
+    def parent(self):
+        return FakeCollectionRef(self._db, self.path[:-1])
+
+    def collection(self, name):
+        return FakeCollectionRef(self._db, self.path + (name,))
+
+    def get(self, *args, **kwargs):
+        self._db._rpc("firestore.get")
+        return FakeSnapshot(self, self._db._read(self.path))
+
+    def create(self, data):
+        self._db._rpc("firestore.write")
+        if self._db._read(self.path) is not None:
+            from google.api_core.exceptions import AlreadyExists
+            raise AlreadyExists(f"Document already exists: {'/'.join(self.path)}")
+        self._db._write(self.path, data)
+
+    def set(self, data, merge=False):
+        self._db._rpc("firestore.write")
+        self._db._write(self.path, data, merge=merge)
+
+    def update(self, data):
+        self._db._rpc("firestore.write")
+        if self._db._read(self.path) is None:
+            from google.api_core.exceptions import NotFound
+            raise NotFound(f"No document to update: {'/'.join(self.path)}")
+        self._db._write(self.path, data, merge=True)
+
+    def delete(self):
+        self._db._rpc("firestore.delete")
+        self._db._delete(self.path)
+
+
+class FakeQuery:
+    def __init__(self, db, path, filters=(), orders=(), limit=None, group=False, after=None):
+        self._db = db
+        self._path = path
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._group = group
+        self._after = after
+
+    def _copy(self, **changes):
+        args = dict(filters=self._filters, orders=self._orders, limit=self._limit, group=self._group,
+                    after=self._after)
+        args.update(changes)
+        return FakeQuery(self._db, self._path, **args)
+
+    def _ordering(self):
+        # Like Firestore, documents that tie on every order field go by their path
+        direction = self._orders[-1][1] if self._orders else "ASCENDING"
+        return self._orders + (("__name__", direction),)
+
+    def _follows(self, doc, cursor):
+        for field, direction in self._ordering():
+            if field == "__name__":
+                mine, theirs = doc[0], cursor[0]
+            else:
+                mine, theirs = doc[1].get(field), cursor[1].get(field)
+            if mine != theirs:
+                return mine < theirs if direction == "DESCENDING" else mine > theirs
+        return False
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot):
+        return self._copy(after=(snapshot.reference.path, snapshot.to_dict()))
+
+    def select(self, fields):
+        return self
+
+    def stream(self, *args, **kwargs):
+        self._db._rpc("firestore.query")
+        docs = self._db._documents(self._path, group=self._group)
+        for field, op, value in self._filters:
+            docs = [d for d in docs if _matches(d[1].get(field), op, value)]
+        if self._after is not None:
+            docs = [d for d in docs if self._follows(d, self._after)]
+        for field, direction in reversed(self._ordering()):
+            docs.sort(key=lambda d: d[0] if field == "__name__" else d[1].get(field),
+                      reverse=direction == "DESCENDING")
+        if self._limit is not None:
+            docs = docs[:self._limit]
+        return iter([FakeSnapshot(FakeDocumentRef(self._db, path), data) for path, data in docs])
+
+    def get(self, *args, **kwargs):
+        return list(self.stream())
+
+
+class FakeCollectionRef(FakeQuery):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.id = path[-1]
+
+    @property
+    def parent(self):
+        return FakeDocumentRef(self._db, self._path[:-1]) if len(self._path) > 1 else None
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = self._db._next_id()
+        return FakeDocumentRef(self._db, self._path + (str(document_id),))
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return datetime.now(timezone.utc), ref
+
+    def list_documents(self, *args, **kwargs):
+        # Includes missing documents that have subcollections, like the real client
+        self._db._rpc("firestore.query")
+        ids = [path[-1] for path, _ in self._db._documents(self._path)]
+        depth = len(self._path)
+        for path, docs in self._db._collections.items():
+            if docs and len(path) > depth + 1 and path[:depth] == self._path and path[depth] not in ids:
+                ids.append(path[depth])
+        return [FakeDocumentRef(self._db, self._path + (doc_id,)) for doc_id in ids]
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append(lambda: self._db._write(ref.path, data, merge=merge))
+
+    def update(self, ref, data):
+        self._ops.append(lambda: self._db._write(ref.path, data, merge=True))
+
+    def delete(self, ref):
+        self._ops.append(lambda: self._db._delete(ref.path))
+
+    def commit(self):
+        self._db._rpc("firestore.commit")
+        for op in self._ops:
+            op()
+        self._ops = []
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Buffers writes like a batch; implements the hooks `firestore.transactional` drives."""
+
+    _max_attempts = 1
+    _read_only = False
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+
+    def _clean_up(self):
+        self._ops = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._db._rpc("firestore.begin_transaction")
+        self._id = b"fake-transaction"
+
+    def _commit(self):
+        self.commit()
+        self._id = None
+        return []
+
+    def _rollback(self):
+        self._clean_up()
+
+
+def _matches(actual, op, value):
+    if op == "==":
+        return actual == value
+    if op == "!=":
+        return actual != value
+    if actual is None:
+        return False
+    if op == "<":
+        return actual < value
+    if op == "<=":
+        return actual <= value
+    if op == ">":
+        return actual > value
+    if op == ">=":
+        return actual >= value
+    if op == "in":
+        return actual in value
+    raise ValueError(f"Unsupported operator in fake query: {op}")
+
+
+class FakeFirestore(_LatencyMixin):
+    """A dict backed stand-in for `google.cloud.firestore.Client`.
+
+    Documents are keyed by their collection path, so deleting a document leaves
+    its subcollections behind exactly like the real service does.
+    """
+
+    def __init__(self, latency=0.0, calls=None):
+        self.latency = latency
+        self.calls = calls if calls is not None else CallCounter()
+        self._collections = {}
+        self._ids = itertools.count(1)
+
+    def _next_id(self):
+        return f"auto{next(self._ids):012d}"
+
+    def _read(self, path):
+        return self._collections.get(path[:-1], {}).get(path[-1])
+
+    def _write(self, path, data, merge=False):
+        docs = self._collections.setdefault(path[:-1], {})
+        current = dict(docs.get(path[-1]) or {}) if merge else {}
+        for key, value in data.items():
+            if isinstance(value, Sentinel):
+                if "timestamp" in value.description:
+                    current[key] = datetime.now(timezone.utc)
+                else:
+                    current.pop(key, None)
+            elif isinstance(value, Increment):
+                current[key] = current.get(key, 0) + value.value
+            else:
+                current[key] = value
+        docs[path[-1]] = current
+
+    def _delete(self, path):
+        self._collections.get(path[:-1], {}).pop(path[-1], None)
+
+    def _documents(self, path, group=False):
+        if group:
+            return [(cpath + (doc_id,), data)
+                    for cpath, docs in self._collections.items() if cpath[-1] == path[-1]
+                    for doc_id, data in docs.items()]
+        return [(path + (doc_id,), data) for doc_id, data in self._collections.get(path, {}).items()]
+
+    def collection(self, name):
+        return FakeCollectionRef(self, (name,))
+
+    def collection_group(self, name):
+        return FakeQuery(self, (name,), group=True)
+
+    def document(self, path):
+        return FakeDocumentRef(self, tuple(path.split("/")))
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    def get_all(self, references, *args, **kwargs):
+        self._rpc("firestore.get_all")
+        return [FakeSnapshot(ref, self._read(ref.path)) for ref in references]
+
+
+# --- Google Translate ---
+
+class FakeTranslateClient(_LatencyMixin):
+    """Stands in for `translate_v2.Client`.
+
+    Every text is assumed to be written in `source_language`; translating into
+    that language returns the text unchanged, like the real API does.
+    """
+
+    def __init__(self, languages, source_language="en", latency=0.0, calls=None):
+        self.languages = list(languages)
+        self.source_language = source_language
+        self.latency = latency
+        self.calls = calls if calls is not None else CallCounter()
+
+    def translate(self, values, target_language=None, format_=None, source_language=None, model=None):
+        self._rpc("translate.translate")
+        texts = [values] if isinstance(values, str) else list(values)
+        results = []
+        for text in texts:
+            translated = text if target_language == self.source_language else f"[{target_language}] {text}"
+            results.append({"translatedText": translated, "detectedSourceLanguage": self.source_language,
+                            "input": text})
+        return results[0] if isinstance(values, str) else results
+
+    def get_languages(self, target_language=None):
+        self._rpc("translate.get_languages")
+        return [{"language": code, "name": code} for code in self.languages]
+
+
+# --- OpenAI ---
+
+class FakeOpenAI(_LatencyMixin):
+    """Replaces `openai.ChatCompletion.create`, `openai.Audio.transcribe` and the pydub conversion."""
+
+    def __init__(self, latency=0.0, convert_latency=0.0, calls=None, reply="Mambo! Hakuna matata.",
+                 transcript="Habari za asubuhi"):
+        self.latency = latency
+        self.convert_latency = convert_latency
+        self.calls = calls if calls is not None else CallCounter()
+        self.reply = reply
+        self.transcript = transcript
+
+    def chat_completion(self, model=None, messages=None, **kwargs):
+        self._rpc("openai.chat_completion")
+        return {"choices": [{"message": {"role": "assistant", "content": self.reply}}]}
+
+    async def transcribe(self, model, file, **kwargs):
+        self.calls.record("openai.transcribe")
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return {"text": self.transcript}
+
+    def convert_ogg_to_mp3(self, input_file, output_file):
+        self.calls.record("pydub.convert")
+        if self.convert_latency:
+            time.sleep(self.convert_latency)
+        with open(output_file, "wb") as f:
+            f.write(b"ID3")
+
+
+# --- Telegram Bot API ---
+
+class FakeBot:
+    """Covers the subset of `telegram.Bot` used by the handlers."""
+
+    def __init__(self, latency=0.0, calls=None, username="MisterSaidBot", member_counts=None):
+        self.latency = latency
+        self.calls = calls if calls is not None else CallCounter()
+        self.username = username
+        self.id = 1
+        self.member_counts = member_counts if member_counts is not None else {}
+        self.sent = []
+        self._message_ids = itertools.count(1_000_000)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def _request(self, name):
+        self.calls.record(f"telegram.{name}")
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, reply_to_message_id=None, **kwargs):
+        await self._request("send_message")
+        message = SimpleNamespace(message_id=next(self._message_ids), chat_id=chat_id, text=text,
+                                  reply_to_message_id=reply_to_message_id)
+        self.sent.append(message)
+        return message
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await self._request("edit_message_text")
+        return SimpleNamespace(message_id=message_id, chat_id=chat_id, text=text)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._request("delete_message")
+        return True
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        await self._request("send_chat_action")
+        return True
+
+    async def get_chat(self, chat_id, **kwargs):
+        await self._request("get_chat")
+        return FakeChat(self, chat_id)
+
+    async def get_chat_member_count(self, chat_id, **kwargs):
+        await self._request("get_chat_member_count")
+        return self.member_counts.get(str(chat_id), 2)
+
+    async def get_file(self, file_id, **kwargs):
+        await self._request("get_file")
+        return FakeFile(self, file_id)
+
+    async def leave_chat(self, chat_id, **kwargs):
+        await self._request("leave_chat")
+        return True
+
+
+class FakeChat:
+    def __init__(self, bot, chat_id):
+        self._bot = bot
+        self.id = chat_id
+
+    async def get_member_count(self):
+        return await self._bot.get_chat_member_count(self.id)
+
+
+class FakeFile:
+    def __init__(self, bot, file_id):
+        self._bot = bot
+        self.file_id = file_id
+
+    async def download_as_bytearray(self):
+        await self._bot._request("download_file")
+        return bytearray(b"OggS" + b"\0" * 1024)
+
+
+class FakeContext:
+    """The parts of `CallbackContext` the handlers read."""
+
+    def __init__(self, bot, args=None):
+        self.bot = bot
+        self.args = args if args is not None else []
+
+
+# --- Wiring ---
+
+_MISSING = object()
+
+
+class FakeServices:
+    """Bundles one fake per external service and swaps them into the bot modules.
+
+    `install()` puts the fakes into the `clients` registry, so the bot modules
+    never build a real client, and replaces the OpenAI calls, restoring
+    everything on exit. `storage` selects what `helpers.store` is backed by: the
+    Firestore fake, or the in-memory or SQLite backend for runs without any
+    simulated network hop.
+    """
+
+    def __init__(self, languages, firestore_latency=0.0, translate_latency=0.0, openai_latency=0.0,
+                 convert_latency=0.0, telegram_latency=0.0, source_language="en", storage="firestore"):
+        from storage import FirestoreStorage, InMemoryStorage, SqliteStorage
+
+        self.calls = CallCounter()
+        self.firestore = FakeFirestore(latency=firestore_latency, calls=self.calls)
+        self.store = {
+            "firestore": lambda: FirestoreStorage(self.firestore),
+            "memory": InMemoryStorage,
+            "sqlite": SqliteStorage,
+        }[storage]()
+        self.translate = FakeTranslateClient(languages, source_language=source_language,
+                                             latency=translate_latency, calls=self.calls)
+        self.openai = FakeOpenAI(latency=openai_latency, convert_latency=convert_latency, calls=self.calls)
+        self.bot = FakeBot(latency=telegram_latency, calls=self.calls)
+        self._saved = []
+
+    def _swap(self, obj, name, value):
+        # Read classes through __dict__ so classmethods are restored as descriptors
+        original = vars(obj).get(name, _MISSING) if isinstance(obj, type) else getattr(obj, name)
+        self._saved.append((obj, name, original))
+        setattr(obj, name, value)
+
+    def install(self):
+        import clients
+        import dedup
+        import helpers
+        from chat_state import ChatStates
+        import openai
+        import openai_helper
+        import response_cache
+
+        self._saved_clients = {"store": clients.install("store", self.store),
+                               "translate": clients.install("translate", self.translate)}
+        self._swap(helpers, "chat_states", ChatStates())
+        self._swap(helpers, "user_cache", {})
+        self._swap(response_cache, "_entries", OrderedDict())
+        self._swap(dedup, "_seen", OrderedDict())
+        self._swap(openai.ChatCompletion, "create", self.openai.chat_completion)
+        self._swap(openai.Audio, "transcribe", self.openai.transcribe)
+        self._swap(openai_helper, "convert_ogg_to_mp3", self.openai.convert_ogg_to_mp3)
+        return self
+
+    def uninstall(self):
+        import clients
+
+        for name, client in getattr(self, "_saved_clients", {}).items():
+            clients.install(name, client)
+        self._saved_clients = {}
+        while self._saved:
+            obj, name, value = self._saved.pop()
+            if value is _MISSING:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, value)
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
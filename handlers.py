@@ -1,20 +1,20 @@
 import asyncio
 
-from google.cloud import firestore
-from telegram import Update, ChatMember, Chat
+from telegram import Update, Chat, ChatMember
 from telegram.constants import ChatAction
 from telegram.ext import ContextTypes
 from functools import wraps
 
+import cleanup
+import coalesce
 import config
 import helpers
-from config import TELEGRAM_BOT, MAXIMUM_CHATS
-from helpers import increment_message_count, translate_and_send_messages, increment_active_chats
+import persona
+import response_cache
+from helpers import increment_message_count, translate_and_send_messages
 from openai_helper import get_openai_response
 from telegram.error import TelegramError
 
-db = firestore.Client(TELEGRAM_BOT)
-
 
 def send_action(action):
     """Sends `action` while processing func command."""
@@ -36,6 +36,7 @@ async def greet_new_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     new_users = update.effective_message.new_chat_members
     print(f"New users {new_users} added to  chat {chat_id}")
+    helpers.invalidate_member_count(chat_id)
 
     # Check if the bot is added to the chat
     bot_added = False
@@ -43,15 +44,18 @@ async def greet_new_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user.is_bot and user.username == context.bot.username:
             bot_added = True
 
-    # If the bot is added, check the active chat count
-    if bot_added and not await increment_active_chats():
+    # If the bot is added to a group, check the active chat count; other chats don't count (see bot_added_to_chat)
+    if bot_added and update.effective_chat.type in (Chat.GROUP, Chat.SUPERGROUP) \
+            and not await helpers.admit_chat(chat_id):
         await context.bot.send_message(chat_id=chat_id,
-                                       text=f"Sorry, I can't join this chat. I'm already in ${MAXIMUM_CHATS} chats.")
+                                       text=f"Sorry, I can't join this chat. I'm already in {config.MAXIMUM_CHATS} chats.")
         await context.bot.leave_chat(chat_id=chat_id)
         return
 
     # If the bot is not added, or the active chat count is below the limit, greet new users
     for user in new_users:
+        if not user.is_bot and await helpers.join_chat(chat_id, user.id):
+            print(f"User {user.id} joined chat {chat_id} with the language of their profile")
         try:
             await context.bot.send_message(chat_id=chat_id,
                                            text=f"Welcome to the chat, {user.full_name}! I'm Mister Said, a bot that can automatically translate messages in group chats. "
@@ -69,20 +73,19 @@ async def translate_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     bot_mention = f"@{context.bot.username}"
     # Get the number of members in the chat
-    chat_info: Chat = await context.bot.get_chat(chat_id)
-    chat_member_count = await chat_info.get_member_count()
+    chat_member_count = await helpers.get_member_count(context.bot, chat_id)
 
     if chat_member_count == 2 or message_text.startswith(bot_mention):
         if message_text.startswith(bot_mention):
             message_text = message_text[len(bot_mention):].strip()
         history = await helpers.get_previous_messages(chat_id, user_id)
         msg = await helpers.store_message(chat_id, user_id, message_text)
-        if len(history) == 0:
-            history.extend(helpers.init_messages)
-            for init_message in helpers.init_messages:
-                await helpers.store_message(chat_id, user_id, init_message['content'], role=init_message['role'])
         history.append(msg)
-        openai_response = await get_openai_response(history)
+        openai_response = await response_cache.get(history)
+        if openai_response is None:
+            # The persona is added here on every request and never stored, see persona.py
+            openai_response = await get_openai_response(persona.prepend(history))
+            await response_cache.put(history, openai_response)
         if openai_response:
             await helpers.store_message(chat_id=chat_id,user_id=user_id, role="assistant", message_text=openai_response)
             try:
@@ -95,16 +98,28 @@ async def translate_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         print(f"Message limit exceeded in chat {chat_id}")
         return
 
+    # Senders who set a language in another chat are translated for from their first message on
+    await helpers.join_chat(chat_id, user_id)
+
+    if coalesce.enabled():
+        # Translated together with the sender's next messages, see coalesce.py
+        await coalesce.add(update, context, message_text)
+        return
     await translate_and_send_messages(update, context, message_text)
 
 
+async def translate_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Updates the replies sent for the message; edits never cause new messages
+    await helpers.translate_edited_message(update, context)
+
+
 async def remove_left_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     left_user = update.effective_message.left_chat_member
     user_id = left_user.id
 
-    doc_ref = db.collection(u'chats').document(str(chat_id)).collection(u'members').document(str(user_id))
-    await doc_ref.delete()
+    await helpers.remove_member(chat_id, user_id)
+    helpers.invalidate_member_count(chat_id)
     print(f"Removed language preferences for user {user_id} in chat {chat_id}")
 
 
@@ -114,8 +129,8 @@ async def bot_removed_from_chat(update: Update, context: ContextTypes.DEFAULT_TY
     print(f"Bot modified in chat {chat_id}: {my_chat_member.difference()}")
     if my_chat_member.old_chat_member.status == ChatMember.ADMINISTRATOR or my_chat_member.old_chat_member.status == ChatMember.MEMBER:
         if my_chat_member.new_chat_member.status == ChatMember.BANNED or my_chat_member.new_chat_member.status == ChatMember.LEFT:
-            doc_ref = db.collection(u'chats').document(str(chat_id))
-            doc_ref.delete()
+            await helpers.release_chat(chat_id, group=update.effective_chat.type in (Chat.GROUP, Chat.SUPERGROUP))
+            await cleanup.schedule(chat_id)
             print(f"Removed chat {chat_id} from the database.")
 
 
@@ -126,6 +141,15 @@ async def bot_added_to_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if (my_chat_member.old_chat_member == None and
         my_chat_member.new_chat_member.status == ChatMember.ADMINISTRATOR) or \
             my_chat_member.new_chat_member.status == ChatMember.MEMBER:
-        doc_ref = db.collection(u'chats').document(str(chat_id))
-        doc_ref.create({'title': update.effective_chat.title})
+        await cleanup.cancel(chat_id)
+        # Private chats match too, e.g. when a user unblocks the bot; only groups count towards
+        # MAXIMUM_CHATS and get a chat record (see helpers.reconcile_active_chats)
+        if update.effective_chat.type not in (Chat.GROUP, Chat.SUPERGROUP):
+            return
+        if not await helpers.admit_chat(chat_id):
+            await context.bot.send_message(chat_id=chat_id,
+                                           text=f"Sorry, I can't join this chat. I'm already in {config.MAXIMUM_CHATS} chats.")
+            await context.bot.leave_chat(chat_id=chat_id)
+            return
+        await helpers.store.save_chat(chat_id, {'title': update.effective_chat.title})
         print(f"Bot added to chat {chat_id}")
@@ -1,128 +1,335 @@
 import asyncio
-
-from google.cloud import firestore
-from google.cloud import translate_v2 as translate
-
-from config import TELEGRAM_BOT, GOOGLE_API_KEY, MAXIMUM_CHATS
-from google.api_core.exceptions import FailedPrecondition
-from google.api_core.exceptions import GoogleAPIError
-
-translate_client = translate.Client(GOOGLE_API_KEY)
-db = firestore.Client(TELEGRAM_BOT)
-
-message_counts = {}
-
-init_messages=[
-    {"role": "system", "content": "From now on you act as Said. You are a 52 years old man living on Zanzibar. "
-                                  "You were born on Zanzibar in a small village called Fujoni where you lived your entire life, "
-                                  "besides regular trips to Tanzania Mainland, mainly to Dar Es Salam, you never really left the island. "
-                                  "You have 7 kids of which 3 are already grown up. You also have three grand childs. "
-                                  "You are an unbevielably kind human being who is always willing to help. "
-                                  "You speak english like a 5 year old and you speak Swahili fluently. "
-                                  "You do not speak any other language, only Swahili and a broken English."
-                                  "You have a strong connection to the nature and to the ocean. During the day you like to go running and swimming. "
-                                  "At night you go hunting for octopus if the tide is high enough, of course traditionally with a spear. "
-                                  "When you meet new people you always at them. Your hugs are always honest and meaningful. "
-                                  "You always begin a conversation with 'Mambo' "
-                                  "If you don't know the answer you can always respond with either 'Hakuna matata' or Karibu or 'Pole pole' or Poa. "}
-]
-async def reset_message_count():
-    global message_counts
-    while True:
-        await asyncio.sleep(86400)  # 24 hours in seconds
-        
-        print("[INFO] Starting daily reset of message_counts.")
-        new_message_counts = {}
-        try:
-            chats_collection_ref = db.collection(u'chats')
-            # Asynchronously stream documents. Consider using .list_documents() if only IDs are needed
-            # and the number of documents is very large, then .get() them in batches if necessary.
-            # For simplicity with smaller number of chats, .stream() is fine.
-            active_chat_docs = chats_collection_ref.stream()
-            
-            async for chat_doc in active_chat_docs:
-                new_message_counts[chat_doc.id] = 0 # Reset count to 0 for active chats
-            
-            message_counts = new_message_counts
-            print(f"[INFO] Message counts reset. Tracking {len(message_counts)} active chats.")
-        except Exception as e:
-            print(f"[ERROR] Failed to reset message counts based on Firestore: {e}")
-            # Fallback: Revert to clearing all counts to prevent potential memory issues
-            # if Firestore is unavailable for an extended period, though this is the behavior we're improving.
-            # Alternatively, could skip reset for this cycle or implement more robust retry/error handling.
-            message_counts = {} 
-            print("[WARNING] Message counts reset to empty due to error during Firestore sync.")
+import time
+from collections import OrderedDict
+
+import chunking
+import clients
+import config
+import langid
+import prefilter
+import replies
+import translation
+from chat_state import ChatStates
+from counters import DAY
+
+# Built on first use, see clients.py
+translate_client = clients.lazy("translate")
+store = clients.lazy("store")
+# Google first (read through translate_client at call time), then the fallbacks in TRANSLATION_BACKENDS
+translator = translation.build(google_client=lambda: translate_client)
+
+# 'messages' queries the chat's messages subcollection for every history load,
+# 'conversation' keeps one capped document of recent turns per user (see migrate_history.py)
+HISTORY_LAYOUT = getattr(config, 'HISTORY_LAYOUT', 'messages')
+CONVERSATION_MAX_TURNS = getattr(config, 'CONVERSATION_MAX_TURNS', 40)
+# Messages older than this are removed by retention.py; None keeps them forever
+MESSAGE_RETENTION_DAYS = getattr(config, 'MESSAGE_RETENTION_DAYS', None)
+
+# Everything kept in memory per chat (see chat_state.py): the members, filled for every chat by
+# warm_up_member_cache() at boot and otherwise on a chat's first message (the bot's own writes go through
+# set_member/remove_member/forget_chat), their languages, the member count and today's message count.
+chat_states = ChatStates()
+# Seconds a chat's member count is trusted; joins and leaves seen by the bot refresh it sooner
+MEMBER_COUNT_TTL = getattr(config, 'MEMBER_COUNT_TTL', 300)
+WARM_UP_CONCURRENCY = getattr(config, 'WARM_UP_CONCURRENCY', 8)
+
+# user id -> (profile or None, time read), least recently used first. A profile holds the language the
+# user set last, which is their language in every chat where they haven't set one. Entries expire after
+# USER_CACHE_TTL seconds so that changes made by other bot processes show up, and past USER_CACHE_SIZE
+# entries the least recently used users are dropped.
+user_cache = OrderedDict()
+USER_CACHE_TTL = getattr(config, 'USER_CACHE_TTL', 600)
+USER_CACHE_SIZE = getattr(config, 'USER_CACHE_SIZE', 50000)
+
+# The active chat count is spread over this many shard documents to avoid write contention
+ACTIVE_CHATS_SHARDS = getattr(config, 'ACTIVE_CHATS_SHARDS', 10)
+ACTIVE_CHATS_RECONCILE_INTERVAL = getattr(config, 'ACTIVE_CHATS_RECONCILE_INTERVAL', 3600)
+
+# Targets matching the offline-detected source language are only skipped above this confidence (see langid.py)
+LANGID_MIN_CONFIDENCE = getattr(config, 'LANGID_MIN_CONFIDENCE', 0.8)
 
 
 async def increment_message_count(chat_id):
-    global message_counts
-    if chat_id in message_counts:
-        message_counts[chat_id] += 1
-    else:
-        message_counts[chat_id] = 1
+    return chat_states.get(chat_id).count_message(time.time())
+
 
-    return message_counts[chat_id]
+async def get_chat_members(chat_id):
+    state = chat_states.get(chat_id)
+    if state.members is None:
+        state.members = dict(await store.list_members(chat_id))
+        chat_states.resize(state)
+    return state.members
 
 
-def get_user_lang(chat_id, user_id):
-    doc_ref = db.collection(u'chats').document(str(chat_id)).collection(u'members').document(str(user_id))
-    doc = doc_ref.get()
-    if doc.exists:
-        return doc.to_dict()['preferred_language']
+def _member_changed(chat_id, user_id, data):
+    state = chat_states.peek(chat_id)
+    if state is None or state.members is None:
+        return
+    if data is None:
+        state.members.pop(str(user_id), None)
     else:
-        return None
+        state.members[str(user_id)] = dict(data)
+    state.languages = None
+    chat_states.resize(state)
+
+
+async def set_member(chat_id, user_id, data):
+    await store.set_member(chat_id, user_id, data)
+    _member_changed(chat_id, user_id, data)
+
+
+async def remove_member(chat_id, user_id):
+    await store.delete_member(chat_id, user_id)
+    _member_changed(chat_id, user_id, None)
+
+
+async def forget_chat(chat_id):
+    await store.delete_chat(chat_id)
+    chat_states.pop(chat_id)
+    replies.forget_chat(chat_id)
+
+
+async def get_member_count(bot, chat_id):
+    """The chat's member count, asked from Telegram at most every MEMBER_COUNT_TTL seconds."""
+    state = chat_states.get(chat_id)
+    now = time.monotonic()
+    if state.member_count is None or now - state.member_count_at > MEMBER_COUNT_TTL:
+        state.member_count = await bot.get_chat_member_count(chat_id)
+        state.member_count_at = now
+    return state.member_count
+
+
+def invalidate_member_count(chat_id):
+    state = chat_states.peek(chat_id)
+    if state is not None:
+        state.member_count = None
+
+
+async def warm_up_member_cache(concurrency=WARM_UP_CONCURRENCY, owns=None):
+    """Loads every chat's members into chat_states so that no chat's first message pays for the read.
+
+    `owns` limits the warm-up to the chats it returns True for, e.g. those of one worker (see sharding.py).
+    """
+    start = time.perf_counter()
+    chat_ids = await store.list_chat_ids()
+    if owns is not None:
+        chat_ids = [chat_id for chat_id in chat_ids if owns(chat_id)]
+    print(f"[INFO] Warm-up: loading members of {len(chat_ids)} chats.")
+    step = max(1, len(chat_ids) // 10)
+
+    def progress(done, total):
+        if done % step == 0 or done == total:
+            print(f"[INFO] Warm-up: {done}/{total} chats loaded.")
+
+    loaded = await store.load_members(chat_ids, concurrency=concurrency, progress=progress)
+    evictions = chat_states.evictions
+    for chat_id, members in loaded.items():
+        state = chat_states.get(chat_id)
+        # Keep entries the bot already filled itself while the warm-up was running
+        if state.members is None:
+            state.members = members
+            chat_states.resize(state)
+    if chat_states.evictions > evictions:
+        print(f"[INFO] Warm-up: the chat state budget holds {len(chat_states)} of {len(loaded)} chats.")
+    inheriting = {member_id for members in loaded.values()
+                  for member_id, member in members.items() if not member.get('preferred_language')}
+    if inheriting:
+        await get_user_profiles(inheriting)
+    seconds = time.perf_counter() - start
+    member_count = sum(len(members) for members in loaded.values())
+    print(f"[INFO] Warm-up: cached {member_count} members of {len(loaded)} chats in {seconds:.2f}s.")
+    return {"chats": len(loaded), "members": member_count, "seconds": seconds}
+
+
+async def get_user_profiles(user_ids):
+    """Returns `{user_id: profile or None}`, reading the users that aren't cached in one batch."""
+    now = time.monotonic()
+    user_ids = [str(user_id) for user_id in user_ids]
+    profiles, missing = {}, []
+    for user_id in user_ids:
+        cached = user_cache.pop(user_id, None)
+        if cached is not None and now - cached[1] <= USER_CACHE_TTL:
+            # Put back as the most recently used
+            user_cache[user_id] = cached
+            profiles[user_id] = cached[0]
+        elif user_id not in missing:
+            missing.append(user_id)
+    if missing:
+        loaded = await store.load_users(missing)
+        for user_id in missing:
+            profiles[user_id] = loaded.get(user_id)
+            _cache_user(user_id, profiles[user_id], now)
+    return {user_id: profiles[user_id] for user_id in user_ids}
+
+
+def _cache_user(user_id, profile, now):
+    user_cache.pop(user_id, None)
+    user_cache[user_id] = (profile, now)
+    # The least recently used entries go first: expired ones, then any beyond the size limit
+    while user_cache:
+        oldest = next(iter(user_cache))
+        if len(user_cache) <= USER_CACHE_SIZE and now - user_cache[oldest][1] <= USER_CACHE_TTL:
+            break
+        user_cache.pop(oldest)
+
+
+async def get_user_profile(user_id):
+    return (await get_user_profiles([user_id]))[str(user_id)]
+
+
+def _forget_languages():
+    # Profiles are shared by all chats; a change is rare enough to resolve every chat's languages again
+    for state in chat_states.values():
+        state.languages = None
+
+
+async def set_user_language(user_id, lang):
+    await store.set_user(user_id, {'preferred_language': lang})
+    cached = user_cache.get(str(user_id), (None, 0))[0]
+    _cache_user(str(user_id), dict(cached or {}, preferred_language=lang), time.monotonic())
+    _forget_languages()
+
+
+def invalidate_user(user_id):
+    user_cache.pop(str(user_id), None)
+    _forget_languages()
+
+
+async def resolve_languages(chat_id):
+    """Returns `{user_id: language}` for the chat's members; a language set in the chat wins over the profile's."""
+    members = await get_chat_members(chat_id)
+    state = chat_states.get(chat_id)
+    # Profiles can change in other processes, so the index is only kept as long as the profiles are cached
+    if state.languages is not None and time.monotonic() - state.languages_at <= USER_CACHE_TTL:
+        return state.languages
+    inheriting = [member_id for member_id, member in members.items() if not member.get('preferred_language')]
+    profiles = await get_user_profiles(inheriting) if inheriting else {}
+    languages = {}
+    for member_id, member in members.items():
+        lang = member.get('preferred_language') or (profiles.get(member_id) or {}).get('preferred_language')
+        if lang:
+            languages[member_id] = lang
+    state.languages, state.languages_at = languages, time.monotonic()
+    chat_states.resize(state)
+    return languages
+
+
+async def get_user_lang(chat_id, user_id):
+    member = (await get_chat_members(chat_id)).get(str(user_id))
+    if member and member.get('preferred_language'):
+        return member['preferred_language']
+    profile = await get_user_profile(user_id)
+    return profile.get('preferred_language') if profile else None
+
+
+async def join_chat(chat_id, user_id):
+    """Makes a user with a profile language a member of the chat, so they get translations without /setlang."""
+    if str(user_id) in await get_chat_members(chat_id):
+        return False
+    profile = await get_user_profile(user_id)
+    if not profile or not profile.get('preferred_language'):
+        return False
+    # An empty member record: the language keeps following the profile
+    await set_member(chat_id, user_id, {})
+    return True
+
+
+async def translate_segments(segments, lang_code, known=None):
+    """Returns `{segment: translation}` for the translatable segments, translating only those not in `known`."""
+    translations = dict(known or {})
+    missing = list(dict.fromkeys(segment for segment, translatable in segments
+                                 if translatable and segment not in translations))
+    # Long segments are cut at sentence ends (see chunking.py); each piece keeps its trailing whitespace
+    pieces = [(segment,) + chunking.strip_chunk(chunk) for segment in missing for chunk in chunking.chunks(segment)]
+    if len(pieces) == 1:
+        translated = [await translator.translate(pieces[0][1], lang_code)]
+    else:
+        # Protected segments (links, mentions, code) stay as they are; the rest goes in as few calls as
+        # the chunk size allows, sent in parallel
+        batches = []
+        size = chunking.TRANSLATE_CHUNK_SIZE
+        for _, text, _ in pieces:
+            if batches and sum(map(len, batches[-1])) + len(text) <= size:
+                batches[-1].append(text)
+            else:
+                batches.append([text])
+        results = await asyncio.gather(*(translator.translate(batch, lang_code) for batch in batches))
+        translated = [text for result in results for text in result]
+    for segment in missing:
+        translations[segment] = ""
+    for (segment, _, whitespace), text in zip(pieces, translated):
+        translations[segment] += text + whitespace
+    return {segment: translations[segment] for segment, translatable in segments if translatable}
+
 
+def join_translations(segments, translations):
+    return prefilter.join(segments, [translations[segment] for segment, translatable in segments if translatable])
 
-async def translate_and_send_messages(update, context, message_text):
+
+async def translate_and_send_messages(update, context, message_text, parts=None):
+    """Translates `message_text` for every member.
+
+    `parts` maps the ids of the messages `message_text` was merged from to their texts (see coalesce.py).
+    """
     chat_id = update.effective_chat.id
     sender_user_id = str(update.effective_user.id)
+    parts = parts or {update.effective_message.message_id: message_text}
+    # Replies answer the first of the source messages
+    reply_to_message_id = next(iter(parts))
 
-    members_ref = db.collection(u'chats').document(str(chat_id)).collection(u'members')
-    members_stream = members_ref.stream() # Changed variable name to avoid confusion
+    segments = prefilter.split(message_text)
+    if not prefilter.has_translatable(segments):
+        # Links, emoji, numbers, commands or code only: the translation would come back unchanged
+        print(f"Skipping translation of untranslatable message in chat {chat_id}.")
+        return
 
-    # 1. Fetch all members' language preferences and 2. Group users by language
-    users_by_language = {}
-    for member_doc in members_stream:
-        member_id = member_doc.id
-        # Ensure not to send to the original sender later by excluding them here if needed,
-        # or by checking before sending. Current logic checks before sending.
-        # if member_id == sender_user_id:
-        #     continue 
+    languages = await resolve_languages(chat_id)
 
+    # 1. Resolve all members' languages and 2. Group users by language
+    users_by_language = {}
+    for member_id, lang in languages.items():
+        # The sender is grouped too; the logic that skips them is applied before sending
+        users_by_language.setdefault(lang, []).append(member_id)
+
+    # Drop the targets the message is already written in, before paying for a round trip
+    sender_lang = languages.get(sender_user_id) or await get_user_lang(chat_id, sender_user_id)
+    source_text = " ".join(segment for segment, translatable in segments if translatable)
+    source_lang, confidence = langid.detect(source_text, prior=sender_lang)
+    if confidence >= LANGID_MIN_CONFIDENCE:
+        users_by_language = {lang: user_ids for lang, user_ids in users_by_language.items()
+                             if not langid.same_language(lang, source_lang)}
+        if not users_by_language:
+            print(f"Skipping translation in chat {chat_id}, every member reads {source_lang}.")
+            return
+
+    # Optimization: If the original message_text is effectively empty or whitespace,
+    # translation might not be useful or might even cause errors with some services.
+    if not message_text.strip():
+        print(f"Skipping translation for empty message in chat {chat_id}.")
+        return
+
+    async def translate_into(lang_code):
         try:
-            lang = member_doc.to_dict().get('preferred_language')
-            if lang:
-                if lang not in users_by_language:
-                    users_by_language[lang] = []
-                users_by_language[lang].append(member_id)
-        except Exception as e:
-            print(f"Error processing member document {member_id}: {e}")
-            continue
-            
-    # 3. For each unique language in this grouping:
-    for lang_code, user_ids_for_lang in users_by_language.items():
-        # a. Translate the message *once* for that language.
-        translated_text = None
-        try:
-            # Optimization: If the original message_text is effectively empty or whitespace,
-            # translation might not be useful or might even cause errors with some services.
-            if not message_text.strip():
-                print(f"Skipping translation for empty message in chat {chat_id}.")
-                continue
-
-            result = translate_client.translate(message_text, target_language=lang_code)
-            translated_text = result['translatedText']
-        except GoogleAPIError as e:
+            translations = await translate_segments(segments, lang_code)
+        except translation.TranslationError as e:
             print(f"Error translating text to {lang_code} in chat {chat_id}: {e}")
-            continue # Skip this language if translation fails
+            return None # Skip this language if translation fails
+        return replies.Translation(join_translations(segments, translations), translations)
+
+    # 3. Translate the message *once* per language, all languages at the same time
+    translations = await asyncio.gather(*(translate_into(lang_code) for lang_code in users_by_language))
 
+    # Kept so that edits of the message can update the replies instead of sending new ones
+    record = replies.Record(dict(parts))
+    for (lang_code, user_ids_for_lang), translated in zip(users_by_language.items(), translations):
         # 5. Ensure that a user does not receive a translation if their preferred language 
         # is the same as the source language of the message
-        if translated_text == message_text:
+        if translated is None or translated.text == message_text:
             # print(f"Skipping sending for language {lang_code} as translated text is same as original.")
             continue
 
-        if translated_text:
+        if translated.text:
+            record.languages[lang_code] = translated
             # b. Iterate through the list of users who prefer this language and send them the translated message.
             for user_id_to_send in user_ids_for_lang:
                 # 6. The logic to not send the message to the original sender
@@ -131,47 +338,133 @@ async def translate_and_send_messages(update, context, message_text):
                 
                 try:
                     print(f"Sending message in {lang_code} to {user_id_to_send} in chat {chat_id}")
-                    await context.bot.send_message(
-                        chat_id=chat_id, 
-                        text=translated_text, 
-                        reply_to_message_id=update.effective_message.message_id
-                    )
+                    translated.reply_ids.append(
+                        await send_parts(context, chat_id, translated.text, reply_to_message_id))
                 except Exception as e:
                     print(f"Error sending translated message to user {user_id_to_send} in chat {chat_id}: {e}")
-
-
-def validate_language(lang_code):
-    supported_languages = translate_client.get_languages('en')
+    if record.languages:
+        replies.remember(chat_id, record)
+
+
+async def send_parts(context, chat_id, text, reply_to_message_id):
+    """Sends `text`, in as many messages as Telegram's length limit requires; returns their ids."""
+    reply_ids = []
+    for part in chunking.split_message(text):
+        sent = await context.bot.send_message(chat_id=chat_id, text=part, reply_to_message_id=reply_to_message_id)
+        reply_ids.append(sent.message_id)
+    return reply_ids
+
+
+async def edit_parts(context, chat_id, reply_ids, text, reply_to_message_id):
+    """Edits the messages `reply_ids` a text was sent in to read `text`, sending or deleting parts as needed."""
+    parts = chunking.split_message(text)
+    for reply_id, part in zip(reply_ids, parts):
+        await context.bot.edit_message_text(text=part, chat_id=chat_id, message_id=reply_id)
+    for part in parts[len(reply_ids):]:
+        sent = await context.bot.send_message(chat_id=chat_id, text=part, reply_to_message_id=reply_to_message_id)
+        reply_ids.append(sent.message_id)
+    for reply_id in reply_ids[len(parts):]:
+        await context.bot.delete_message(chat_id=chat_id, message_id=reply_id)
+    del reply_ids[len(parts):]
+
+
+async def translate_edited_message(update, context):
+    """Re-translates the changed segments of an edited message and edits the replies sent for it."""
+    chat_id = update.effective_chat.id
+    message = update.effective_message
+    record = replies.lookup(chat_id, message.message_id)
+    if record is None:
+        # Too old, or it was never translated
+        return
+    record.parts[message.message_id] = message.text
+    segments = prefilter.split(record.text)
+
+    async def update_language(lang_code, sent):
+        try:
+            translations = await translate_segments(segments, lang_code, known=sent.segments)
+        except translation.TranslationError as e:
+            print(f"Error translating edited text to {lang_code} in chat {chat_id}: {e}")
+            return
+        text = join_translations(segments, translations)
+        sent.segments = translations
+        if text == sent.text:
+            return
+        sent.text = text
+        for reply_ids in sent.reply_ids:
+            try:
+                await edit_parts(context, chat_id, reply_ids, text, next(iter(record.parts)))
+            except Exception as e:
+                print(f"Error editing translated message {reply_ids} in chat {chat_id}: {e}")
+
+    await asyncio.gather(*(update_language(lang_code, sent) for lang_code, sent in record.languages.items()))
+
+
+async def validate_language(lang_code):
+    if asyncio.iscoroutinefunction(translate_client.get_languages):
+        supported_languages = await translate_client.get_languages('en')
+    else:
+        # The blocking SDK client (TRANSLATE_TRANSPORT = 'sdk')
+        supported_languages = await asyncio.to_thread(translate_client.get_languages, 'en')
     supported_codes = [lang['language'] for lang in supported_languages]
     return lang_code in supported_codes
 
 
 async def increment_active_chats() -> bool:
-    active_chats_ref = db.collection(u'active_chats').document(u'count')
-    transaction = db.transaction()
-
-    @firestore.async_transactional
-    async def _update_count(transaction, doc_ref):
-        doc = await transaction.get(doc_ref)
-        if not doc.exists:
-            if MAXIMUM_CHATS >= 1:
-                transaction.set(doc_ref, {"count": 1})
-                return True
-            else:
-                return False
-        else:
-            current_count = doc.to_dict().get("count", 0)
-            if current_count < MAXIMUM_CHATS:
-                transaction.update(doc_ref, {"count": firestore.Increment(1)})
-                return True
-            else:
-                return False
-
+    # Admission reads the sharded total and then adds blindly, so simultaneous joins near the
+    # limit can overshoot it by a few chats; the reconciliation below keeps the total exact.
     try:
-        return await _update_count(transaction, active_chats_ref)
+        if await store.get_counter(u'active_chats') + 1 > config.MAXIMUM_CHATS:
+            return False
+        await store.add_to_counter(u'active_chats', 1, shards=ACTIVE_CHATS_SHARDS)
+        return True
     except Exception as e:
-        print(f"Error in transaction: {e}")
+        print(f"Error updating the active chat count: {e}")
+        return False
+
+
+async def admit_chat(chat_id) -> bool:
+    """Counts the group chat as active unless the bot is at MAXIMUM_CHATS; a chat is only counted once."""
+    chat = await store.get_chat(chat_id)
+    # Group chats recorded before the 'counted' flag existed were counted when the bot joined them
+    if chat and chat.get('counted', True):
+        return True
+    if not await increment_active_chats():
         return False
+    await store.save_chat(chat_id, {'counted': True})
+    return True
+
+
+async def release_chat(chat_id, group=True):
+    """Forgets a chat the bot left, taking it off the active chat count if it was counted. Records
+    without the 'counted' flag predate it; of those, only group chats (`group`) were counted."""
+    chat = await store.get_chat(chat_id)
+    if chat and chat.get('counted', group):
+        try:
+            await store.add_to_counter(u'active_chats', -1, shards=ACTIVE_CHATS_SHARDS)
+        except Exception as e:
+            print(f"Error updating the active chat count: {e}")
+    await forget_chat(chat_id)
+
+
+async def reconcile_active_chats():
+    """Recomputes the active chat count from the chat records, which only admitted group chats have;
+    returns the correction applied."""
+    try:
+        actual = len(await store.list_chat_ids())
+        delta = actual - await store.get_counter(u'active_chats')
+        if delta:
+            await store.add_to_counter(u'active_chats', delta, shards=ACTIVE_CHATS_SHARDS)
+            print(f"[INFO] Active chat count corrected by {delta:+d} to {actual}.")
+        return delta
+    except Exception as e:
+        print(f"[ERROR] Failed to reconcile the active chat count: {e}")
+        return 0
+
+
+async def reconcile_active_chats_periodically(interval=None):
+    while True:
+        await reconcile_active_chats()
+        await asyncio.sleep(interval or ACTIVE_CHATS_RECONCILE_INTERVAL)
 
 
 async def store_message(chat_id, user_id, message_text, role="user"):
@@ -180,30 +473,33 @@ async def store_message(chat_id, user_id, message_text, role="user"):
         return None
     else:
         print("storing message: " + message_text)
-    messages_ref = db.collection(u'chats').document(str(chat_id)).collection(u'messages')
     msg = {
         'user_id': user_id,
         'message_text': message_text,
         'role': role,
-        'timestamp': firestore.SERVER_TIMESTAMP
     }
-    messages_ref.add(msg)
-    return {"role": msg['role'],"content": msg['message_text']}
+    if MESSAGE_RETENTION_DAYS:
+        # Lets a Firestore TTL policy on `expire_at` delete the message without the compaction job
+        msg['expire_at'] = time.time() + MESSAGE_RETENTION_DAYS * DAY
+    turn = {"role": msg['role'],"content": msg['message_text']}
+    if HISTORY_LAYOUT == 'conversation':
+        await store.append_conversation(chat_id, user_id, [turn], CONVERSATION_MAX_TURNS)
+    else:
+        await store.add_message(chat_id, msg)
+    return turn
 
 
 async def get_previous_messages(chat_id, user_id):
-    messages_ref = db.collection(u'chats').document(str(chat_id)).collection(u'messages')
-    messages = messages_ref.where('user_id', '==', user_id).order_by('timestamp', direction=firestore.Query.ASCENDING).stream()
-    return [{"role": msg.to_dict()['role'],"content": msg.to_dict()['message_text']} for msg in messages]
-
+    if HISTORY_LAYOUT == 'conversation':
+        return await store.get_conversation(chat_id, user_id)
+    messages = await store.get_messages(chat_id, user_id)
+    return [{"role": msg['role'],"content": msg['message_text']} for msg in messages]
 
-# Wrap the openai.Completion.create call in a try-except block
-from pydub import AudioSegment
 
 def convert_ogg_to_mp3(input_file, output_file):
+    # pydub is only needed for voice messages and probes for ffmpeg on import
+    from pydub import AudioSegment
+
     ogg_audio = AudioSegment.from_ogg(input_file)
     ogg_audio.export(output_file, format="mp3")
 
-
-def start_reset_task() -> asyncio.Task:
-    return asyncio.create_task(reset_message_count())
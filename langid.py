@@ -0,0 +1,184 @@
+"""Offline source language identification.
+
+Telling which targets a message doesn't need to be translated into used to
+take a paid round trip per language (`translated_text == message_text`).
+`detect()` guesses the language in-process instead: non-Latin scripts mostly
+identify the language by themselves, and Latin script text is scored against
+character trigram profiles built at import time from the short samples in
+`SAMPLES`. The sender's `preferred_language` can be passed as a prior, which
+settles short or ambiguous messages in the sender's favour.
+
+Only the languages in `SAMPLES` have a profile, so text in any other language
+still fits one of them best. Two checks keep such text from being taken for
+a profiled language: the confidence comes from how much better the best
+profile fits each trigram on average, not from the total over the message,
+and a message whose trigrams fit even the best profile worse than `MIN_FIT`
+is not identified at all. The prior picks between close languages but never
+raises the confidence.
+
+Callers should only act on a confident guess; an unsure one returns a low
+confidence rather than no answer, and a message that is too short to tell,
+or fits no profile, returns `(None, 0.0)`.
+"""
+import math
+import re
+from collections import Counter
+
+SAMPLES = {
+    "en": "Hello everyone, how are you doing today? I think we should meet at the beach tomorrow morning "
+          "when the weather is nice. Thank you for the pictures, they look great. What time does the "
+          "boat leave? Let me know if you need anything, I will be there with the children.",
+    "fr": "Bonjour à tous, comment allez-vous aujourd'hui ? Je pense qu'on devrait se retrouver à la plage "
+          "demain matin quand il fera beau. Merci pour les photos, elles sont magnifiques. À quelle heure "
+          "part le bateau ? Dites-moi si vous avez besoin de quelque chose, je serai là avec les enfants.",
+    "es": "Hola a todos, ¿cómo estáis hoy? Creo que deberíamos quedar en la playa mañana por la mañana "
+          "cuando haga buen tiempo. Gracias por las fotos, son preciosas. ¿A qué hora sale el barco? "
+          "Avisadme si necesitáis algo, yo estaré allí con los niños.",
+    "de": "Hallo zusammen, wie geht es euch heute? Ich denke, wir sollten uns morgen früh am Strand treffen, "
+          "wenn das Wetter schön ist. Danke für die Bilder, die sehen toll aus. Wann fährt das Boot ab? "
+          "Sagt mir Bescheid, wenn ihr etwas braucht, ich bin mit den Kindern da.",
+    "it": "Ciao a tutti, come state oggi? Penso che dovremmo incontrarci in spiaggia domani mattina quando "
+          "il tempo è bello. Grazie per le foto, sono bellissime. A che ora parte la barca? Fatemi sapere "
+          "se avete bisogno di qualcosa, io sarò lì con i bambini.",
+    "pt": "Olá a todos, como vocês estão hoje? Acho que devíamos nos encontrar na praia amanhã de manhã "
+          "quando o tempo estiver bom. Obrigado pelas fotos, estão lindas. A que horas sai o barco? "
+          "Avisem se precisarem de alguma coisa, eu vou estar lá com as crianças.",
+    "nl": "Hallo allemaal, hoe gaat het vandaag met jullie? Ik denk dat we morgenochtend op het strand moeten "
+          "afspreken als het mooi weer is. Bedankt voor de foto's, ze zien er geweldig uit. Hoe laat vertrekt "
+          "de boot? Laat het me weten als jullie iets nodig hebben, ik ben er met de kinderen.",
+    "sw": "Habari zenu nyote, mnaendeleaje leo? Nadhani tukutane ufukweni kesho asubuhi hali ya hewa "
+          "ikiwa nzuri. Asante kwa picha, ni nzuri sana. Boti inaondoka saa ngapi? Niambieni kama "
+          "mnahitaji kitu chochote, nitakuwa pale pamoja na watoto. Karibu sana, hakuna matata.",
+    "pl": "Cześć wszystkim, jak się dzisiaj macie? Myślę, że powinniśmy spotkać się jutro rano na plaży, "
+          "jeśli będzie ładna pogoda. Dziękuję za zdjęcia, wyglądają świetnie. O której godzinie odpływa "
+          "łódź? Dajcie znać, jeśli czegoś potrzebujecie, będę tam z dziećmi.",
+    "tr": "Herkese merhaba, bugün nasılsınız? Bence yarın sabah hava güzel olursa sahilde buluşmalıyız. "
+          "Fotoğraflar için teşekkürler, harika görünüyorlar. Tekne saat kaçta kalkıyor? Bir şeye "
+          "ihtiyacınız olursa haber verin, çocuklarla orada olacağım.",
+    "id": "Halo semuanya, apa kabar hari ini? Saya pikir kita harus bertemu di pantai besok pagi kalau "
+          "cuacanya bagus. Terima kasih untuk fotonya, bagus sekali. Jam berapa kapalnya berangkat? "
+          "Kabari saya kalau kalian butuh sesuatu, saya akan ada di sana bersama anak-anak.",
+    "sv": "Hej allihopa, hur mår ni idag? Jag tycker att vi ska träffas på stranden i morgon bitti om vädret "
+          "är fint. Tack för bilderna, de ser jättefina ut. När går båten? Säg till om ni behöver något, "
+          "jag kommer att vara där med barnen.",
+}
+
+# Scripts that identify a language on their own, or a default with the alternatives a prior can pick
+SCRIPTS = [
+    ("ko", re.compile(r"[가-힯ᄀ-ᇿ]"), {"ko"}),
+    ("ja", re.compile(r"[぀-ヿ]"), {"ja"}),
+    ("zh", re.compile(r"[一-鿿]"), {"zh", "zh-CN", "zh-TW", "ja"}),
+    ("ru", re.compile(r"[Ѐ-ӿ]"), {"ru", "uk", "bg", "sr", "mk", "be", "kk"}),
+    ("ar", re.compile(r"[؀-ۿ]"), {"ar", "fa", "ur"}),
+    ("hi", re.compile(r"[ऀ-ॿ]"), {"hi", "mr", "ne"}),
+    ("el", re.compile(r"[Ͱ-Ͽ]"), {"el"}),
+    ("he", re.compile(r"[֐-׿]"), {"he", "iw", "yi"}),
+    ("th", re.compile(r"[฀-๿]"), {"th"}),
+]
+# Confidence of the script's default language when other languages share the script
+SHARED_SCRIPT_CONFIDENCE = 0.6
+# Characters that only occur in one of simplified or traditional Chinese
+SIMPLIFIED = set("这说个们会时国来为学对后经发过现还东车长门问间见电语认请让")
+TRADITIONAL = set("這說個們會時國來為學對後經發過現還東車長門問間見電語認請讓")
+UKRAINIAN = set("іїєґІЇЄҐ")
+# Google Translate codes that name the same language
+ALIASES = {"iw": "he", "jw": "jv"}
+
+LETTER = re.compile(r"[^\W\d_]")
+MIN_LETTERS = 3
+PRIOR_WEIGHT = 0.6  # share of the prior probability given to the sender's preferred language
+# Turns the per-trigram advantage of a profile into confidence; 15 gives text in a profiled language
+# 0.9 or more and text in other Latin script languages under 0.7
+SHARPNESS = 15
+# Mean log-likelihood per trigram under the best profile below which the text fits none of them;
+# a trigram no profile has scores about -7.7
+MIN_FIT = -7.3
+
+
+def _trigrams(text):
+    text = " " + re.sub(r"[^\w]+|\d+|_", " ", text.lower()).strip() + " "
+    return Counter(text[i:i + 3] for i in range(len(text) - 2))
+
+
+PROFILES = {lang: _trigrams(sample) for lang, sample in SAMPLES.items()}
+VOCABULARY = len(set().union(*PROFILES.values()))
+
+
+def _log_likelihoods(text):
+    grams = _trigrams(text)
+    scores = {}
+    for lang, profile in PROFILES.items():
+        total = sum(profile.values()) + VOCABULARY
+        scores[lang] = sum(count * math.log((profile[gram] + 1) / total) for gram, count in grams.items())
+    return scores
+
+
+def _softmax(scores):
+    top = max(scores.values())
+    weights = {lang: math.exp(score - top) for lang, score in scores.items()}
+    total = sum(weights.values())
+    return {lang: weight / total for lang, weight in weights.items()}
+
+
+def _posterior(scores, trigrams, prior):
+    """`(language, confidence)` from the per-trigram log-likelihoods of `trigrams` trigrams."""
+    if max(scores.values()) / trigrams < MIN_FIT:
+        return None, 0.0
+    fit = _softmax({lang: score / trigrams * SHARPNESS for lang, score in scores.items()})
+    prior = normalize(prior) if prior else None
+    if prior in fit:
+        others = (1 - PRIOR_WEIGHT) / max(len(fit) - 1, 1)
+        lang = max(fit, key=lambda lang: fit[lang] * (PRIOR_WEIGHT if lang == prior else others))
+    else:
+        lang = max(fit, key=fit.get)
+    # The prior settles the choice, the text alone the confidence
+    return lang, fit[lang]
+
+
+def _detect_script(text, letters, prior):
+    for default, pattern, family in SCRIPTS:
+        if len(pattern.findall(text)) * 2 < letters:
+            continue
+        if default == "zh":
+            if SCRIPTS[1][1].search(text):
+                return "ja", 0.95
+            simplified = sum(ch in SIMPLIFIED for ch in text)
+            traditional = sum(ch in TRADITIONAL for ch in text)
+            if simplified > traditional:
+                return "zh-CN", 0.9
+            if traditional > simplified:
+                return "zh-TW", 0.9
+            if prior and normalize(prior) in family:
+                return normalize(prior), 0.9
+            # Nothing tells the variants apart, so neither may be pruned
+            return "zh", SHARED_SCRIPT_CONFIDENCE
+        if default == "ru" and any(ch in UKRAINIAN for ch in text):
+            return "uk", 0.9
+        if prior and normalize(prior) in family:
+            return normalize(prior), 0.9
+        return default, 0.95 if len(family) == 1 else SHARED_SCRIPT_CONFIDENCE
+    return None
+
+
+def normalize(code):
+    return ALIASES.get(code, code)
+
+
+def detect(text, prior=None):
+    """Returns `(language, confidence)` for `text`; `prior` is the sender's preferred language, if known."""
+    letters = len(LETTER.findall(text))
+    if letters < MIN_LETTERS:
+        return None, 0.0
+    by_script = _detect_script(text, letters, prior)
+    if by_script:
+        return by_script
+    return _posterior(_log_likelihoods(text), sum(_trigrams(text).values()), prior)
+
+
+def same_language(target, detected):
+    """Whether translating into `target` is pointless for text detected as `detected`.
+
+    Regional targets only match exactly, so a message detected as plain "zh"
+    is still translated into both "zh-CN" and "zh-TW".
+    """
+    return bool(detected) and normalize(target) == normalize(detected)
@@ -0,0 +1,167 @@
+"""Detects callbacks that block the event loop.
+
+Firestore, the Translate SDK, `openai.ChatCompletion.create` and pydub are
+synchronous, and a call to one of them inside a coroutine stops every chat
+until it returns. The watchdog finds such calls in two halves:
+
+- a heartbeat coroutine sleeps `LOOP_WATCHDOG_INTERVAL` seconds at a time and
+  records how late it wakes up in a loop lag histogram;
+- a thread checks the heartbeat. When it is more than `LOOP_BLOCK_THRESHOLD`
+  seconds late, the loop is stuck in one callback, and the thread logs the
+  loop thread's stack at that moment, i.e. the blocking call itself, along
+  with the handler it ran in (see profiling.active_handler).
+
+`main.py` runs one for the bot and logs the histogram every
+`LOOP_LAG_REPORT_INTERVAL` seconds; benchmark.py runs one per scenario and
+reports the lag and the number of blocks next to the latencies:
+
+    dog = LoopWatchdog(threshold=0.1)
+    dog.start()            # from the event loop
+    ...
+    dog.stop()
+    dog.stats()            # {'lag': {'p50_ms': ..., 'p99_ms': ..., 'max_ms': ..., 'buckets': {...}}, 'blocked': ...}
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+import config
+import profiling
+
+LOOP_WATCHDOG = getattr(config, 'LOOP_WATCHDOG', True)
+LOOP_WATCHDOG_INTERVAL = getattr(config, 'LOOP_WATCHDOG_INTERVAL', 0.05)
+LOOP_BLOCK_THRESHOLD = getattr(config, 'LOOP_BLOCK_THRESHOLD', 0.25)
+LOOP_LAG_REPORT_INTERVAL = getattr(config, 'LOOP_LAG_REPORT_INTERVAL', 3600)
+# Upper bounds of the histogram buckets in milliseconds; later lags go to the last, open bucket
+LAG_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+STACK_DEPTH = 25
+
+
+class LagHistogram:
+    def __init__(self, buckets=LAG_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        index = next((i for i, bound in enumerate(self.buckets) if ms <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.count += 1
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        """Upper bound in ms of the bucket holding the `q`th percentile (the maximum for the open bucket)."""
+        if not self.count:
+            return 0.0
+        rank = max(1, round(q / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return float(self.buckets[index]) if index < len(self.buckets) else round(self.max, 3)
+        return round(self.max, 3)
+
+    def as_dict(self):
+        labels = [f"le_{bound}" for bound in self.buckets] + [f"gt_{self.buckets[-1]}"]
+        return {"samples": self.count, "p50_ms": self.percentile(50), "p99_ms": self.percentile(99),
+                "max_ms": round(self.max, 3), "buckets": dict(zip(labels, self.counts))}
+
+
+class LoopWatchdog:
+    def __init__(self, interval=LOOP_WATCHDOG_INTERVAL, threshold=LOOP_BLOCK_THRESHOLD, log=print):
+        self.interval = interval
+        self.threshold = threshold
+        self.log = log
+        self.histogram = LagHistogram()
+        self.blocked = Counter()
+        self._due = float("inf")
+        self._reported = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._loop_thread_id = None
+
+    def start(self):
+        """Starts watching the running event loop; call from the loop's thread."""
+        self._loop_thread_id = threading.get_ident()
+        self._due = time.monotonic() + self.interval
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            # The loop should wake this coroutine at `due`; anything later is time it spent elsewhere
+            self._due = due = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.histogram.add(max(0.0, time.monotonic() - due))
+
+    def _watch(self):
+        while not self._stopped.wait(min(self.interval, self.threshold) / 4):
+            due = self._due
+            late = time.monotonic() - due
+            if late > self.threshold and due != self._reported:
+                # Report every stall once, while it is still going on
+                self._reported = due
+                self._report(late)
+
+    def _report(self, late):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        handler = profiling.active_handler(frame)
+        self.blocked[handler] += 1
+        stack = "".join(traceback.format_stack(frame, limit=STACK_DEPTH))
+        self.log(f"[ERROR] Event loop blocked for at least {late * 1000:.0f} ms"
+                 f"{f' in handler {handler}' if handler else ''}:\n{stack}")
+
+    def stats(self):
+        return {"lag": self.histogram.as_dict(), "blocked": sum(self.blocked.values()),
+                "blocked_by_handler": {handler or "(none)": count for handler, count in self.blocked.items()}}
+
+
+_watchdog = None
+
+
+def start():
+    """Starts the bot's watchdog if LOOP_WATCHDOG is on; call from the event loop."""
+    global _watchdog
+    if LOOP_WATCHDOG and _watchdog is None:
+        _watchdog = LoopWatchdog().start()
+    return _watchdog
+
+
+def stop():
+    global _watchdog
+    if _watchdog is not None:
+        _watchdog.stop()
+        _watchdog = None
+
+
+def format_stats(stats):
+    lag = stats["lag"]
+    text = (f"loop lag p50 {lag['p50_ms']} ms, p99 {lag['p99_ms']} ms, max {lag['max_ms']} ms "
+            f"over {lag['samples']} beats; {stats['blocked']} block(s)")
+    if stats["blocked_by_handler"]:
+        text += " (" + ", ".join(f"{handler} {count}" for handler, count in stats["blocked_by_handler"].items()) + ")"
+    return text
+
+
+async def report_periodically(interval=LOOP_LAG_REPORT_INTERVAL):
+    while _watchdog is not None:
+        await asyncio.sleep(interval)
+        if _watchdog is not None:
+            print(f"[INFO] Event loop: {format_stats(_watchdog.stats())}")
@@ -1,51 +1,123 @@
 import asyncio
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ChatMemberHandler
+from telegram import Update
+from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ChatMemberHandler, TypeHandler
+import cleanup
+import clients
+import coalesce
+import config
+import dedup
+import loop_watchdog
+import retention
+import sharding
 from config import TELEGRAM_TOKEN
 from commands import start, set_lang, my_lang, transcribe_voice_message
-from handlers import greet_new_user, remove_left_user, translate_message, bot_removed_from_chat, bot_added_to_chat
-from helpers import start_reset_task
-
-app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-
-start_handler = CommandHandler('start', start)
-set_lang_handler = CommandHandler('setlang', set_lang)
-my_lang_handler = CommandHandler('mylang', my_lang)
-message_handler = MessageHandler(filters.TEXT, translate_message)
-new_user_handler = ChatMemberHandler(greet_new_user, ChatMemberHandler.CHAT_MEMBER)
-left_user_handler = ChatMemberHandler(remove_left_user, ChatMemberHandler.CHAT_MEMBER)
-bot_modified_handler = ChatMemberHandler(bot_added_to_chat, ChatMemberHandler.MY_CHAT_MEMBER)
-bot_removed_handler = ChatMemberHandler(bot_removed_from_chat, ChatMemberHandler.MY_CHAT_MEMBER)
-voice_handler = MessageHandler(filters.VOICE, transcribe_voice_message)
-
-app.add_handler(start_handler)
-app.add_handler(set_lang_handler)
-app.add_handler(my_lang_handler)
-app.add_handler(message_handler)
-app.add_handler(new_user_handler)
-app.add_handler(left_user_handler)
-app.add_handler(bot_modified_handler)
-app.add_handler(bot_removed_handler)
-app.add_handler(voice_handler)
-
-def handle_task_completion(task: asyncio.Task) -> None:
-    """Callback to handle the completion of the reset_message_count task."""
-    try:
-        # Check if the task raised an exception
-        if task.exception() is not None:
-            print(f"[ERROR] Reset message count task failed: {task.exception()}")
-        else:
-            # Optionally, log successful completion or check result if the task returns one
-            print("[INFO] Reset message count task completed (or was cancelled).")
-    except asyncio.CancelledError:
-        print("[INFO] Reset message count task was cancelled.")
-    except Exception as e:
-        # Log any other error that might occur within the callback itself
-        print(f"[ERROR] Exception in handle_task_completion: {e}")
+from handlers import greet_new_user, remove_left_user, translate_message, translate_edit, bot_removed_from_chat, bot_added_to_chat
+from helpers import warm_up_member_cache, reconcile_active_chats_periodically, ACTIVE_CHATS_RECONCILE_INTERVAL
+from profiling import profiled, profile_command, start_from_config as start_profiling
+from replay import UpdateRecorder
 
-if __name__ == "__main__":
-    # Start the background task for resetting message counts
-    reset_task = start_reset_task()
-    reset_task.add_done_callback(handle_task_completion)
+RECORD_UPDATES_PATH = getattr(config, 'RECORD_UPDATES_PATH', None)
+# Build the Firestore and Translate clients before the first update instead of on it.
+# Leave off for webhook deployments that should answer as soon as possible after a cold start.
+WARM_UP_CLIENTS = getattr(config, 'WARM_UP_CLIENTS', False)
+# Load every chat's members and language preferences before the first update is taken in
+WARM_UP_MEMBER_CACHE = getattr(config, 'WARM_UP_MEMBER_CACHE', True)
+
+
+async def post_init(application) -> None:
+    # In a worker process (see sharding.py), only the worker's own chats are loaded and cleaned up,
+    # and the jobs covering all chats run in worker 0 alone
+    shard = sharding.current
+    owns = shard.owns if shard else None
+    primary = shard is None or shard.primary
+    # PROFILE_SAMPLE_RATE; started here so that the sampler watches the event loop's thread
+    start_profiling()
+    # Logs callbacks that block the event loop, and the loop lag now and then (LOOP_WATCHDOG)
+    if loop_watchdog.start():
+        application.create_task(loop_watchdog.report_periodically())
+    if WARM_UP_CLIENTS:
+        timings = await asyncio.to_thread(clients.warm_up)
+        print(f"[INFO] Warmed up clients: {', '.join(f'{name} {seconds:.2f}s' for name, seconds in timings.items())}")
+    if WARM_UP_MEMBER_CACHE:
+        try:
+            await warm_up_member_cache(owns=owns)
+        except Exception as e:
+            # The cache fills itself chat by chat, so a failed warm-up only costs latency
+            print(f"[ERROR] Member cache warm-up failed: {e}")
+    if ACTIVE_CHATS_RECONCILE_INTERVAL and primary:
+        application.create_task(reconcile_active_chats_periodically())
+    application.create_task(cleanup.run_worker(owns=owns))
+    if retention.policy_configured() and primary:
+        application.create_task(retention.run_periodically())
+
+
+async def post_stop(application) -> None:
+    # Don't drop messages still waiting for the rest of their burst. Runs after the last update
+    # was handled and before shutdown() closes the bot's connection, which sending the replies needs.
+    await coalesce.flush_all()
+
+
+async def post_shutdown(application) -> None:
+    loop_watchdog.stop()
+    # Close the Translate connection pool (translate_rest.py) cleanly
+    if clients.is_built("translate") and hasattr(clients.get("translate"), "aclose"):
+        await clients.get("translate").aclose()
+
+
+# Every callback is wrapped so that a sample of its invocations can be profiled (see profiling.py)
+start_handler = CommandHandler('start', profiled(start))
+set_lang_handler = CommandHandler('setlang', profiled(set_lang))
+my_lang_handler = CommandHandler('mylang', profiled(my_lang))
+profile_handler = CommandHandler('profile', profile_command)
+message_handler = MessageHandler(filters.TEXT & ~filters.UpdateType.EDITED, profiled(translate_message))
+edited_message_handler = MessageHandler(filters.TEXT & filters.UpdateType.EDITED_MESSAGE, profiled(translate_edit))
+new_user_handler = ChatMemberHandler(profiled(greet_new_user), ChatMemberHandler.CHAT_MEMBER)
+left_user_handler = ChatMemberHandler(profiled(remove_left_user), ChatMemberHandler.CHAT_MEMBER)
+bot_modified_handler = ChatMemberHandler(profiled(bot_added_to_chat), ChatMemberHandler.MY_CHAT_MEMBER)
+bot_removed_handler = ChatMemberHandler(profiled(bot_removed_from_chat), ChatMemberHandler.MY_CHAT_MEMBER)
+voice_handler = MessageHandler(filters.VOICE, profiled(transcribe_voice_message))
+# Stops updates Telegram delivers again (see dedup.py)
+dedup_handler = TypeHandler(Update, dedup.skip_duplicates)
 
+
+def register_handlers(application):
+    """Adds the bot's handlers to `application`; shared with the replay tool."""
+    # Runs before every other group, the update recorder included
+    application.add_handler(dedup_handler, group=-2)
+    application.add_handler(start_handler)
+    application.add_handler(set_lang_handler)
+    application.add_handler(my_lang_handler)
+    application.add_handler(profile_handler)
+    application.add_handler(message_handler)
+    application.add_handler(edited_message_handler)
+    application.add_handler(new_user_handler)
+    application.add_handler(left_user_handler)
+    application.add_handler(bot_modified_handler)
+    # Both react to MY_CHAT_MEMBER updates and only the first match of a group runs
+    application.add_handler(bot_removed_handler, group=1)
+    application.add_handler(voice_handler)
+
+
+def add_update_recorder(application):
+    """Records every update `application` receives to RECORD_UPDATES_PATH, if set (see replay.py)."""
+    if RECORD_UPDATES_PATH:
+        # Runs after de-duplication, before the bot's handlers, and never stops processing
+        application.add_handler(TypeHandler(Update, UpdateRecorder(RECORD_UPDATES_PATH)), group=-1)
+
+
+def build_application():
+    """The single-process bot. Built on demand so that importing this module (replay.py, sharding.py)
+    creates no Application of its own."""
+    application = (ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(post_init).post_stop(post_stop)
+                   .post_shutdown(post_shutdown).build())
+    register_handlers(application)
+    add_update_recorder(application)
+    return application
+
+
+if __name__ == "__main__":
     # Run the bot
-    app.run_polling()
\ No newline at end of file
+    if sharding.WORKERS > 1:
+        sharding.run()
+    else:
+        build_application().run_polling()
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""Converts stored assistant history to the per-user conversation layout.
+
+Reads every chat's messages, groups them by user and writes one capped
+conversation record per user, so the bot can run with
+`HISTORY_LAYOUT = 'conversation'` without losing context. Source messages are
+left in place; run it once before switching the layout, and again right after
+to pick up anything written in between:
+
+    python migrate_history.py --dry-run
+    python migrate_history.py --max-turns 40
+"""
+import argparse
+import asyncio
+
+from storage import cap_turns
+
+
+async def migrate_chat(store, chat_id, max_turns, dry_run=False):
+    """Returns the number of conversations written for the chat."""
+    turns_by_user = {}
+    for msg in await store.get_chat_messages(chat_id):
+        if msg['role'] == 'system':
+            # Copies of the persona stored by older versions; it is added at request time now
+            continue
+        turns_by_user.setdefault(msg['user_id'], []).append({"role": msg['role'], "content": msg['message_text']})
+    if not dry_run:
+        for user_id, turns in turns_by_user.items():
+            await store.set_conversation(chat_id, user_id, cap_turns(turns, max_turns))
+    return len(turns_by_user)
+
+
+async def migrate(store, max_turns, dry_run=False):
+    chats = conversations = 0
+    # Private chats usually have messages but no chat record
+    for chat_id in await store.list_message_chat_ids():
+        written = await migrate_chat(store, chat_id, max_turns, dry_run=dry_run)
+        chats += 1
+        conversations += written
+        if written:
+            print(f"[INFO] Chat {chat_id}: {written} conversation(s){' (dry run)' if dry_run else ''}")
+    print(f"[INFO] Migrated {conversations} conversation(s) in {chats} chat(s).")
+    return conversations
+
+
+def main(argv=None):
+    import helpers
+
+    parser = argparse.ArgumentParser(description="Build per-user conversation records from stored messages.")
+    parser.add_argument("--max-turns", type=int, default=helpers.CONVERSATION_MAX_TURNS)
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be written")
+    args = parser.parse_args(argv)
+    asyncio.run(migrate(helpers.store, args.max_turns, dry_run=args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,21 @@
-import openai
+import asyncio
+
 import config
-from openai import OpenAIError
 from config import OPENAI_API_KEY
 from helpers import convert_ogg_to_mp3
 
+# The openai SDK is imported on first use to keep start-up light, see clients.py
+
 
 async def get_openai_response(messages) -> str:
+    import openai
+    from openai import OpenAIError
+
     openai.api_key = OPENAI_API_KEY
     try:
-        response = openai.ChatCompletion.create(
+        # The SDK call blocks; in a thread it leaves the event loop to other chats and can be timed out
+        response = await asyncio.to_thread(
+            openai.ChatCompletion.create,
             model="gpt-3.5-turbo",
             messages=messages
         )
@@ -25,6 +32,9 @@ import tempfile
 import os
 
 async def transcribe_audio(audio_data: bytes) -> str:
+    import openai
+    from openai import OpenAIError
+
     openai.api_key = config.OPENAI_API_KEY
     
     ogg_temp_file = None
@@ -0,0 +1,56 @@
+"""The persona the assistant speaks as in 1:1 chats and @mentions.
+
+The persona prompt is put in front of the history when the OpenAI request is
+made and is never stored with the conversation, so history records only hold
+what was actually said, and a changed prompt applies to every user on their
+next message. The prompt comes from, in order of preference, the file at
+`PERSONA_PATH`, `PERSONA_PROMPT` or the built-in `DEFAULT_PROMPT`:
+
+    persona.prepend(history)    # [{'role': 'system', ...}, *history without system turns]
+    persona.version             # PERSONA_VERSION, or a digest of the prompt
+
+Histories written before the persona moved here start with a stored copy of
+it; `prepend` drops stored system turns so that only the current persona is
+sent.
+"""
+import hashlib
+
+import config
+
+DEFAULT_PROMPT = ("From now on you act as Said. You are a 52 years old man living on Zanzibar. "
+                  "You were born on Zanzibar in a small village called Fujoni where you lived your entire life, "
+                  "besides regular trips to Tanzania Mainland, mainly to Dar Es Salam, you never really left the island. "
+                  "You have 7 kids of which 3 are already grown up. You also have three grand childs. "
+                  "You are an unbevielably kind human being who is always willing to help. "
+                  "You speak english like a 5 year old and you speak Swahili fluently. "
+                  "You do not speak any other language, only Swahili and a broken English."
+                  "You have a strong connection to the nature and to the ocean. During the day you like to go running and swimming. "
+                  "At night you go hunting for octopus if the tide is high enough, of course traditionally with a spear. "
+                  "When you meet new people you always at them. Your hugs are always honest and meaningful. "
+                  "You always begin a conversation with 'Mambo' "
+                  "If you don't know the answer you can always respond with either 'Hakuna matata' or Karibu or 'Pole pole' or Poa. ")
+
+PERSONA_PATH = getattr(config, 'PERSONA_PATH', None)
+PERSONA_PROMPT = getattr(config, 'PERSONA_PROMPT', DEFAULT_PROMPT)
+# Set explicitly to name versions; by default every distinct prompt is its own version
+PERSONA_VERSION = getattr(config, 'PERSONA_VERSION', None)
+
+
+def load(path=PERSONA_PATH, prompt=PERSONA_PROMPT, version=PERSONA_VERSION):
+    """Returns `(prompt, version)`."""
+    if path:
+        with open(path, encoding="utf-8") as f:
+            prompt = f.read().strip()
+    return prompt, version or hashlib.sha256(prompt.encode()).hexdigest()[:12]
+
+
+prompt, version = load()
+
+
+def messages():
+    return [{"role": "system", "content": prompt}]
+
+
+def prepend(history):
+    """The request messages for `history`: the current persona, then every turn that isn't a system turn."""
+    return messages() + [turn for turn in history if turn.get('role') != 'system']
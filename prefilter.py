@@ -0,0 +1,85 @@
+"""Decides locally which parts of a message are worth sending to the translator.
+
+URLs, @mentions, e-mail addresses, /commands and code spans come back from
+the API unchanged (or worse, mangled), and a message made only of those,
+emoji, numbers and punctuation comes back identical and is thrown away. The
+message is split into segments; protected segments are kept as they are and
+only segments containing letters are translated, so a message without any
+is never sent to the API at all:
+
+    segments = split("see https://example.com, it's great")
+    # [("see", True), (" ", False), ("https://example.com", False), (", it's great", True)]
+"""
+import re
+
+PROTECTED = re.compile(
+    r"```.*?```"                                # code blocks
+    r"|`[^`\n]+`"                               # inline code
+    r"|(?:https?://|www\.)\S*[^\s.,;:!?)'\"]"   # URLs, without trailing punctuation
+    r"|[\w.+-]+@[\w-]+\.[\w.-]+"                # e-mail addresses
+    r"|(?<![\w/])@\w+"                          # mentions
+    r"|(?<!\S)/\w+(?:@\w+)?",                   # bot commands
+    re.DOTALL,
+)
+LETTER = re.compile(r"[^\W\d_]")
+CODE_SYMBOLS = re.compile(r"[{}\[\]();=<>]")
+LINE_BREAK = re.compile(r"(\s*\n\s*)")
+
+
+def looks_like_code(text):
+    """Unfenced code, e.g. a pasted `x = f(y);`: mostly symbols and at least one statement-ish character."""
+    letters = len(LETTER.findall(text))
+    symbols = len(CODE_SYMBOLS.findall(text))
+    return symbols >= 2 and symbols > 0.25 * (letters + symbols) and bool(re.search(r"[;{}=]", text))
+
+
+def _split_line(text):
+    # Keep the surrounding whitespace out of the translated part; the API doesn't preserve it
+    if not LETTER.search(text):
+        return [(text, False)]
+    stripped = text.strip()
+    start = text.index(stripped)
+    parts = [(text[:start], False), (stripped, True), (text[start + len(stripped):], False)]
+    return [part for part in parts if part[0]]
+
+
+def _split_text(text):
+    # Every line is a segment of its own, so that editing one line leaves the
+    # translations of the others reusable (see replies.py)
+    segments = []
+    for i, part in enumerate(LINE_BREAK.split(text)):
+        if i % 2:
+            segments.append((part, False))
+        elif part:
+            segments.extend(_split_line(part))
+    return segments
+
+
+def split(text):
+    """Splits `text` into `(segment, translatable)` pairs that concatenate back to `text`."""
+    if looks_like_code(text):
+        return [(text, False)]
+    segments = []
+    position = 0
+    for match in PROTECTED.finditer(text):
+        if match.start() > position:
+            segments.extend(_split_text(text[position:match.start()]))
+        segments.append((match.group(), False))
+        position = match.end()
+    if position < len(text):
+        segments.extend(_split_text(text[position:]))
+    return segments
+
+
+def has_translatable(segments):
+    return any(translatable for _, translatable in segments)
+
+
+def is_translatable(text):
+    return has_translatable(split(text))
+
+
+def join(segments, translations):
+    """Reassembles the message, taking translated segments in order from `translations`."""
+    translations = iter(translations)
+    return "".join(next(translations) if translatable else segment for segment, translatable in segments)
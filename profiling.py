@@ -0,0 +1,253 @@
+"""Opt-in profiling of the running bot, per handler.
+
+Off by default. It is switched on at start-up with the `PROFILE_SAMPLE_RATE`
+environment variable (or config entry), e.g. `PROFILE_SAMPLE_RATE=0.05`, or
+at run time by an admin (`ADMIN_USER_IDS`) with the `/profile` command:
+
+    /profile on 0.05 sample   # profile 5% of handler invocations with the stack sampler
+    /profile on 1 cprofile    # every invocation under cProfile
+    /profile status           # samples and invocations per handler
+    /profile dump             # write the results to PROFILE_DIR
+    /profile off
+
+Every handler registered in main.py is wrapped with `profiled()`. The chosen
+fraction of its invocations is profiled, and results are kept per handler:
+
+- `sample` (the default) runs a thread that looks at the event loop's stack
+  every `PROFILE_INTERVAL` seconds. A sample counts for the handler whose
+  invocation is on the stack at that moment, so time spent in other
+  coroutines while a handler awaits is not charged to it. `dump()` writes one
+  `<handler>.collapsed` file per handler in the collapsed stack format read by
+  flamegraph.pl and speedscope.
+- `cprofile` runs the invocation under cProfile and merges the statistics per
+  handler; `dump()` writes `<handler>.pstats` files for `python -m pstats` or
+  snakeviz. Only one invocation is under cProfile at a time, and like the
+  sampler it sees other coroutines that run while the handler awaits.
+"""
+import asyncio
+import cProfile
+import os
+import pstats
+import random
+import sys
+import threading
+from collections import Counter
+from functools import wraps
+
+import config
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", getattr(config, 'PROFILE_SAMPLE_RATE', 0)))
+PROFILE_MODE = os.environ.get("PROFILE_MODE", getattr(config, 'PROFILE_MODE', 'sample'))
+PROFILE_INTERVAL = getattr(config, 'PROFILE_INTERVAL', 0.005)
+PROFILE_DIR = getattr(config, 'PROFILE_DIR', 'profiles')
+ADMIN_USER_IDS = {str(user_id) for user_id in getattr(config, 'ADMIN_USER_IDS', [])}
+MODES = ("sample", "cprofile")
+
+rate = 0.0
+mode = "sample"
+# handler name -> Counter of collapsed stacks (sample mode) / merged pstats.Stats (cprofile mode)
+stacks = {}
+stats = {}
+invocations = Counter()
+_cprofile_busy = False
+_sampler = None
+# Guards `stacks`, which the sampler thread writes to
+_lock = threading.Lock()
+
+
+class Sampler(threading.Thread):
+    """Samples the stack of one thread (the event loop's) at a fixed interval."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                record(frame)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def _frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def record(frame):
+    """Adds the stack ending in `frame` to the handler being profiled on it, if any."""
+    names = []
+    handler = None
+    while frame is not None:
+        if frame.f_code is _invoke.__code__:
+            # The innermost profiled invocation owns the sample
+            handler = handler or frame.f_locals.get("name")
+            break
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    if handler is not None and names:
+        with _lock:
+            stacks.setdefault(handler, Counter())[";".join([handler] + names[::-1])] += 1
+
+
+def enable(sample_rate, profile_mode="sample", interval=PROFILE_INTERVAL):
+    """Profiles `sample_rate` (0 to 1) of all handler invocations; call from the event loop's thread."""
+    global rate, mode, _sampler
+    if profile_mode not in MODES:
+        raise ValueError(f"Unknown profiling mode {profile_mode!r}, expected one of {', '.join(MODES)}")
+    disable()
+    rate, mode = max(0.0, min(1.0, sample_rate)), profile_mode
+    if mode == "sample":
+        _sampler = Sampler(threading.get_ident(), interval)
+        _sampler.start()
+    print(f"[INFO] Profiling {rate:.0%} of handler invocations ({mode}).")
+
+
+def disable():
+    global rate, _sampler
+    rate = 0.0
+    if _sampler is not None:
+        _sampler.stop()
+        _sampler = None
+
+
+def enabled():
+    return rate > 0
+
+
+def reset():
+    with _lock:
+        stacks.clear()
+    stats.clear()
+    invocations.clear()
+
+
+async def _invoke(name, handler, args, kwargs):
+    # The sampler finds this frame on the stack while the handler runs, see record()
+    return await handler(*args, **kwargs)
+
+
+async def _invoke_cprofile(name, handler, args, kwargs):
+    global _cprofile_busy
+    profile = cProfile.Profile()
+    _cprofile_busy = True
+    profile.enable()
+    try:
+        return await handler(*args, **kwargs)
+    finally:
+        profile.disable()
+        _cprofile_busy = False
+        if name in stats:
+            stats[name].add(profile)
+        else:
+            stats[name] = pstats.Stats(profile)
+
+
+def profiled(handler):
+    """Wraps an async handler so that a sampled fraction of its invocations is profiled."""
+    name = handler.__name__
+
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        if not rate or random.random() >= rate:
+            return await handler(*args, **kwargs)
+        if mode == "cprofile":
+            if _cprofile_busy:
+                # cProfile can't nest; this invocation goes unprofiled
+                return await handler(*args, **kwargs)
+            invocations[name] += 1
+            return await _invoke_cprofile(name, handler, args, kwargs)
+        invocations[name] += 1
+        return await _invoke(name, handler, args, kwargs)
+
+    return wrapper
+
+
+# The code of every profiled() wrapper; a frame running it is a handler invocation
+_WRAPPER_CODE = profiled(_invoke).__code__
+
+
+def active_handler(frame):
+    """The name of the innermost profiled() handler on the stack ending in `frame`, or None."""
+    while frame is not None:
+        if frame.f_code is _WRAPPER_CODE:
+            return frame.f_locals.get("name")
+        frame = frame.f_back
+    return None
+
+
+def summary():
+    """`{handler: {'invocations': ..., 'samples': ...}}`; samples are call counts in cprofile mode."""
+    with _lock:
+        sampled = {name: sum(counts.values()) for name, counts in stacks.items()}
+    result = {}
+    for name in sorted(set(invocations) | set(sampled) | set(stats)):
+        samples = sampled[name] if name in sampled else stats[name].total_calls if name in stats else 0
+        result[name] = {"invocations": invocations[name], "samples": samples}
+    return result
+
+
+def dump(directory=PROFILE_DIR):
+    """Writes the results collected so far; returns the paths written."""
+    os.makedirs(directory, exist_ok=True)
+    with _lock:
+        collapsed = {name: counts.most_common() for name, counts in stacks.items()}
+    paths = []
+    for name, counts in collapsed.items():
+        path = os.path.join(directory, f"{name}.collapsed")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in counts:
+                f.write(f"{stack} {count}\n")
+        paths.append(path)
+    for name, profile in list(stats.items()):
+        path = os.path.join(directory, f"{name}.pstats")
+        profile.dump_stats(path)
+        paths.append(path)
+    print(f"[INFO] Wrote {len(paths)} profile(s) to {directory}.")
+    return paths
+
+
+def is_admin(user_id):
+    return str(user_id) in ADMIN_USER_IDS
+
+
+async def profile_command(update, context):
+    """/profile on [rate] [sample|cprofile] | off | status | dump | reset, for ADMIN_USER_IDS only."""
+    chat_id = update.effective_chat.id
+    if not is_admin(update.effective_user.id):
+        print(f"[INFO] Ignored /profile from user {update.effective_user.id}, not an admin.")
+        return
+    args = list(context.args or [])
+    action = args[0] if args else "status"
+    if action == "on":
+        try:
+            enable(float(args[1]) if len(args) > 1 else 0.05, args[2] if len(args) > 2 else PROFILE_MODE)
+        except ValueError as e:
+            await context.bot.send_message(chat_id=chat_id, text=f"Could not start profiling: {e}")
+            return
+        text = f"Profiling {rate:.0%} of handler invocations ({mode})."
+    elif action == "off":
+        disable()
+        text = "Profiling is off."
+    elif action == "dump":
+        paths = await asyncio.to_thread(dump)
+        text = "\n".join(paths) if paths else "Nothing profiled yet."
+    elif action == "reset":
+        reset()
+        text = "Profiling results cleared."
+    else:
+        lines = [f"{name}: {counts['invocations']} invocations, {counts['samples']} samples"
+                 for name, counts in summary().items()]
+        state = f"on, {rate:.0%} ({mode})" if enabled() else "off"
+        text = "\n".join([f"Profiling is {state}."] + lines)
+    await context.bot.send_message(chat_id=chat_id, text=text)
+
+
+def start_from_config():
+    """Enables profiling if PROFILE_SAMPLE_RATE is set; call from the event loop's thread."""
+    if PROFILE_SAMPLE_RATE:
+        enable(PROFILE_SAMPLE_RATE, PROFILE_MODE)
@@ -0,0 +1,310 @@
+"""Records incoming updates and replays them to reproduce production traffic.
+
+Recording is enabled by setting `RECORD_UPDATES_PATH` in `config.py`: every
+update is appended to that file as one JSON line, with user and chat ids,
+names, file ids and message text scrubbed. Scrubbing is deterministic and keeps
+lengths, so the same user maps to the same pseudonym and message entities keep
+pointing at the right offsets.
+
+Replaying feeds a recording to the handlers registered in `main.py`, either
+against the in-process fakes or against a staging bot:
+
+    python replay.py updates.jsonl --speed 60 --fanout 10 --seed-languages en,fr,es
+    python replay.py updates.jsonl --target staging --token <staging token> --staging-chat-id -100123
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import time
+
+from telegram import Update
+
+NAME_FIELDS = {"first_name", "last_name", "username", "title", "bio", "description", "email", "phone_number",
+               "invite_link", "name", "language_code"}
+FILE_FIELDS = {"file_id", "file_unique_id"}
+DROPPED_FIELDS = {"contact", "location", "venue", "photo", "thumbnail", "sticker", "animation", "document",
+                  "video", "video_note", "audio"}
+TEXT_FIELDS = {"text", "caption"}
+# Objects whose "id" identifies a person or a chat
+ID_OWNERS = {"from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat", "new_chat_member",
+             "old_chat_member", "left_chat_member", "new_chat_members"}
+FANOUT_OFFSET = 10 ** 12
+
+
+def _digest(salt, value):
+    return hashlib.sha256(f"{salt}:{value}".encode()).hexdigest()
+
+
+def pseudonymize_id(value, salt):
+    """Maps an id to a stable pseudonym with the same sign, keeping group ids negative."""
+    pseudonym = int(_digest(salt, value)[:12], 16) % FANOUT_OFFSET or 1
+    return -pseudonym if value < 0 else pseudonym
+
+
+def scrub_text(text, keep=()):
+    """Replaces letters and digits while keeping the length, whitespace and punctuation.
+
+    Words listed in `keep` (the bot's @mention), a leading /command and its short
+    arguments such as language codes survive so that routing in the handlers stays
+    the same.
+    """
+    scrubbed = []
+    is_command = text.startswith("/")
+    for index, word in enumerate(text.split(" ")):
+        if word in keep or (is_command and (index == 0 or len(word) <= 5)):
+            scrubbed.append(word)
+            continue
+        scrubbed.append("".join("0" if c.isdigit() else ("X" if c.isupper() else "x") if c.isalpha() else c
+                                for c in word))
+    return " ".join(scrubbed)
+
+
+def scrub_update(data, salt, keep=(), owner=None):
+    """Returns a copy of an `Update.to_dict()` payload with personal data removed."""
+    if isinstance(data, list):
+        return [scrub_update(item, salt, keep, owner) for item in data]
+    if not isinstance(data, dict):
+        return data
+    is_bot = data.get("is_bot", False)
+    scrubbed = {}
+    for key, value in data.items():
+        if key in DROPPED_FIELDS:
+            continue
+        if key == "id" and owner in ID_OWNERS and isinstance(value, int) and not is_bot:
+            scrubbed[key] = pseudonymize_id(value, salt)
+        elif key in NAME_FIELDS and isinstance(value, str) and not is_bot:
+            scrubbed[key] = f"{key}-{_digest(salt, value)[:8]}"
+        elif key in FILE_FIELDS and isinstance(value, str):
+            scrubbed[key] = _digest(salt, value)[:len(value)]
+        elif key in TEXT_FIELDS and isinstance(value, str):
+            scrubbed[key] = scrub_text(value, keep)
+        elif key == "url" and isinstance(value, str):
+            scrubbed[key] = "https://example.invalid/"
+        else:
+            scrubbed[key] = scrub_update(value, salt, keep, owner=key)
+    return scrubbed
+
+
+class UpdateRecorder:
+    """A `TypeHandler` callback that appends every update to a JSON lines file."""
+
+    def __init__(self, path, salt=None, scrub=True):
+        self.path = path
+        self.salt = salt if salt is not None else os.environ.get("RECORD_UPDATES_SALT", "mister-said")
+        self.scrub = scrub
+        self._file = None
+
+    async def __call__(self, update, context):
+        data = update.to_dict()
+        if self.scrub:
+            keep = (f"@{context.bot.username}",) if context.bot.username else ()
+            data = scrub_update(data, self.salt, keep)
+        if self._file is None:
+            self._file = open(self.path, "a", buffering=1)
+        self._file.write(json.dumps({"t": time.time(), "update": data}) + "\n")
+
+
+def load_recording(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _shift_ids(data, offset, owner=None):
+    if isinstance(data, list):
+        return [_shift_ids(item, offset, owner) for item in data]
+    if not isinstance(data, dict):
+        return data
+    shifted = {}
+    for key, value in data.items():
+        if key == "id" and owner in ID_OWNERS and isinstance(value, int) and not data.get("is_bot", False):
+            shifted[key] = value - offset if value < 0 else value + offset
+        else:
+            shifted[key] = _shift_ids(value, offset, owner=key)
+    return shifted
+
+
+def fan_out(data, copy):
+    """Clones a recorded update onto a disjoint set of chats and users; copy 0 is the original."""
+    if copy == 0:
+        return data
+    clone = _shift_ids(data, copy * FANOUT_OFFSET)
+    clone["update_id"] = data["update_id"] + copy * FANOUT_OFFSET
+    return clone
+
+
+def remap_chats(data, chat_ids, mapping):
+    """Points every chat in a recorded update at one of the staging `chat_ids`."""
+    if isinstance(data, list):
+        return [remap_chats(item, chat_ids, mapping) for item in data]
+    if not isinstance(data, dict):
+        return data
+    remapped = {}
+    for key, value in data.items():
+        if key == "chat" and isinstance(value, dict) and "id" in value:
+            original = value["id"]
+            if original not in mapping:
+                mapping[original] = chat_ids[len(mapping) % len(chat_ids)]
+            remapped[key] = dict(value, id=mapping[original])
+        else:
+            remapped[key] = remap_chats(value, chat_ids, mapping)
+    return remapped
+
+
+async def seed_languages(services, records, languages, fanout):
+    """Gives every user seen in the recording a preferred language in each of their chats."""
+    seen = set()
+    for record in records:
+        for copy in range(fanout):
+            update = Update.de_json(fan_out(record["update"], copy), services.bot)
+            chat, user = update.effective_chat, update.effective_user
+            if chat and user and (chat.id, user.id) not in seen:
+                seen.add((chat.id, user.id))
+                lang = languages[len(seen) % len(languages)]
+                await services.store.set_member(chat.id, user.id, {'preferred_language': lang})
+                services.bot.member_counts.setdefault(str(chat.id), 1)
+                services.bot.member_counts[str(chat.id)] += 1
+    services.calls.reset()
+
+
+class ReplayStats:
+    """Measures the time from an update's scheduled arrival until all handler groups ran."""
+
+    def __init__(self):
+        self.arrivals = {}
+        self.latencies = []
+        self.errors = 0
+        self.skipped = 0
+
+    async def on_done(self, update, context):
+        arrived = self.arrivals.pop(update.update_id, None)
+        if arrived is not None:
+            self.latencies.append(time.perf_counter() - arrived)
+
+    async def on_error(self, update, context):
+        self.errors += 1
+        print(f"[ERROR] Handler failed during replay: {context.error}", file=sys.__stderr__)
+
+
+async def replay(application, records, speed=1.0, fanout=1, transform=None, stats=None):
+    """Feeds `records` into a started `application` at their recorded pace divided by `speed`."""
+    from telegram.ext import TypeHandler
+
+    stats = stats or ReplayStats()
+    application.add_handler(TypeHandler(Update, stats.on_done), group=sys.maxsize)
+    application.add_error_handler(stats.on_error)
+
+    first = records[0]["t"] if records else 0
+    start = time.perf_counter()
+    for record in records:
+        due = start + (record["t"] - first) / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        for copy in range(fanout):
+            data = fan_out(record["update"], copy)
+            if transform:
+                data = transform(data)
+            update = Update.de_json(data, application.bot)
+            stats.arrivals[update.update_id] = time.perf_counter()
+            await application.update_queue.put(update)
+
+    # The queue is joined once every update went through the handler groups; updates a group stopped,
+    # such as redeliveries skipped by dedup.py, never reach on_done
+    processed = asyncio.ensure_future(application.update_queue.join())
+    while stats.arrivals and application.running and not processed.done():
+        await asyncio.sleep(0.01)
+    processed.cancel()
+    stats.skipped = len(stats.arrivals)
+    stats.arrivals.clear()
+    return time.perf_counter() - start, stats
+
+
+async def run_replay(args):
+    from telegram.ext import ApplicationBuilder
+    from benchmark import summarize
+
+    records = load_recording(args.recording)
+    if args.limit:
+        records = records[:args.limit]
+    services = None
+    transform = None
+    if args.target == "fakes":
+        from fakes import FakeServices
+
+        languages = args.seed_languages.split(",")
+        services = FakeServices(languages, firestore_latency=args.firestore_latency,
+                                translate_latency=args.translate_latency, openai_latency=args.openai_latency,
+                                telegram_latency=args.telegram_latency).install()
+        services.bot.username = args.bot_username
+        await seed_languages(services, records, languages, args.fanout)
+        builder = ApplicationBuilder().bot(services.bot)
+    else:
+        mapping = {}
+        chat_ids = args.staging_chat_id
+
+        def transform(data):
+            return remap_chats(data, chat_ids, mapping)
+        builder = ApplicationBuilder().token(args.token)
+
+    import main
+
+    application = builder.updater(None).concurrent_updates(args.concurrency).build()
+    main.register_handlers(application)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if not args.verbose else sys.stdout):
+            async with application:
+                await application.start()
+                seconds, stats = await replay(application, records, speed=args.speed, fanout=args.fanout,
+                                              transform=transform)
+                await application.stop()
+    finally:
+        if services:
+            services.uninstall()
+    calls = services.calls.snapshot() if services else {}
+    return summarize(len(records) * args.fanout, stats.errors, seconds, stats.latencies, calls)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded updates against the bot's handlers.")
+    parser.add_argument("recording", help="JSON lines file written by UpdateRecorder")
+    parser.add_argument("--target", choices=["fakes", "staging"], default="fakes")
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression, 10 replays ten times faster")
+    parser.add_argument("--fanout", type=int, default=1, help="replay every update on this many disjoint chats")
+    parser.add_argument("--concurrency", type=int, default=1, help="updates the Application processes at once")
+    parser.add_argument("--limit", type=int, help="replay only the first N recorded updates")
+    parser.add_argument("--seed-languages", default="en,fr,es,sw",
+                        help="languages assigned to the recorded users (fakes only)")
+    parser.add_argument("--bot-username", default="MisterSaidBot", help="username of the fake bot")
+    parser.add_argument("--firestore-latency", type=float, default=0.0)
+    parser.add_argument("--translate-latency", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--token", help="token of the staging bot")
+    parser.add_argument("--staging-chat-id", type=int, action="append",
+                        help="chat the staging bot replays into; repeat to spread recorded chats over several")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the handlers' output")
+    args = parser.parse_args(argv)
+    if args.target == "staging" and not (args.token and args.staging_chat_id):
+        parser.error("--target staging needs --token and at least one --staging-chat-id")
+    return args
+
+
+def main(argv=None):
+    from benchmark import format_report
+
+    args = parse_args(argv)
+    result = asyncio.run(run_replay(args))
+    print(format_report({"replay": result}))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""Remembers the translations sent for recent messages, so edits can update them.
+
+`translate_and_send_messages` records, per source message, the text it was
+built from and for every language the ids of the replies it sent and the
+translation of each segment (line or text between links, see prefilter.py).
+When the message is edited, `helpers.translate_edited_message` looks the
+record up, translates only the segments that aren't in it yet and edits the
+existing replies in place.
+
+Records are kept for the last `REPLY_MAP_SIZE` translated messages; edits to
+older messages are ignored, as are edits to messages that were never
+translated.
+"""
+from collections import OrderedDict
+
+import config
+
+REPLY_MAP_SIZE = getattr(config, 'REPLY_MAP_SIZE', 5000)
+
+
+class Translation:
+    """What was sent in one language: the reply text, the ids of the replies (one list of
+    message parts per recipient, see chunking.py) and the translation of each segment."""
+
+    __slots__ = ("text", "reply_ids", "segments")
+
+    def __init__(self, text, segments):
+        self.text = text
+        self.reply_ids = []
+        self.segments = segments
+
+
+class Record:
+    """The source message(s) of one translation; coalesced bursts have one part per message."""
+
+    __slots__ = ("parts", "languages")
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.languages = {}
+
+    @property
+    def text(self):
+        return "\n".join(self.parts.values())
+
+
+_records = OrderedDict()
+
+
+def remember(chat_id, record):
+    for message_id in record.parts:
+        _records[(str(chat_id), message_id)] = record
+        _records.move_to_end((str(chat_id), message_id))
+    while len(_records) > REPLY_MAP_SIZE:
+        _records.popitem(last=False)
+
+
+def lookup(chat_id, message_id):
+    record = _records.get((str(chat_id), message_id))
+    if record is not None:
+        _records.move_to_end((str(chat_id), message_id))
+    return record
+
+
+def forget_chat(chat_id):
+    for key in [key for key in _records if key[0] == str(chat_id)]:
+        del _records[key]
+
+
+def size():
+    return len(_records)
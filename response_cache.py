@@ -0,0 +1,137 @@
+"""Reuses the assistant's answers to openers it has already answered.
+
+Many 1:1 conversations start the same way ("hi", "mambo", "who are you?")
+and each used to cost a full OpenAI round trip. Conversations of at most
+`RESPONSE_CACHE_MAX_TURNS` short turns are looked up by a key made of the
+persona version (see persona.py) and a digest of the turns, normalized for
+case, punctuation and whitespace. So that a cached opener doesn't get the
+same reply every time, every key first collects `RESPONSE_CACHE_VARIETY`
+answers from OpenAI and then answers with a random one of them:
+
+    answer = await response_cache.get(history)
+    if answer is None:
+        answer = await get_openai_response(persona.prepend(history))
+        await response_cache.put(history, answer)
+
+Entries expire `RESPONSE_CACHE_TTL` seconds after their first answer, and the
+least recently used are dropped beyond `RESPONSE_CACHE_SIZE` keys. With
+`RESPONSE_CACHE_PERSIST` the pools are also written to storage, so that a
+restart or another bot process starts with them. A new persona version
+starts with an empty cache.
+"""
+import hashlib
+import json
+import random
+import re
+import time
+from collections import OrderedDict
+
+import clients
+import config
+import persona
+
+RESPONSE_CACHE_SIZE = getattr(config, 'RESPONSE_CACHE_SIZE', 1000)
+RESPONSE_CACHE_TTL = getattr(config, 'RESPONSE_CACHE_TTL', 7 * 86400)
+RESPONSE_CACHE_VARIETY = getattr(config, 'RESPONSE_CACHE_VARIETY', 3)
+# Only conversations this short, made of turns this short, are cached; 0 turns disables the cache
+RESPONSE_CACHE_MAX_TURNS = getattr(config, 'RESPONSE_CACHE_MAX_TURNS', 1)
+RESPONSE_CACHE_MAX_CHARS = getattr(config, 'RESPONSE_CACHE_MAX_CHARS', 80)
+RESPONSE_CACHE_PERSIST = getattr(config, 'RESPONSE_CACHE_PERSIST', False)
+
+store = clients.lazy("store")
+
+_NOT_WORD = re.compile(r"[^\w\s]+")
+_SPACE = re.compile(r"\s+")
+
+
+class Entry:
+    __slots__ = ("answers", "created")
+
+    def __init__(self, answers, created):
+        self.answers = answers
+        self.created = created
+
+
+_entries = OrderedDict()
+hits = 0
+misses = 0
+
+
+def normalize(text):
+    return _SPACE.sub(" ", _NOT_WORD.sub(" ", text.casefold())).strip()
+
+
+def key(history, version=None):
+    """The cache key of `history`, or None if it is too long to be cached."""
+    turns = [turn for turn in history if turn.get('role') != 'system']
+    if not turns or len(turns) > RESPONSE_CACHE_MAX_TURNS:
+        return None
+    normalized = [(turn['role'], normalize(turn['content'])) for turn in turns]
+    if any(not content or len(content) > RESPONSE_CACHE_MAX_CHARS for _, content in normalized):
+        return None
+    digest = hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode()).hexdigest()[:32]
+    return f"{version or persona.version}:{digest}"
+
+
+async def _entry(cache_key, now):
+    entry = _entries.get(cache_key)
+    if entry is None and RESPONSE_CACHE_PERSIST:
+        try:
+            data = await store.get_cached_response(cache_key)
+        except Exception as e:
+            print(f"[ERROR] Failed to read cached response {cache_key}: {e}")
+            data = None
+        if data is not None:
+            entry = Entry(list(data['answers']), data['created'])
+            _entries[cache_key] = entry
+    if entry is not None and now - entry.created > RESPONSE_CACHE_TTL:
+        del _entries[cache_key]
+        entry = None
+    if entry is not None:
+        _entries.move_to_end(cache_key)
+    return entry
+
+
+async def get(history):
+    """A cached answer to `history`, or None if it has to be asked from OpenAI."""
+    global hits, misses
+    cache_key = key(history)
+    if cache_key is None:
+        return None
+    entry = await _entry(cache_key, time.time())
+    # Until the pool is full, misses collect more answers
+    if entry is None or len(entry.answers) < RESPONSE_CACHE_VARIETY:
+        misses += 1
+        return None
+    hits += 1
+    return random.choice(entry.answers)
+
+
+async def put(history, answer):
+    cache_key = key(history)
+    if cache_key is None or not answer:
+        return
+    now = time.time()
+    entry = await _entry(cache_key, now)
+    if entry is None:
+        entry = _entries[cache_key] = Entry([], now)
+    if len(entry.answers) >= RESPONSE_CACHE_VARIETY:
+        return
+    entry.answers.append(answer)
+    while len(_entries) > RESPONSE_CACHE_SIZE:
+        _entries.popitem(last=False)
+    if RESPONSE_CACHE_PERSIST:
+        try:
+            await store.save_cached_response(cache_key, {'answers': entry.answers, 'created': entry.created})
+        except Exception as e:
+            print(f"[ERROR] Failed to store cached response {cache_key}: {e}")
+
+
+def clear():
+    global hits, misses
+    _entries.clear()
+    hits = misses = 0
+
+
+def stats():
+    return {"entries": len(_entries), "hits": hits, "misses": misses}
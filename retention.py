@@ -0,0 +1,88 @@
+"""Keeps the stored message history bounded.
+
+`chats/{chat}/messages` gets a document for every user message and assistant
+reply. The retention policy removes messages older than
+`MESSAGE_RETENTION_DAYS` and, with `MESSAGE_RETENTION_PER_USER`, all but the
+newest messages of each user in a chat. `main.py` runs `compact()` every
+`RETENTION_INTERVAL` seconds when a policy is configured; it deletes in
+batches of `RETENTION_PAGE_SIZE` and reports how many documents it reclaimed.
+It can also be run by hand:
+
+    python retention.py --max-age-days 30 --keep-per-user 200
+
+With `MESSAGE_RETENTION_DAYS` set, new messages also carry an `expire_at`
+field, so a Firestore TTL policy on it can take over the age based part:
+
+    gcloud firestore fields ttls update expire_at --collection-group=messages --enable-ttl
+"""
+import argparse
+import asyncio
+import time
+
+import config
+import helpers
+from counters import DAY
+
+MESSAGE_RETENTION_PER_USER = getattr(config, 'MESSAGE_RETENTION_PER_USER', None)
+RETENTION_INTERVAL = getattr(config, 'RETENTION_INTERVAL', DAY)
+RETENTION_PAGE_SIZE = getattr(config, 'RETENTION_PAGE_SIZE', 300)
+
+
+async def compact_chat(chat_id, before=None, keep_per_user=None, page_size=RETENTION_PAGE_SIZE):
+    """Applies the policy to one chat; returns the number of messages deleted."""
+    deleted = 0
+    cursor = {}
+    while True:
+        # A short page doesn't mean the chat is done: backends may cap a page (Firestore at 500)
+        page = await helpers.store.compact_messages(chat_id, before=before, keep_per_user=keep_per_user,
+                                                    limit=page_size, cursor=cursor)
+        if not page:
+            return deleted
+        deleted += page
+        await asyncio.sleep(0)
+
+
+async def compact(max_age_days=None, keep_per_user=None, page_size=RETENTION_PAGE_SIZE):
+    """Applies the policy to every chat and reports what was reclaimed."""
+    start = time.perf_counter()
+    before = time.time() - max_age_days * DAY if max_age_days else None
+    chats = deleted = 0
+    # Chats are found by their messages; private chats usually have no chat record
+    for chat_id in await helpers.store.list_message_chat_ids():
+        try:
+            reclaimed = await compact_chat(chat_id, before, keep_per_user, page_size)
+        except Exception as e:
+            print(f"[ERROR] Retention failed for chat {chat_id}: {e}")
+            continue
+        chats += 1
+        deleted += reclaimed
+        if reclaimed:
+            print(f"[INFO] Retention: deleted {reclaimed} messages in chat {chat_id}.")
+    seconds = time.perf_counter() - start
+    print(f"[INFO] Retention: reclaimed {deleted} messages in {chats} chats in {seconds:.2f}s.")
+    return {"chats": chats, "deleted": deleted, "seconds": seconds}
+
+
+def policy_configured():
+    return bool(helpers.MESSAGE_RETENTION_DAYS or MESSAGE_RETENTION_PER_USER)
+
+
+async def run_periodically(interval=RETENTION_INTERVAL):
+    while True:
+        await compact(helpers.MESSAGE_RETENTION_DAYS, MESSAGE_RETENTION_PER_USER)
+        await asyncio.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Delete messages outside the retention policy.")
+    parser.add_argument("--max-age-days", type=float, default=helpers.MESSAGE_RETENTION_DAYS)
+    parser.add_argument("--keep-per-user", type=int, default=MESSAGE_RETENTION_PER_USER)
+    parser.add_argument("--page-size", type=int, default=RETENTION_PAGE_SIZE)
+    args = parser.parse_args(argv)
+    if not args.max_age_days and not args.keep_per_user:
+        parser.error("no retention policy configured; pass --max-age-days and/or --keep-per-user")
+    asyncio.run(compact(args.max_age_days, args.keep_per_user, args.page_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""Runs the bot as a front dispatcher and several worker processes.
+
+One process is bound to one core and one event loop. With `WORKERS` above 1,
+`python main.py` instead starts a front process that only fetches updates and
+hands each of them to one of `WORKERS` worker processes. Each worker runs the
+bot's usual handlers (see `main.register_handlers`). An update goes to the
+worker that owns its chat on a consistent hash ring of `chat_id`, so
+everything kept in memory about a chat (members, bursts, reply records, see
+chat_state.py) lives in exactly one worker. Updates reach a worker in the
+order the front received them, and workers handle them one at a time, so a
+chat's messages are still handled in order.
+
+Adding a worker takes over about 1/N of the chats, and removing one spreads
+only its own chats over the others; every other chat stays where it was. A
+chat that moves rebuilds its state from storage on its next message. A
+removed worker still handles the updates it was sent before it exits, so for
+a moment a moved chat may have updates in two workers. The workers running
+are told about every change of the ring, so each of them knows its chats:
+
+    dispatcher = Dispatcher()
+    dispatcher.start(3)             # workers 0 to 2, all started with the full ring
+    dispatcher.add_worker()         # or `kill -USR1 <front pid>`
+    dispatcher.remove_worker(2)     # or `kill -USR2 <front pid>`, drops the newest worker
+    dispatcher.load()               # {0: {'routed': ..., 'backlog': ..., 'chats': ...}, ...}
+
+The front logs the load of every worker each `LOAD_REPORT_INTERVAL` seconds
+and restarts workers that died, on the inbox they left behind. Only worker 0 runs the periodic jobs that
+cover all chats (the active chat recount and message retention).
+"""
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import queue
+import signal
+import time
+
+import config
+
+WORKERS = getattr(config, 'WORKERS', 1)
+# Points per worker on the ring; more points spread chats more evenly
+RING_REPLICAS = getattr(config, 'RING_REPLICAS', 128)
+LOAD_REPORT_INTERVAL = getattr(config, 'LOAD_REPORT_INTERVAL', 60)
+
+# The Shard of this process when it is a worker, None when the bot runs in a single process
+current = None
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes=(), replicas=RING_REPLICAS):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self):
+        return sorted(set(self._owners.values()))
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = _hash(f"{node}#{replica}")
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+                self._owners[point] = node
+
+    def remove(self, node):
+        points = [point for point, owner in self._owners.items() if owner == node]
+        for point in points:
+            del self._owners[point]
+        self._points = [point for point in self._points if point in self._owners]
+
+    def node_for(self, key):
+        """The node owning `key`: the first point clockwise from the key's hash."""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+class Shard:
+    """A worker's view of the ring, used to pick the chats it loads and cleans up at start-up."""
+
+    def __init__(self, index, nodes, replicas=RING_REPLICAS):
+        self.index = index
+        self.ring = HashRing(nodes, replicas)
+
+    @property
+    def primary(self):
+        return self.index == 0
+
+    def set_nodes(self, nodes):
+        self.ring = HashRing(nodes, self.ring.replicas)
+
+    def owns(self, chat_id):
+        return self.ring.node_for(chat_id) == self.index
+
+    def release(self, states):
+        """Drops from `states` (a ChatStates) the chats another worker owns now; returns how many."""
+        moved = [state.chat_id for state in states.values() if not self.owns(state.chat_id)]
+        for chat_id in moved:
+            states.pop(chat_id)
+        return len(moved)
+
+
+def routing_key(update):
+    """The chat of an update; updates without one (e.g. inline queries) go by their user."""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
+
+
+class Worker:
+    """The front's handle on one worker process."""
+
+    def __init__(self, index, inbox, process=None):
+        self.index = index
+        self.inbox = inbox
+        self.process = process
+        self.routed = 0
+        self.report = {}
+
+    def send(self, data):
+        self.inbox.put(data)
+        self.routed += 1
+
+    def send_ring(self, nodes):
+        # Queued behind the updates routed with the old ring
+        self.inbox.put({"ring": list(nodes)})
+
+    def backlog(self):
+        try:
+            return self.inbox.qsize()
+        except NotImplementedError:
+            # macOS has no sem_getvalue()
+            return None
+
+    def alive(self):
+        return self.process is None or self.process.is_alive()
+
+    def close(self):
+        # Updates already in the inbox are handled before the worker exits
+        self.inbox.put(None)
+
+    def join(self, timeout=30):
+        if self.process is not None:
+            self.process.join(timeout)
+            if self.process.is_alive():
+                print(f"[ERROR] Worker {self.index} did not stop in {timeout}s, terminating it.")
+                self.process.terminate()
+
+
+class Dispatcher:
+    def __init__(self, spawn=None, replicas=RING_REPLICAS):
+        self._context = multiprocessing.get_context("spawn")
+        self._spawn = spawn or self._spawn_process
+        # Fakes given as `spawn` run in this process and get plain queues
+        self._queue = self._context.Queue if spawn is None else queue.Queue
+        self.ring = HashRing(replicas=replicas)
+        self.workers = {}
+        self.reports = self._queue()
+        self._retired = []
+        self._next_index = 0
+        self._last_routed = {}
+        self._last_report = time.monotonic()
+
+    def _spawn_process(self, index, nodes, inbox):
+        process = self._context.Process(target=run_worker, args=(index, nodes, inbox, self.reports),
+                                        name=f"worker-{index}", daemon=True)
+        process.start()
+        return Worker(index, inbox, process)
+
+    def start(self, count):
+        """Starts `count` workers; all of them are on the ring before the first one is spawned."""
+        indices = list(range(self._next_index, self._next_index + count))
+        self._next_index += count
+        for index in indices:
+            self.ring.add(index)
+        for index in indices:
+            self.workers[index] = self._spawn(index, self.ring.nodes, self._queue())
+        print(f"[INFO] Started {count} worker(s).")
+        return indices
+
+    def _send_ring(self):
+        for worker in self.workers.values():
+            worker.send_ring(self.ring.nodes)
+
+    def add_worker(self):
+        index = self._next_index
+        self._next_index += 1
+        self.ring.add(index)
+        self._send_ring()
+        self.workers[index] = self._spawn(index, self.ring.nodes, self._queue())
+        print(f"[INFO] Started worker {index}, {len(self.workers)} worker(s) running.")
+        return index
+
+    def remove_worker(self, index):
+        if index not in self.workers or len(self.workers) == 1:
+            return False
+        # Route the worker's chats elsewhere first, then let it finish what it was sent
+        self.ring.remove(index)
+        worker = self.workers.pop(index)
+        self._send_ring()
+        worker.close()
+        self._retired.append(worker)
+        print(f"[INFO] Stopping worker {index}, {len(self.workers)} worker(s) left.")
+        return True
+
+    async def route(self, update, context=None):
+        """TypeHandler callback of the front application."""
+        worker = self.workers[self.ring.node_for(routing_key(update))]
+        worker.send(update.to_dict())
+
+    def restart_dead_workers(self):
+        for index, worker in list(self.workers.items()):
+            if not worker.alive():
+                print(f"[ERROR] Worker {index} exited with code {worker.process.exitcode}, restarting it.")
+                # Same index, same place on the ring: no chat moves. The updates still in the
+                # inbox are handled by the new process.
+                self.workers[index] = self._spawn(index, self.ring.nodes, worker.inbox)
+
+    def _collect_reports(self):
+        while True:
+            try:
+                report = self.reports.get_nowait()
+            except queue.Empty:
+                return
+            worker = self.workers.get(report["index"])
+            if worker is not None:
+                worker.report = report
+
+    def load(self):
+        self._collect_reports()
+        now = time.monotonic()
+        elapsed = max(now - self._last_report, 1e-9)
+        load = {}
+        for index, worker in sorted(self.workers.items()):
+            load[index] = {"routed": worker.routed,
+                           "rate": (worker.routed - self._last_routed.get(index, 0)) / elapsed,
+                           "backlog": worker.backlog(),
+                           "pending": worker.report.get("pending"),
+                           "chats": worker.report.get("chats")}
+        self._last_routed = {index: worker.routed for index, worker in self.workers.items()}
+        self._last_report = now
+        return load
+
+    def report_load(self):
+        parts = [f"#{index} {stats['rate']:.1f}/s, {stats['routed']} routed, backlog {stats['backlog']}, "
+                 f"{stats['chats']} chats" for index, stats in self.load().items()]
+        print(f"[INFO] Worker load: {' | '.join(parts)}")
+
+    async def monitor(self, interval=LOAD_REPORT_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            self.restart_dead_workers()
+            self.report_load()
+
+    async def stop(self):
+        workers = list(self.workers.values())
+        for worker in workers:
+            worker.close()
+        await asyncio.gather(*(asyncio.to_thread(worker.join) for worker in workers + self._retired))
+        self.workers.clear()
+        self._retired.clear()
+
+
+def run_worker(index, nodes, inbox, reports):
+    """Entry point of a worker process."""
+    asyncio.run(_serve(index, nodes, inbox, reports))
+
+
+async def _serve(index, nodes, inbox, reports, interval=LOAD_REPORT_INTERVAL):
+    global current
+    current = Shard(index, nodes)
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder
+
+    import helpers
+    import main
+
+    # The front fetches the updates, workers only answer them
+    application = ApplicationBuilder().token(config.TELEGRAM_TOKEN).updater(None).build()
+    main.register_handlers(application)
+    async with application:
+        await main.post_init(application)
+        await application.start()
+        loop = asyncio.get_running_loop()
+        reported = loop.time()
+        try:
+            while True:
+                try:
+                    data = await asyncio.to_thread(inbox.get, timeout=1)
+                except queue.Empty:
+                    data = False
+                if data is None:
+                    break
+                if data and "ring" in data:
+                    current.set_nodes(data["ring"])
+                    # Chats moved away get their state on the new worker; here it would only go stale
+                    current.release(helpers.chat_states)
+                elif data:
+                    await application.update_queue.put(Update.de_json(data, application.bot))
+                if loop.time() - reported >= interval:
+                    reported = loop.time()
+                    reports.put({"index": index, "pending": application.update_queue.qsize(),
+                                 "chats": len(helpers.chat_states)})
+        finally:
+            # Handles the updates already taken in before stopping
+            await application.stop()
+            await main.post_stop(application)
+            await main.post_shutdown(application)
+
+
+def run(workers=WORKERS):
+    """Starts the front application and `workers` worker processes; blocks until the bot is stopped."""
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder, TypeHandler
+
+    import main
+
+    dispatcher = Dispatcher()
+
+    async def post_init(application):
+        dispatcher.start(workers)
+        application.create_task(dispatcher.monitor())
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, dispatcher.add_worker)
+        loop.add_signal_handler(signal.SIGUSR2, lambda: dispatcher.remove_worker(max(dispatcher.workers)))
+
+    async def post_shutdown(application):
+        await dispatcher.stop()
+
+    front = ApplicationBuilder().token(config.TELEGRAM_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
+    # Every update passes through the front, so it alone records them (RECORD_UPDATES_PATH)
+    main.add_update_recorder(front)
+    front.add_handler(TypeHandler(Update, dispatcher.route))
+    front.run_polling()
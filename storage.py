@@ -0,0 +1,805 @@
+"""Storage backends for chats, members, messages and counters.
+
+`helpers.store` is the single process-wide `Storage`; handlers and commands go
+through it instead of building Firestore document paths themselves. Besides the
+Firestore backend there is an in-memory one for tests and benchmarks and a
+SQLite one for small single-process deployments. `STORAGE_BACKEND` in
+`config.py` picks the backend ("firestore", "memory" or "sqlite"), and
+`SQLITE_PATH` the database file of the SQLite backend.
+
+Every method is a coroutine and takes chat and user ids as ints or strings.
+Members and chats are plain dicts such as `{'preferred_language': 'fr'}`;
+messages are dicts with `user_id`, `message_text` and `role`.
+
+Assistant history can also be kept per user as a conversation: a single record
+holding a capped list of `{'role', 'content'}` turns, so loading a history is
+one read instead of a query over every message of the chat.
+"""
+import asyncio
+import json
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+
+class Storage:
+    """Interface shared by all backends."""
+
+    # --- chats ---
+
+    async def get_chat(self, chat_id):
+        raise NotImplementedError
+
+    async def save_chat(self, chat_id, data):
+        """Creates the chat or merges `data` into it."""
+        raise NotImplementedError
+
+    async def delete_chat(self, chat_id):
+        """Deletes the chat record only; see `delete_chat_data` for what is stored under it."""
+        raise NotImplementedError
+
+    async def list_chat_ids(self):
+        raise NotImplementedError
+
+    async def list_message_chat_ids(self):
+        """Every chat with stored messages, including private chats that never got a chat record."""
+        raise NotImplementedError
+
+    async def delete_chat_data(self, chat_id, limit):
+        """Deletes up to `limit` members, messages and conversations of the chat; returns how many."""
+        raise NotImplementedError
+
+    # --- cleanup jobs (see cleanup.py) ---
+
+    async def get_cleanup_job(self, chat_id):
+        raise NotImplementedError
+
+    async def save_cleanup_job(self, chat_id, data):
+        raise NotImplementedError
+
+    async def delete_cleanup_job(self, chat_id):
+        raise NotImplementedError
+
+    async def list_cleanup_jobs(self):
+        raise NotImplementedError
+
+    # --- response cache (see response_cache.py) ---
+
+    async def get_cached_response(self, key):
+        raise NotImplementedError
+
+    async def save_cached_response(self, key, data):
+        raise NotImplementedError
+
+    # --- processed updates (see dedup.py) ---
+
+    async def claim_update(self, key, expire_at):
+        """Records `key` as processed until `expire_at` (epoch seconds) unless it already is, atomically;
+        returns whether this call recorded it."""
+        raise NotImplementedError
+
+    # --- members ---
+
+    async def get_member(self, chat_id, user_id):
+        raise NotImplementedError
+
+    async def set_member(self, chat_id, user_id, data):
+        raise NotImplementedError
+
+    async def delete_member(self, chat_id, user_id):
+        raise NotImplementedError
+
+    async def list_members(self, chat_id):
+        """Returns `(user_id, data)` pairs for every member of the chat."""
+        raise NotImplementedError
+
+    # --- users (settings that follow a user into every chat) ---
+
+    async def get_user(self, user_id):
+        raise NotImplementedError
+
+    async def set_user(self, user_id, data):
+        """Creates the user's profile or merges `data` into it."""
+        raise NotImplementedError
+
+    async def load_users(self, user_ids):
+        """Returns `{user_id: data}` for those of the users that have a profile."""
+        raise NotImplementedError
+
+    async def load_members(self, chat_ids, concurrency=8, progress=None):
+        """Bulk read for cache warm-up: `{chat_id: {user_id: data}}` for every chat in `chat_ids`.
+
+        `progress(done, total)` is called as chats complete. Backends read in as
+        few round trips as they can; this fallback reads chat by chat.
+        """
+        result = {}
+        for done, chat_id in enumerate(chat_ids, 1):
+            result[str(chat_id)] = dict(await self.list_members(chat_id))
+            if progress:
+                progress(done, len(chat_ids))
+        return result
+
+    # --- messages ---
+
+    async def add_message(self, chat_id, message):
+        raise NotImplementedError
+
+    async def get_messages(self, chat_id, user_id):
+        """Returns the messages stored for a user in a chat, oldest first."""
+        raise NotImplementedError
+
+    async def get_chat_messages(self, chat_id):
+        """Returns the messages of all users in a chat, oldest first."""
+        raise NotImplementedError
+
+    async def compact_messages(self, chat_id, before=None, keep_per_user=None, limit=500, cursor=None):
+        """Deletes up to `limit` of the chat's messages that are older than `before` (epoch seconds)
+        or not among the newest `keep_per_user` of their user; returns how many. Called page by page
+        until it returns 0; `cursor`, a dict passed unchanged to every page of a chat, lets a backend
+        carry on from where the previous page stopped."""
+        raise NotImplementedError
+
+    # --- conversations ---
+
+    async def get_conversation(self, chat_id, user_id):
+        """Returns the user's recent turns, oldest first."""
+        raise NotImplementedError
+
+    async def set_conversation(self, chat_id, user_id, turns):
+        raise NotImplementedError
+
+    async def append_conversation(self, chat_id, user_id, turns, max_turns):
+        """Appends `turns` and keeps only the newest `max_turns` (see `cap_turns`)."""
+        raise NotImplementedError
+
+    # --- counters ---
+
+    async def get_counter(self, name):
+        raise NotImplementedError
+
+    async def add_to_counter(self, name, delta=1, shards=1):
+        """Adds `delta` without reading the counter first, spread over `shards` write targets.
+
+        This never contends with concurrent writers; `get_counter` returns the sum.
+        """
+        raise NotImplementedError
+
+
+class FirestoreStorage(Storage):
+    """Keeps the existing layout: `chats/{chat}/members/{user}`, `chats/{chat}/messages/{auto id}`
+    and one `{name}/count` document per counter, plus its `{name}/count/shards/{i}` documents.
+    Pending cleanups live in `cleanup_jobs/{chat}`, user profiles in `users/{user}`, cached
+    assistant answers in `response_cache/{key}` and update de-duplication claims in
+    `processed_updates/{key}`.
+
+    The SDK is imported where it is used so that the other backends never load it. Its calls block,
+    so every one of them runs in a thread through `asyncio.to_thread`.
+    """
+
+    def __init__(self, client):
+        self.db = client
+
+    def _chat(self, chat_id):
+        return self.db.collection(u'chats').document(str(chat_id))
+
+    def _member(self, chat_id, user_id):
+        return self._chat(chat_id).collection(u'members').document(str(user_id))
+
+    @staticmethod
+    async def _read(doc_ref):
+        doc = await asyncio.to_thread(doc_ref.get)
+        return doc.to_dict() if doc.exists else None
+
+    @staticmethod
+    async def _ids(query):
+        return await asyncio.to_thread(lambda: [doc.id for doc in query.stream()])
+
+    async def get_chat(self, chat_id):
+        return await self._read(self._chat(chat_id))
+
+    async def save_chat(self, chat_id, data):
+        await asyncio.to_thread(self._chat(chat_id).set, data, merge=True)
+
+    async def delete_chat(self, chat_id):
+        await asyncio.to_thread(self._chat(chat_id).delete)
+
+    async def list_chat_ids(self):
+        # An empty projection returns document names only
+        return await self._ids(self.db.collection(u'chats').select([]))
+
+    async def list_message_chat_ids(self):
+        # Unlike a query, list_documents() also returns the missing parents of subcollections
+        refs = await asyncio.to_thread(self.db.collection(u'chats').list_documents)
+        return [ref.id for ref in refs]
+
+    CHAT_SUBCOLLECTIONS = (u'members', u'messages', u'conversations')
+
+    async def delete_chat_data(self, chat_id, limit):
+        return await asyncio.to_thread(self._delete_chat_data, chat_id, min(limit, 500))
+
+    def _delete_chat_data(self, chat_id, limit):
+        # Deleting a document leaves its subcollections behind, so they are removed
+        # page by page; a write batch holds at most 500 operations.
+        batch = self.db.batch()
+        deleted = 0
+        for name in self.CHAT_SUBCOLLECTIONS:
+            if deleted == limit:
+                break
+            for doc in self._chat(chat_id).collection(name).select([]).limit(limit - deleted).stream():
+                batch.delete(doc.reference)
+                deleted += 1
+        if deleted:
+            batch.commit()
+        return deleted
+
+    def _cleanup_job(self, chat_id):
+        return self.db.collection(u'cleanup_jobs').document(str(chat_id))
+
+    async def get_cleanup_job(self, chat_id):
+        return await self._read(self._cleanup_job(chat_id))
+
+    async def save_cleanup_job(self, chat_id, data):
+        await asyncio.to_thread(self._cleanup_job(chat_id).set, data)
+
+    async def delete_cleanup_job(self, chat_id):
+        await asyncio.to_thread(self._cleanup_job(chat_id).delete)
+
+    async def list_cleanup_jobs(self):
+        return await self._ids(self.db.collection(u'cleanup_jobs').select([]))
+
+    def _cached_response(self, key):
+        return self.db.collection(u'response_cache').document(key)
+
+    async def get_cached_response(self, key):
+        return await self._read(self._cached_response(key))
+
+    async def save_cached_response(self, key, data):
+        await asyncio.to_thread(self._cached_response(key).set, data)
+
+    async def claim_update(self, key, expire_at):
+        return await asyncio.to_thread(self._claim_update, key, expire_at)
+
+    def _claim_update(self, key, expire_at):
+        from google.api_core.exceptions import AlreadyExists
+
+        doc_ref = self.db.collection(u'processed_updates').document(key)
+        # `expire_at` is a timestamp so that a Firestore TTL policy can delete old claims
+        expires = datetime.fromtimestamp(expire_at, timezone.utc)
+        try:
+            doc_ref.create({'expire_at': expires})
+            return True
+        except AlreadyExists:
+            doc = doc_ref.get()
+            current = doc.to_dict().get('expire_at') if doc.exists else None
+            if current is not None and current.timestamp() > time.time():
+                return False
+            # An expired claim the TTL policy hasn't deleted yet
+            doc_ref.set({'expire_at': expires})
+            return True
+
+    async def get_member(self, chat_id, user_id):
+        return await self._read(self._member(chat_id, user_id))
+
+    async def set_member(self, chat_id, user_id, data):
+        await asyncio.to_thread(self._member(chat_id, user_id).set, data)
+
+    async def delete_member(self, chat_id, user_id):
+        await asyncio.to_thread(self._member(chat_id, user_id).delete)
+
+    async def list_members(self, chat_id):
+        members = self._chat(chat_id).collection(u'members')
+        return await asyncio.to_thread(lambda: [(doc.id, doc.to_dict()) for doc in members.stream()])
+
+    def _user(self, user_id):
+        return self.db.collection(u'users').document(str(user_id))
+
+    async def get_user(self, user_id):
+        return await self._read(self._user(user_id))
+
+    async def set_user(self, user_id, data):
+        await asyncio.to_thread(self._user(user_id).set, data, merge=True)
+
+    async def load_users(self, user_ids):
+        if not user_ids:
+            return {}
+        return await asyncio.to_thread(self._load_users, [str(user_id) for user_id in user_ids])
+
+    def _load_users(self, user_ids):
+        # One batched read for all of them
+        return {doc.id: doc.to_dict() for doc in self.db.get_all([self._user(user_id) for user_id in user_ids])
+                if doc.exists}
+
+    async def load_members(self, chat_ids, concurrency=8, progress=None):
+        return await asyncio.to_thread(self._load_members, [str(chat_id) for chat_id in chat_ids], concurrency,
+                                       progress)
+
+    def _load_members(self, chat_ids, concurrency, progress):
+        from google.api_core.exceptions import GoogleAPIError
+
+        result = {chat_id: {} for chat_id in chat_ids}
+        try:
+            # One streamed collection group query instead of a query per chat
+            for doc in self.db.collection_group(u'members').stream():
+                chat_id = doc.reference.parent.parent.id
+                if chat_id in result:
+                    result[chat_id][doc.id] = doc.to_dict()
+            if progress:
+                progress(len(chat_ids), len(chat_ids))
+            return result
+        except GoogleAPIError as e:
+            print(f"[ERROR] Collection group query on members failed, reading chat by chat: {e}")
+
+        def read_chat(chat_id):
+            return chat_id, {doc.id: doc.to_dict() for doc in self._chat(chat_id).collection(u'members').stream()}
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            for done, (chat_id, members) in enumerate(pool.map(read_chat, chat_ids), 1):
+                result[chat_id] = members
+                if progress:
+                    progress(done, len(chat_ids))
+        return result
+
+    async def add_message(self, chat_id, message):
+        from google.cloud import firestore
+
+        message = dict(message, timestamp=firestore.SERVER_TIMESTAMP)
+        if 'expire_at' in message:
+            # A TTL policy on messages.expire_at only acts on timestamp values
+            message['expire_at'] = datetime.fromtimestamp(message['expire_at'], timezone.utc)
+        await asyncio.to_thread(self._chat(chat_id).collection(u'messages').add, message)
+
+    async def get_messages(self, chat_id, user_id):
+        from google.cloud import firestore
+
+        # Messages keep the user id as it was passed in, an int from Telegram or a string
+        ids = [str(user_id)] + ([int(user_id)] if str(user_id).lstrip('-').isdigit() else [])
+        messages = self._chat(chat_id).collection(u'messages') \
+            .where('user_id', 'in', ids) \
+            .order_by('timestamp', direction=firestore.Query.ASCENDING)
+        return await asyncio.to_thread(lambda: [msg.to_dict() for msg in messages.stream()])
+
+    async def get_chat_messages(self, chat_id):
+        from google.cloud import firestore
+
+        messages = self._chat(chat_id).collection(u'messages') \
+            .order_by('timestamp', direction=firestore.Query.ASCENDING)
+        return await asyncio.to_thread(lambda: [msg.to_dict() for msg in messages.stream()])
+
+    async def compact_messages(self, chat_id, before=None, keep_per_user=None, limit=500, cursor=None):
+        # A write batch takes at most 500 deletes
+        return await asyncio.to_thread(self._compact_messages, chat_id, before, keep_per_user, min(limit, 500),
+                                       {} if cursor is None else cursor)
+
+    def _compact_messages(self, chat_id, before, keep_per_user, limit, cursor):
+        from google.cloud import firestore
+
+        messages = self._chat(chat_id).collection(u'messages')
+        doomed = {}
+        if before is not None:
+            cutoff = datetime.fromtimestamp(before, timezone.utc)
+            for doc in messages.where('timestamp', '<', cutoff).select([]).limit(limit).stream():
+                doomed[doc.id] = doc.reference
+        if keep_per_user is not None and len(doomed) < limit:
+            # The per-user counts and the last message seen carry over to the next page, so that the chat
+            # is streamed once in all instead of once per page. The cursor needs the ordering field.
+            kept = cursor.setdefault('kept', Counter())
+            newest_first = messages.select(['user_id', 'timestamp']) \
+                .order_by('timestamp', direction=firestore.Query.DESCENDING)
+            if cursor.get('after') is not None:
+                newest_first = newest_first.start_after(cursor['after'])
+            for doc in newest_first.stream():
+                cursor['after'] = doc
+                kept[str(doc.get('user_id'))] += 1
+                if kept[str(doc.get('user_id'))] > keep_per_user:
+                    doomed[doc.id] = doc.reference
+                    if len(doomed) >= limit:
+                        break
+        if doomed:
+            batch = self.db.batch()
+            for ref in doomed.values():
+                batch.delete(ref)
+            batch.commit()
+        return len(doomed)
+
+    def _conversation(self, chat_id, user_id):
+        return self._chat(chat_id).collection(u'conversations').document(str(user_id))
+
+    async def get_conversation(self, chat_id, user_id):
+        data = await self._read(self._conversation(chat_id, user_id))
+        return data.get('turns', []) if data is not None else []
+
+    async def set_conversation(self, chat_id, user_id, turns):
+        from google.cloud import firestore
+
+        await asyncio.to_thread(self._conversation(chat_id, user_id).set,
+                                {'turns': turns, 'updated': firestore.SERVER_TIMESTAMP})
+
+    async def append_conversation(self, chat_id, user_id, turns, max_turns):
+        await asyncio.to_thread(self._append_conversation, chat_id, user_id, turns, max_turns)
+
+    def _append_conversation(self, chat_id, user_id, turns, max_turns):
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def _append(transaction, doc_ref):
+            doc = doc_ref.get(transaction=transaction)
+            current = doc.to_dict().get('turns', []) if doc.exists else []
+            transaction.set(doc_ref, {'turns': cap_turns(current + list(turns), max_turns),
+                                      'updated': firestore.SERVER_TIMESTAMP})
+
+        _append(self.db.transaction(), self._conversation(chat_id, user_id))
+
+    def _counter(self, name):
+        return self.db.collection(name).document(u'count')
+
+    async def get_counter(self, name):
+        return await asyncio.to_thread(self._get_counter, name)
+
+    def _get_counter(self, name):
+        doc = self._counter(name).get()
+        count = doc.to_dict().get("count", 0) if doc.exists else 0
+        return count + sum(shard.to_dict().get("count", 0)
+                           for shard in self._counter(name).collection(u'shards').stream())
+
+    async def add_to_counter(self, name, delta=1, shards=1):
+        from google.cloud import firestore
+
+        # A blind increment on a random shard: no transaction, and writers rarely touch the same document
+        shard = self._counter(name).collection(u'shards').document(str(random.randrange(shards)))
+        await asyncio.to_thread(shard.set, {"count": firestore.Increment(delta)}, merge=True)
+
+
+class InMemoryStorage(Storage):
+    """Deterministic, process-local storage for tests, benchmarks and throwaway runs."""
+
+    def __init__(self):
+        self.chats = {}
+        self.members = {}
+        self.messages = {}
+        self.conversations = {}
+        self.counters = {}
+        self.cleanup_jobs = {}
+        self.users = {}
+        self.cached_responses = {}
+        self.processed_updates = {}
+
+    async def get_chat(self, chat_id):
+        chat = self.chats.get(str(chat_id))
+        return dict(chat) if chat is not None else None
+
+    async def save_chat(self, chat_id, data):
+        self.chats.setdefault(str(chat_id), {}).update(data)
+
+    async def delete_chat(self, chat_id):
+        self.chats.pop(str(chat_id), None)
+
+    async def list_chat_ids(self):
+        return list(self.chats)
+
+    async def list_message_chat_ids(self):
+        return [chat_id for chat_id, messages in self.messages.items() if messages]
+
+    async def delete_chat_data(self, chat_id, limit):
+        chat_id = str(chat_id)
+        deleted = 0
+        for user_id in list(self.members.get(chat_id, {}))[:limit]:
+            del self.members[chat_id][user_id]
+            deleted += 1
+        messages = self.messages.get(chat_id, [])
+        removed = messages[:limit - deleted]
+        del messages[:len(removed)]
+        deleted += len(removed)
+        for key in [key for key in self.conversations if key[0] == chat_id][:limit - deleted]:
+            del self.conversations[key]
+            deleted += 1
+        return deleted
+
+    async def get_cleanup_job(self, chat_id):
+        job = self.cleanup_jobs.get(str(chat_id))
+        return dict(job) if job is not None else None
+
+    async def save_cleanup_job(self, chat_id, data):
+        self.cleanup_jobs[str(chat_id)] = dict(data)
+
+    async def delete_cleanup_job(self, chat_id):
+        self.cleanup_jobs.pop(str(chat_id), None)
+
+    async def list_cleanup_jobs(self):
+        return list(self.cleanup_jobs)
+
+    async def get_cached_response(self, key):
+        data = self.cached_responses.get(key)
+        return dict(data) if data is not None else None
+
+    async def save_cached_response(self, key, data):
+        self.cached_responses[key] = dict(data)
+
+    async def claim_update(self, key, expire_at):
+        if self.processed_updates.get(key, 0) > time.time():
+            return False
+        self.processed_updates[key] = expire_at
+        return True
+
+    async def get_member(self, chat_id, user_id):
+        member = self.members.get(str(chat_id), {}).get(str(user_id))
+        return dict(member) if member is not None else None
+
+    async def set_member(self, chat_id, user_id, data):
+        self.members.setdefault(str(chat_id), {})[str(user_id)] = dict(data)
+
+    async def delete_member(self, chat_id, user_id):
+        self.members.get(str(chat_id), {}).pop(str(user_id), None)
+
+    async def list_members(self, chat_id):
+        return [(user_id, dict(data)) for user_id, data in self.members.get(str(chat_id), {}).items()]
+
+    async def get_user(self, user_id):
+        user = self.users.get(str(user_id))
+        return dict(user) if user is not None else None
+
+    async def set_user(self, user_id, data):
+        self.users.setdefault(str(user_id), {}).update(data)
+
+    async def load_users(self, user_ids):
+        return {str(user_id): dict(self.users[str(user_id)]) for user_id in user_ids if str(user_id) in self.users}
+
+    async def load_members(self, chat_ids, concurrency=8, progress=None):
+        result = {str(chat_id): dict(await self.list_members(chat_id)) for chat_id in chat_ids}
+        if progress:
+            progress(len(result), len(result))
+        return result
+
+    async def add_message(self, chat_id, message):
+        self.messages.setdefault(str(chat_id), []).append(dict(message, timestamp=time.time()))
+
+    async def get_messages(self, chat_id, user_id):
+        return [dict(msg) for msg in self.messages.get(str(chat_id), []) if str(msg['user_id']) == str(user_id)]
+
+    async def get_chat_messages(self, chat_id):
+        return [dict(msg) for msg in self.messages.get(str(chat_id), [])]
+
+    async def compact_messages(self, chat_id, before=None, keep_per_user=None, limit=500, cursor=None):
+        messages = self.messages.get(str(chat_id), [])
+        kept = Counter()
+        doomed = set()
+        for index in range(len(messages) - 1, -1, -1):
+            msg = messages[index]
+            kept[str(msg['user_id'])] += 1
+            if (before is not None and msg['timestamp'] < before) or \
+                    (keep_per_user is not None and kept[str(msg['user_id'])] > keep_per_user):
+                doomed.add(index)
+                if len(doomed) == limit:
+                    break
+        messages[:] = [msg for index, msg in enumerate(messages) if index not in doomed]
+        return len(doomed)
+
+    async def get_conversation(self, chat_id, user_id):
+        return [dict(turn) for turn in self.conversations.get((str(chat_id), str(user_id)), [])]
+
+    async def set_conversation(self, chat_id, user_id, turns):
+        self.conversations[(str(chat_id), str(user_id))] = [dict(turn) for turn in turns]
+
+    async def append_conversation(self, chat_id, user_id, turns, max_turns):
+        key = (str(chat_id), str(user_id))
+        self.conversations[key] = cap_turns(self.conversations.get(key, []) + [dict(t) for t in turns], max_turns)
+
+    async def get_counter(self, name):
+        return self.counters.get(name, 0)
+
+    async def add_to_counter(self, name, delta=1, shards=1):
+        self.counters[name] = self.counters.get(name, 0) + delta
+
+
+class SqliteStorage(Storage):
+    """Single-file storage for small deployments that run one bot process."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chats (chat_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS members (
+            chat_id TEXT NOT NULL, user_id TEXT NOT NULL, data TEXT NOT NULL,
+            PRIMARY KEY (chat_id, user_id));
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT NOT NULL, user_id TEXT NOT NULL,
+            data TEXT NOT NULL, timestamp REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS messages_by_user ON messages (chat_id, user_id, timestamp);
+        CREATE TABLE IF NOT EXISTS conversations (
+            chat_id TEXT NOT NULL, user_id TEXT NOT NULL, turns TEXT NOT NULL,
+            PRIMARY KEY (chat_id, user_id));
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS cleanup_jobs (chat_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS processed_updates (key TEXT PRIMARY KEY, expire_at REAL NOT NULL);
+    """
+
+    def __init__(self, path=":memory:"):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    async def get_chat(self, chat_id):
+        rows = self._execute("SELECT data FROM chats WHERE chat_id = ?", (str(chat_id),))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def save_chat(self, chat_id, data):
+        with self._lock:
+            row = self.conn.execute("SELECT data FROM chats WHERE chat_id = ?", (str(chat_id),)).fetchone()
+            merged = dict(json.loads(row[0]) if row else {}, **data)
+            self.conn.execute("INSERT OR REPLACE INTO chats (chat_id, data) VALUES (?, ?)",
+                              (str(chat_id), json.dumps(merged)))
+
+    async def delete_chat(self, chat_id):
+        self._execute("DELETE FROM chats WHERE chat_id = ?", (str(chat_id),))
+
+    async def list_chat_ids(self):
+        return [row[0] for row in self._execute("SELECT chat_id FROM chats")]
+
+    async def list_message_chat_ids(self):
+        return [row[0] for row in self._execute("SELECT DISTINCT chat_id FROM messages")]
+
+    async def delete_chat_data(self, chat_id, limit):
+        deleted = 0
+        with self._lock:
+            for table in ("members", "messages", "conversations"):
+                if deleted == limit:
+                    break
+                deleted += self.conn.execute(
+                    f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE chat_id = ? LIMIT ?)",
+                    (str(chat_id), limit - deleted)).rowcount
+        return deleted
+
+    async def get_cleanup_job(self, chat_id):
+        rows = self._execute("SELECT data FROM cleanup_jobs WHERE chat_id = ?", (str(chat_id),))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def save_cleanup_job(self, chat_id, data):
+        self._execute("INSERT OR REPLACE INTO cleanup_jobs (chat_id, data) VALUES (?, ?)",
+                      (str(chat_id), json.dumps(data)))
+
+    async def delete_cleanup_job(self, chat_id):
+        self._execute("DELETE FROM cleanup_jobs WHERE chat_id = ?", (str(chat_id),))
+
+    async def list_cleanup_jobs(self):
+        return [row[0] for row in self._execute("SELECT chat_id FROM cleanup_jobs")]
+
+    async def get_cached_response(self, key):
+        rows = self._execute("SELECT data FROM response_cache WHERE key = ?", (key,))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def save_cached_response(self, key, data):
+        self._execute("INSERT OR REPLACE INTO response_cache (key, data) VALUES (?, ?)", (key, json.dumps(data)))
+
+    async def claim_update(self, key, expire_at):
+        # Replaces only an expired claim; rowcount is 0 when a live one is in the way
+        with self._lock:
+            return self.conn.execute(
+                "INSERT INTO processed_updates (key, expire_at) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET expire_at = excluded.expire_at WHERE expire_at <= ?",
+                (key, expire_at, time.time())).rowcount == 1
+
+    async def get_member(self, chat_id, user_id):
+        rows = self._execute("SELECT data FROM members WHERE chat_id = ? AND user_id = ?",
+                             (str(chat_id), str(user_id)))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def set_member(self, chat_id, user_id, data):
+        self._execute("INSERT OR REPLACE INTO members (chat_id, user_id, data) VALUES (?, ?, ?)",
+                      (str(chat_id), str(user_id), json.dumps(data)))
+
+    async def delete_member(self, chat_id, user_id):
+        self._execute("DELETE FROM members WHERE chat_id = ? AND user_id = ?", (str(chat_id), str(user_id)))
+
+    async def list_members(self, chat_id):
+        rows = self._execute("SELECT user_id, data FROM members WHERE chat_id = ?", (str(chat_id),))
+        return [(user_id, json.loads(data)) for user_id, data in rows]
+
+    async def get_user(self, user_id):
+        rows = self._execute("SELECT data FROM users WHERE user_id = ?", (str(user_id),))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def set_user(self, user_id, data):
+        with self._lock:
+            row = self.conn.execute("SELECT data FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+            merged = dict(json.loads(row[0]) if row else {}, **data)
+            self.conn.execute("INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)",
+                              (str(user_id), json.dumps(merged)))
+
+    async def load_users(self, user_ids):
+        user_ids = [str(user_id) for user_id in user_ids]
+        result = {}
+        # Stay well below SQLite's limit on the number of query parameters
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            rows = self._execute(f"SELECT user_id, data FROM users WHERE user_id IN ({', '.join('?' * len(chunk))})",
+                                 chunk)
+            result.update((user_id, json.loads(data)) for user_id, data in rows)
+        return result
+
+    async def load_members(self, chat_ids, concurrency=8, progress=None):
+        result = {str(chat_id): {} for chat_id in chat_ids}
+        for chat_id, user_id, data in self._execute("SELECT chat_id, user_id, data FROM members"):
+            if chat_id in result:
+                result[chat_id][user_id] = json.loads(data)
+        if progress:
+            progress(len(result), len(result))
+        return result
+
+    async def add_message(self, chat_id, message):
+        self._execute("INSERT INTO messages (chat_id, user_id, data, timestamp) VALUES (?, ?, ?, ?)",
+                      (str(chat_id), str(message['user_id']), json.dumps(message), time.time()))
+
+    async def get_messages(self, chat_id, user_id):
+        rows = self._execute("SELECT data, timestamp FROM messages WHERE chat_id = ? AND user_id = ? "
+                             "ORDER BY timestamp, id", (str(chat_id), str(user_id)))
+        return [dict(json.loads(data), timestamp=timestamp) for data, timestamp in rows]
+
+    async def get_chat_messages(self, chat_id):
+        rows = self._execute("SELECT data, timestamp FROM messages WHERE chat_id = ? ORDER BY timestamp, id",
+                             (str(chat_id),))
+        return [dict(json.loads(data), timestamp=timestamp) for data, timestamp in rows]
+
+    async def compact_messages(self, chat_id, before=None, keep_per_user=None, limit=500, cursor=None):
+        with self._lock:
+            return self.conn.execute(
+                "DELETE FROM messages WHERE id IN (SELECT id FROM ("
+                "  SELECT id, timestamp, ROW_NUMBER() OVER ("
+                "    PARTITION BY user_id ORDER BY timestamp DESC, id DESC) AS newest"
+                "  FROM messages WHERE chat_id = ?)"
+                " WHERE (? IS NOT NULL AND timestamp < ?) OR (? IS NOT NULL AND newest > ?) LIMIT ?)",
+                (str(chat_id), before, before, keep_per_user, keep_per_user, limit)).rowcount
+
+    async def get_conversation(self, chat_id, user_id):
+        rows = self._execute("SELECT turns FROM conversations WHERE chat_id = ? AND user_id = ?",
+                             (str(chat_id), str(user_id)))
+        return json.loads(rows[0][0]) if rows else []
+
+    async def set_conversation(self, chat_id, user_id, turns):
+        self._execute("INSERT OR REPLACE INTO conversations (chat_id, user_id, turns) VALUES (?, ?, ?)",
+                      (str(chat_id), str(user_id), json.dumps(list(turns))))
+
+    async def append_conversation(self, chat_id, user_id, turns, max_turns):
+        with self._lock:
+            row = self.conn.execute("SELECT turns FROM conversations WHERE chat_id = ? AND user_id = ?",
+                                    (str(chat_id), str(user_id))).fetchone()
+            current = json.loads(row[0]) if row else []
+            self.conn.execute("INSERT OR REPLACE INTO conversations (chat_id, user_id, turns) VALUES (?, ?, ?)",
+                              (str(chat_id), str(user_id), json.dumps(cap_turns(current + list(turns), max_turns))))
+
+    async def get_counter(self, name):
+        rows = self._execute("SELECT value FROM counters WHERE name = ?", (name,))
+        return rows[0][0] if rows else 0
+
+    async def add_to_counter(self, name, delta=1, shards=1):
+        self._execute("INSERT INTO counters (name, value) VALUES (?, ?) "
+                      "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value", (name, delta))
+
+
+def cap_turns(turns, max_turns):
+    """Keeps the newest `max_turns` turns; leading system turns (the persona) are always kept."""
+    pinned = 0
+    while pinned < len(turns) and turns[pinned].get('role') == 'system':
+        pinned += 1
+    recent = turns[pinned:]
+    keep = max(max_turns - pinned, 0)
+    return turns[:pinned] + (recent[-keep:] if keep else [])
+
+
+def create_storage(backend="firestore", project=None, sqlite_path="mister_said.db"):
+    """Builds the storage backend named in `config.STORAGE_BACKEND`."""
+    if backend == "firestore":
+        from google.cloud import firestore
+
+        return FirestoreStorage(firestore.Client(project))
+    if backend == "memory":
+        return InMemoryStorage()
+    if backend == "sqlite":
+        return SqliteStorage(sqlite_path)
+    raise ValueError(f"Unknown storage backend: {backend}")
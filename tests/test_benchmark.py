@@ -0,0 +1,60 @@
+import pytest
+
+import benchmark
+from benchmark import compare, percentile, summarize
+
+
+def test_percentile():
+    values = [0.001 * i for i in range(1, 101)]
+    assert percentile(values, 50) == pytest.approx(0.05)
+    assert percentile(values, 99) == pytest.approx(0.099)
+    assert percentile([], 99) == 0.0
+
+
+def test_summarize_reports_throughput_and_calls_per_update():
+    result = summarize(10, 0, 2.0, [0.1] * 10, {"translate.translate": 30})
+    assert result["throughput"] == 5.0
+    assert result["p50_ms"] == 100.0
+    assert result["calls_per_update"] == 3.0
+
+
+def test_compare_flags_regressions():
+    baseline = {"translate": summarize(100, 0, 1.0, [0.01] * 100, {"translate.translate": 300})}
+    slower = {"translate": summarize(100, 0, 2.0, [0.01] * 100, {"translate.translate": 400})}
+    regressions = compare(slower, baseline, tolerance=0.2)
+    assert any("throughput" in r for r in regressions)
+    assert any("calls/update" in r for r in regressions)
+    assert compare(baseline, baseline, tolerance=0.2) == []
+
+
+def test_compare_flags_event_loop_blocking():
+    loop = {"lag": {"p99_ms": 5.0, "max_ms": 8.0, "buckets": {}}, "blocked": 0, "blocked_by_handler": {}}
+    blocking = {"lag": {"p99_ms": 250.0, "max_ms": 300.0, "buckets": {}}, "blocked": 4,
+                "blocked_by_handler": {"set_lang": 4}}
+    baseline = {"setlang": summarize(100, 0, 1.0, [0.01] * 100, {}, loop=loop)}
+    regressions = compare({"setlang": summarize(100, 0, 1.0, [0.01] * 100, {}, loop=blocking)}, baseline,
+                          tolerance=0.2)
+
+    assert any("blocked 4 times" in r for r in regressions)
+    assert any("loop lag p99" in r for r in regressions)
+    # reports written before the watchdog existed have nothing to compare against
+    assert compare(baseline, {"setlang": summarize(100, 0, 1.0, [0.01] * 100, {})}, tolerance=0.2) == []
+
+
+@pytest.mark.asyncio
+async def test_run_benchmark_counts_external_calls():
+    args = benchmark.parse_args(["--chats", "2", "--members", "3", "--languages", "3", "--messages", "10"])
+    results = await benchmark.run_benchmark(args)
+
+    assert set(results) == set(benchmark.SCENARIOS)
+    for result in results.values():
+        assert result["updates"] == 10
+        assert result["errors"] == 0
+
+    calls = results["translate"]["calls"]
+    # every chat has one member each in en, fr and es; reactions such as emoji skip translation and
+    # English is dropped as a target whenever the offline detector recognises the English messages
+    assert 10 <= calls["translate.translate"] <= 30
+    # the sender gets nothing and English comes back untranslated from the fake
+    assert 5 <= calls["telegram.send_message"] <= 20
+    assert results["voice"]["calls"]["openai.transcribe"] == 10
@@ -0,0 +1,98 @@
+import pytest
+
+from chat_state import ChatState, ChatStates
+from counters import DAY
+
+
+def test_chat_state_has_no_instance_dict():
+    state = ChatState("chat1")
+    assert not hasattr(state, "__dict__")
+    with pytest.raises(AttributeError):
+        state.title = "Group"
+
+
+def test_count_message_restarts_every_day():
+    state = ChatState("chat1")
+    assert state.count_message(10) == 1
+    assert state.count_message(20) == 2
+    assert state.messages_today(30) == 2
+    assert state.messages_today(DAY + 30) == 0
+    assert state.count_message(DAY + 30) == 1
+
+
+def test_idle_chats_are_evicted_over_budget():
+    now = [0.0]
+    states = ChatStates(budget=10 ** 9, clock=lambda: now[0])
+    for chat_id in ["chat1", "chat2", "chat3"]:
+        now[0] += 1
+        state = states.get(chat_id)
+        state.members = {f"user{i}": {"preferred_language": "en"} for i in range(20)}
+        states.resize(state)
+    states.get("chat1")  # chat2 is now the one idle longest
+
+    states.budget = states.stats()["bytes"] - 1
+    state = states.get("chat4")
+    states.resize(state)
+
+    assert "chat2" not in states
+    assert "chat1" in states and "chat4" in states
+    assert states.stats()["bytes"] <= states.budget
+    assert states.stats()["evictions"] >= 1
+
+
+def test_todays_message_count_survives_eviction():
+    now = [DAY * 10 + 5]
+    states = ChatStates(budget=1, clock=lambda: now[0])
+    for _ in range(3):
+        states.get("chat1").count_message(now[0])
+    states.resize(states.get("chat2"))  # evicts chat1
+    assert "chat1" not in states
+
+    assert states.get("chat1").count_message(now[0]) == 4
+
+    states.get("chat3").count_message(now[0])  # evicts chat1 again
+    assert states.stats()["evicted_message_counts"] == 1
+    now[0] += DAY
+    states.get("chat4")  # evicts chat3; a new day drops yesterday's counts
+    assert states.stats()["evicted_message_counts"] == 0
+    assert states.get("chat1").messages_today(now[0]) == 0
+
+
+def test_the_record_being_resized_is_never_evicted():
+    states = ChatStates(budget=1)
+    state = states.get("chat1")
+    state.members = {"user1": {"preferred_language": "en"}}
+    states.resize(state)
+    assert states.peek("chat1") is state
+
+    other = states.get("chat2")
+    states.resize(other)
+    assert "chat1" not in states
+    assert states.peek("chat2") is other
+
+
+def test_a_state_evicted_while_loading_is_not_accounted():
+    states = ChatStates(budget=10 ** 9)
+    state = states.get("chat1")
+    other = states.get("chat2")
+    # chat1 is evicted while its members are being read from storage
+    states.pop("chat1")
+    state.members = {f"user{i}": {"preferred_language": "en"} for i in range(20)}
+    states.resize(state)
+
+    assert "chat1" not in states
+    assert states.stats()["bytes"] == other.size
+
+
+def test_stats_and_pop():
+    states = ChatStates()
+    states.get("chat1")
+    states.get("chat1")
+    states.get(2)
+
+    stats = states.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (2, 1, 2)
+    assert 2 in states and "2" in states
+    assert states.pop("chat1").chat_id == "chat1"
+    assert states.stats()["bytes"] == states.peek("2").size
+    assert states.peek("chat1") is None
@@ -0,0 +1,42 @@
+import pytest
+
+import chunking
+
+
+def test_short_texts_are_left_alone():
+    assert chunking.split_message("Habari") == ["Habari"]
+    assert chunking.chunks("Habari. Yako?") == ["Habari. Yako?"]
+
+
+@pytest.mark.parametrize("limit", [10, 25, 60, 200])
+def test_parts_fit_and_add_up_to_the_text(limit):
+    text = ("First sentence here. Second one follows! A third?\n"
+            "A new line.\n\nA new paragraph with averyveryveryverylongwordthatneverends and more words. ") * 5
+
+    parts = chunking.split_message(text, limit=limit)
+
+    assert "".join(parts) == text
+    assert all(len(part) <= limit for part in parts)
+
+
+def test_split_message_prefers_larger_boundaries():
+    text = "One. Two.\n\nThree. Four."
+
+    assert chunking.split_message(text, limit=12) == ["One. Two.\n\n", "Three. Four."]
+    assert chunking.split_message("One. Two. Three.", limit=10) == ["One. Two. ", "Three."]
+
+
+def test_chunks_cut_at_sentence_ends():
+    text = "Karibu sana. Hakuna matata! Pole pole? Poa."
+
+    assert chunking.chunks(text, size=30) == ["Karibu sana. Hakuna matata! ", "Pole pole? Poa."]
+    assert chunking.strip_chunk("Karibu sana. ") == ("Karibu sana.", " ")
+
+
+def test_expanded_translations_are_sent_in_compliant_parts():
+    text = "Jambo rafiki. " * 600
+
+    parts = chunking.split_message(text)
+
+    assert len(parts) == 3
+    assert all(len(part) <= chunking.TELEGRAM_MESSAGE_LIMIT and part.endswith(". ") for part in parts)
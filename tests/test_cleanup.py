@@ -0,0 +1,66 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+import cleanup
+from fakes import FakeFirestore
+from storage import FirestoreStorage, InMemoryStorage
+
+
+@pytest.fixture(params=["memory", "firestore"])
+def store(request):
+    store = InMemoryStorage() if request.param == "memory" else FirestoreStorage(FakeFirestore())
+    with patch("helpers.store", store), patch("cleanup._queue", None):
+        yield store
+
+
+async def seed_chat(store, chat_id, members=3, messages=4):
+    for user_id in range(members):
+        await store.set_member(chat_id, user_id, {"preferred_language": "en"})
+        await store.set_conversation(chat_id, user_id, [{"role": "user", "content": "hi"}])
+    for i in range(messages):
+        await store.add_message(chat_id, {"user_id": 0, "message_text": f"msg {i}", "role": "user"})
+
+
+@pytest.mark.asyncio
+async def test_clean_chat_deletes_everything_in_pages(store):
+    await seed_chat(store, -100)
+    await seed_chat(store, -200, members=1, messages=1)
+    await cleanup.schedule(-100)
+
+    assert await cleanup.clean_chat(-100, page_size=4, pause=0) == 10
+
+    assert await store.list_members(-100) == []
+    assert await store.get_chat_messages(-100) == []
+    assert await store.get_conversation(-100, 0) == []
+    assert await store.get_cleanup_job(-100) is None
+    assert len(await store.list_members(-200)) == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_job_keeps_the_chat_data(store):
+    await seed_chat(store, -100)
+    await cleanup.schedule(-100)
+    await cleanup.cancel(-100)
+
+    assert await cleanup.clean_chat(-100, page_size=4, pause=0) is None
+    assert len(await store.list_members(-100)) == 3
+
+
+@pytest.mark.asyncio
+async def test_worker_resumes_persisted_jobs(store):
+    await seed_chat(store, -100)
+    # A job that was halfway done when the process stopped
+    await store.save_cleanup_job(-100, {"deleted": 5, "started": 0})
+
+    with patch("cleanup.CLEANUP_PAUSE", 0):
+        worker = asyncio.create_task(cleanup.run_worker())
+        for _ in range(200):
+            await asyncio.sleep(0.01)
+            if await store.get_cleanup_job(-100) is None:
+                break
+        worker.cancel()
+
+    assert await store.list_cleanup_jobs() == []
+    assert await store.list_members(-100) == []
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import clients
+
+
+@pytest.fixture
+def registry():
+    clients.register("dummy", MagicMock(side_effect=lambda: object()))
+    yield clients._factories["dummy"]
+    clients.reset("dummy")
+    del clients._factories["dummy"]
+
+
+def test_client_is_built_once_on_first_use(registry):
+    clients.lazy("dummy")
+    assert not clients.is_built("dummy")
+    registry.assert_not_called()
+
+    first = clients.get("dummy")
+    assert clients.get("dummy") is first
+    registry.assert_called_once()
+
+
+def test_lazy_proxy_forwards_attributes(registry):
+    client = MagicMock()
+    clients.install("dummy", client)
+
+    clients.lazy("dummy").translate("hi")
+
+    client.translate.assert_called_once_with("hi")
+    registry.assert_not_called()
+
+
+def test_patching_a_lazy_client_does_not_build_it(registry):
+    module = SimpleNamespace(client=clients.lazy("dummy"))
+    with patch.object(module, "client"):
+        pass
+    assert not hasattr(clients.lazy("dummy"), "__func__")
+    registry.assert_not_called()
+
+
+def test_install_and_reset(registry):
+    fake = object()
+    assert clients.install("dummy", fake) is None
+    assert clients.get("dummy") is fake
+    assert clients.install("dummy", None) is fake
+    assert not clients.is_built("dummy")
+
+    clients.get("dummy")
+    clients.reset("dummy")
+    assert not clients.is_built("dummy")
+    registry.assert_called_once()
+
+
+def test_warm_up_reports_timings_and_survives_failures(registry):
+    clients.register("broken", MagicMock(side_effect=RuntimeError("no credentials")))
+    try:
+        timings = clients.warm_up(["dummy", "broken"])
+    finally:
+        del clients._factories["broken"]
+
+    assert list(timings) == ["dummy"]
+    assert clients.is_built("dummy")
+
+
+def test_importing_the_bot_builds_no_clients():
+    import handlers
+    import commands
+
+    assert isinstance(handlers.helpers.store, clients.LazyClient)
+    assert isinstance(commands.helpers.translate_client, clients.LazyClient)
@@ -0,0 +1,141 @@
+import asyncio
+import json
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from telegram.ext import ApplicationBuilder
+from telegram.request import BaseRequest
+
+import coalesce
+
+
+@pytest.fixture(autouse=True)
+def translate():
+    coalesce._bursts.clear()
+    with patch("helpers.translate_and_send_messages", AsyncMock()) as translate:
+        yield translate
+    coalesce._bursts.clear()
+
+
+def make_update(message_id, chat_id="chat1", user_id="user1"):
+    update = MagicMock()
+    update.effective_chat.id = chat_id
+    update.effective_user.id = user_id
+    update.effective_message.message_id = message_id
+    return update
+
+
+@pytest.mark.asyncio
+async def test_a_burst_is_translated_once(translate):
+    context = MagicMock()
+    for message_id, text in enumerate(["hi", "are you there", "dinner at 8?"], start=1):
+        await coalesce.add(make_update(message_id), context, text, window=0.05)
+        await asyncio.sleep(0.01)
+    translate.assert_not_called()
+
+    await asyncio.sleep(0.1)
+
+    translate.assert_awaited_once()
+    update, passed_context, text = translate.call_args.args
+    assert update.effective_message.message_id == 1 and passed_context is context
+    assert text == "hi\nare you there\ndinner at 8?"
+    assert translate.call_args.kwargs == {"parts": {1: "hi", 2: "are you there", 3: "dinner at 8?"}}
+    assert coalesce.pending() == 0
+
+
+@pytest.mark.asyncio
+async def test_senders_and_chats_are_kept_apart(translate):
+    await coalesce.add(make_update(1), MagicMock(), "hi", window=0.02)
+    await coalesce.add(make_update(2, user_id="user2"), MagicMock(), "hello", window=0.02)
+    await coalesce.add(make_update(3, chat_id="chat2"), MagicMock(), "jambo", window=0.02)
+
+    await asyncio.sleep(0.06)
+
+    assert sorted(call.args[2] for call in translate.call_args_list) == ["hello", "hi", "jambo"]
+
+
+@pytest.mark.asyncio
+async def test_bursts_are_cut_off(translate):
+    for message_id in range(1, 4):
+        await coalesce.add(make_update(message_id), MagicMock(), f"line {message_id}", window=10, max_messages=3)
+    await asyncio.sleep(0)
+    assert list(translate.call_args.kwargs["parts"]) == [1, 2, 3]
+
+    await coalesce.add(make_update(4), MagicMock(), "line 4", window=0.05, max_delay=0.02)
+    await asyncio.sleep(0.01)
+    await coalesce.add(make_update(5), MagicMock(), "line 5", window=0.05, max_delay=0.02)
+    await asyncio.sleep(0.03)
+    assert list(translate.call_args.kwargs["parts"]) == [4, 5]
+
+
+@pytest.mark.asyncio
+async def test_flush_all(translate):
+    await coalesce.add(make_update(1), MagicMock(), "hi", window=10)
+
+    await coalesce.flush_all()
+
+    translate.assert_awaited_once()
+    assert coalesce.pending() == 0
+
+
+class FakeBotApi(BaseRequest):
+    """Answers the Bot API calls of a polling application; refuses them outside initialize/shutdown."""
+
+    def __init__(self):
+        self.initialized = False
+        self.sent = []
+
+    @property
+    def read_timeout(self):
+        return 1
+
+    async def initialize(self):
+        self.initialized = True
+
+    async def shutdown(self):
+        self.initialized = False
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        if not self.initialized:
+            raise RuntimeError("This request object is not initialized!")
+        endpoint = url.rsplit("/", 1)[-1]
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Said", "username": "said_bot"}
+        elif endpoint == "getUpdates":
+            await asyncio.sleep(0.01)
+            result = []
+        elif endpoint == "sendMessage":
+            self.sent.append(request_data.parameters)
+            result = {"message_id": len(self.sent), "date": 0, "chat": {"id": 5, "type": "private"},
+                      "text": request_data.parameters["text"]}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def test_pending_bursts_are_sent_when_the_application_stops(translate):
+    import main
+
+    api = FakeBotApi()
+
+    async def reply(update, context, text, parts=None):
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+
+    async def post_init(application):
+        await coalesce.add(make_update(1, chat_id=5), SimpleNamespace(bot=application.bot), "hi", window=60)
+        asyncio.get_running_loop().call_later(0.05, application.stop_running)
+
+    application = (ApplicationBuilder().token("1:token").request(api).get_updates_request(FakeBotApi())
+                   .post_init(post_init).post_stop(main.post_stop).post_shutdown(main.post_shutdown).build())
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        translate.side_effect = reply
+        application.run_polling(stop_signals=None, close_loop=False)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    assert [parameters["text"] for parameters in api.sent] == ["hi"]
+    assert coalesce.pending() == 0
@@ -0,0 +1,89 @@
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from telegram import Chat, Message, Update
+from telegram.ext import ApplicationHandlerStop
+
+import dedup
+from storage import InMemoryStorage
+
+CHAT = Chat(id=-100, type=Chat.GROUP)
+SENT = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def empty_seen():
+    dedup.clear()
+    yield
+    dedup.clear()
+
+
+def message_update(update_id, message_id=1, edit_date=None):
+    message = Message(message_id=message_id, date=SENT, chat=CHAT, text="hi", edit_date=edit_date)
+    if edit_date is not None:
+        return Update(update_id, edited_message=message)
+    return Update(update_id, message=message)
+
+
+def test_keys():
+    assert dedup.keys(message_update(10, message_id=5)) == ["update:10", "message:-100:5"]
+    edited = message_update(11, message_id=5, edit_date=datetime(2024, 1, 1, 0, 1, tzinfo=timezone.utc))
+    assert dedup.keys(edited) == ["update:11", f"edit:-100:5:{int(SENT.timestamp()) + 60}"]
+    assert dedup.keys(Update(12)) == ["update:12"]
+
+
+@pytest.mark.asyncio
+async def test_redelivered_updates_are_claimed_once():
+    assert await dedup.claim(message_update(10, message_id=5))
+    assert not await dedup.claim(message_update(10, message_id=5))
+    # The same message under a new update_id
+    assert not await dedup.claim(message_update(11, message_id=5))
+    assert await dedup.claim(message_update(12, message_id=6))
+
+
+@pytest.mark.asyncio
+async def test_every_edit_is_handled():
+    first = datetime(2024, 1, 1, 0, 1, tzinfo=timezone.utc)
+    second = datetime(2024, 1, 1, 0, 2, tzinfo=timezone.utc)
+    assert await dedup.claim(message_update(10, message_id=5))
+    assert await dedup.claim(message_update(11, message_id=5, edit_date=first))
+    assert await dedup.claim(message_update(12, message_id=5, edit_date=second))
+    assert not await dedup.claim(message_update(13, message_id=5, edit_date=second))
+
+
+@pytest.mark.asyncio
+async def test_seen_updates_are_bounded():
+    with patch("dedup.DEDUP_SIZE", 4):
+        for update_id in range(10):
+            await dedup.claim(message_update(update_id, message_id=update_id))
+        assert len(dedup._seen) == 4
+        # Forgotten, so handled again
+        assert await dedup.claim(message_update(0, message_id=0))
+
+
+@pytest.mark.asyncio
+async def test_shared_claims_outlive_the_process():
+    store = InMemoryStorage()
+    with patch("dedup.DEDUP_SHARED", True), patch("dedup.store", store):
+        assert await dedup.claim(message_update(10, message_id=5))
+        # A restart forgets what was seen in memory
+        dedup.clear()
+        assert not await dedup.claim(message_update(11, message_id=5))
+    assert list(store.processed_updates) == ["message:-100:5"]
+
+
+@pytest.mark.asyncio
+async def test_failed_shared_claim_handles_the_update():
+    store = MagicMock(claim_update=AsyncMock(side_effect=RuntimeError("unavailable")))
+    with patch("dedup.DEDUP_SHARED", True), patch("dedup.store", store):
+        assert await dedup.claim(message_update(10))
+
+
+@pytest.mark.asyncio
+async def test_skip_duplicates_stops_later_handlers():
+    update = message_update(10)
+    await dedup.skip_duplicates(update, MagicMock())
+    with pytest.raises(ApplicationHandlerStop):
+        await dedup.skip_duplicates(update, MagicMock())
+    assert dedup.skipped == 1
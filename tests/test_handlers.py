@@ -1,9 +1,13 @@
+from collections import OrderedDict
+
 import pytest
 from unittest.mock import MagicMock, patch, AsyncMock
-from telegram import Update, ChatMember
+from telegram import Update, Chat, ChatMember
 
 import handlers
 from handlers import greet_new_user, translate_message, remove_left_user, bot_removed_from_chat, bot_added_to_chat
+from chat_state import ChatStates
+from storage import InMemoryStorage
 
 # Create mock Update and Context objects
 UPDATE = MagicMock()
@@ -18,8 +22,18 @@ async def async_send_message(*args, **kwargs):
 
 CONTEXT.bot.send_message = AsyncMock(side_effect=async_send_message)
 CONTEXT.bot.send_chat_action = AsyncMock(side_effect=async_send_message)
+CONTEXT.bot.get_chat_member_count = AsyncMock(return_value=5)
 translate_and_send_messages_mock = AsyncMock(side_effect=async_send_message)
-handlers.translate_and_send_messages = translate_and_send_messages_mock
+
+
+@pytest.fixture(autouse=True)
+def mock_translate_and_send_messages():
+    # Patched per test so other test modules keep the real implementation
+    with patch("handlers.translate_and_send_messages", translate_and_send_messages_mock), \
+            patch("helpers.store", InMemoryStorage()), \
+            patch("helpers.chat_states", ChatStates()), patch("helpers.user_cache", {}), \
+            patch("response_cache._entries", OrderedDict()):
+        yield
 
 
 # Set mock values for the Update object
@@ -39,6 +53,33 @@ async def test_greet_new_user():
     CONTEXT.bot.send_message.assert_called()
 
 
+@pytest.mark.asyncio
+async def test_greet_new_user_only_admits_group_chats():
+    bot = MagicMock(is_bot=True, username=CONTEXT.bot.username)
+    update = MagicMock()
+    update.effective_chat.id = "777"
+    update.effective_chat.type = Chat.PRIVATE
+    update.effective_message.new_chat_members = [bot]
+    context = MagicMock()
+    context.bot.username = CONTEXT.bot.username
+    context.bot.send_chat_action = AsyncMock()
+    context.bot.send_message = AsyncMock()
+    context.bot.leave_chat = AsyncMock()
+    store = InMemoryStorage()
+    store.counters["active_chats"] = 5
+
+    with patch("helpers.store", store), patch("config.MAXIMUM_CHATS", 5):
+        await greet_new_user(update, context)
+        context.bot.leave_chat.assert_not_called()
+        assert await store.get_chat("777") is None
+
+        update.effective_chat.type = Chat.GROUP
+        await greet_new_user(update, context)
+
+    context.bot.leave_chat.assert_awaited_once_with(chat_id="777")
+    assert "already in 5 chats" in context.bot.send_message.await_args_list[-1].kwargs["text"]
+
+
 # Test for translate_message without bot mention
 @pytest.mark.asyncio
 async def test_translate_message_no_bot_mention():
@@ -76,21 +117,66 @@ async def test_translate_message_with_bot_mention_no_openai_response():
         mock_get_openai_response.assert_called()
         CONTEXT.bot.send_message.assert_not_called()
 
+@pytest.mark.asyncio
+async def test_private_chat_sends_persona_without_storing_it():
+    context = MagicMock()
+    context.bot.username = "TestBot"
+    context.bot.send_message = AsyncMock()
+    context.bot.send_chat_action = AsyncMock()
+    context.bot.get_chat_member_count = AsyncMock(return_value=2)
+    update = MagicMock()
+    update.effective_chat.id = "chat1"
+    update.effective_user.id = "user1"
+    update.effective_message.text = "Habari?"
+    store = InMemoryStorage()
+
+    with patch("helpers.store", store), \
+            patch("handlers.get_openai_response", AsyncMock(return_value="Mambo!")) as get_openai_response:
+        await translate_message(update, context)
+        await translate_message(update, context)
+
+    sent = get_openai_response.await_args.args[0]
+    assert sent[0] == {"role": "system", "content": handlers.persona.prompt}
+    assert [turn["role"] for turn in sent[1:]] == ["user", "assistant", "user"]
+    assert [msg["role"] for msg in await store.get_messages("chat1", "user1")] == ["user", "assistant", "user",
+                                                                                   "assistant"]
+
+
+@pytest.mark.asyncio
+async def test_private_chat_answers_common_openers_from_the_cache():
+    context = MagicMock()
+    context.bot.username = "TestBot"
+    context.bot.send_message = AsyncMock()
+    context.bot.send_chat_action = AsyncMock()
+    context.bot.get_chat_member_count = AsyncMock(return_value=2)
+    answers = iter(["Mambo!", "Poa!", "Karibu!"])
+
+    with patch("handlers.get_openai_response", AsyncMock(side_effect=lambda messages: next(answers))) as ask, \
+            patch("response_cache.RESPONSE_CACHE_VARIETY", 3):
+        for user_id in range(5):
+            update = MagicMock()
+            update.effective_chat.id = f"chat{user_id}"
+            update.effective_user.id = f"user{user_id}"
+            update.effective_message.text = "Mambo!" if user_id % 2 else "mambo"
+            await translate_message(update, context)
+
+    assert ask.await_count == 3
+    sent = [call.kwargs["text"] for call in context.bot.send_message.await_args_list]
+    assert sent[:3] == ["Mambo!", "Poa!", "Karibu!"] and set(sent[3:]) <= set(sent[:3])
+
+
 # Test for remove_left_user
 @pytest.mark.asyncio
 async def test_remove_left_user():
-    with patch("handlers.db") as mock_db:
-        # Ensure the delete method is an AsyncMock
-        mock_delete = AsyncMock()
-        mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value.delete = mock_delete
+    store = InMemoryStorage()
+    await store.set_member(UPDATE.effective_chat.id, UPDATE.effective_user.id, {"preferred_language": "en"})
+    await store.set_member(UPDATE.effective_chat.id, "456", {"preferred_language": "fr"})
 
+    with patch("helpers.store", store):
         await remove_left_user(UPDATE, CONTEXT)
 
-        mock_db.collection.assert_called_with("chats")
-        mock_db.collection().document.assert_called_with(str(UPDATE.effective_chat.id))
-        mock_db.collection().document().collection.assert_called_with("members")
-        mock_db.collection().document().collection().document.assert_called_with(str(UPDATE.effective_user.id))
-        mock_delete.assert_awaited_once()
+    assert await store.get_member(UPDATE.effective_chat.id, UPDATE.effective_user.id) is None
+    assert await store.get_member(UPDATE.effective_chat.id, "456") == {"preferred_language": "fr"}
 
 # Test for bot_removed_from_chat
 @pytest.mark.asyncio
@@ -99,12 +185,15 @@ async def test_bot_removed_from_chat():
     my_chat_member.old_chat_member.status = ChatMember.ADMINISTRATOR
     my_chat_member.new_chat_member.status = ChatMember.BANNED
     UPDATE.my_chat_member = my_chat_member
+    store = InMemoryStorage()
+    await store.save_chat(UPDATE.effective_chat.id, {"title": "Test Chat", "counted": True})
+    store.counters["active_chats"] = 3
 
-    with patch("handlers.db") as mock_db:
+    with patch("helpers.store", store):
         await bot_removed_from_chat(UPDATE, CONTEXT)
-        mock_db.collection.assert_called_with("chats")
-        mock_db.collection().document.assert_called_with(str(UPDATE.effective_chat.id))
-        mock_db.collection().document().delete.assert_called()
+
+    assert await store.get_chat(UPDATE.effective_chat.id) is None
+    assert await store.get_counter("active_chats") == 2
 
 # Test for bot_added_to_chat
 @pytest.mark.asyncio
@@ -113,9 +202,54 @@ async def test_bot_added_to_chat():
     my_chat_member.old_chat_member = None
     my_chat_member.new_chat_member.status = ChatMember.ADMINISTRATOR
     UPDATE.my_chat_member = my_chat_member
+    UPDATE.effective_chat.title = "Test Chat"
+    UPDATE.effective_chat.type = Chat.GROUP
+    store = InMemoryStorage()
+
+    with patch("helpers.store", store), patch("config.MAXIMUM_CHATS", 5):
+        await bot_added_to_chat(UPDATE, CONTEXT)
+
+    assert await store.get_chat(UPDATE.effective_chat.id) == {"title": "Test Chat", "counted": True}
+    assert await store.get_counter("active_chats") == 1
+
+
+@pytest.mark.asyncio
+async def test_bot_added_to_chat_over_the_limit_leaves():
+    my_chat_member = MagicMock()
+    my_chat_member.old_chat_member = None
+    my_chat_member.new_chat_member.status = ChatMember.ADMINISTRATOR
+    UPDATE.my_chat_member = my_chat_member
+    UPDATE.effective_chat.type = Chat.SUPERGROUP
+    store = InMemoryStorage()
+    store.counters["active_chats"] = 5
+    CONTEXT.bot.leave_chat = AsyncMock()
 
-    with patch("handlers.db") as mock_db:
+    with patch("helpers.store", store), patch("config.MAXIMUM_CHATS", 5):
         await bot_added_to_chat(UPDATE, CONTEXT)
-        mock_db.collection.assert_called_with("chats")
-        mock_db.collection().document.assert_called_with(str(UPDATE.effective_chat.id))
-        mock_db.collection().document().create.assert_called_with({"title": UPDATE.effective_chat.title})
+
+    CONTEXT.bot.leave_chat.assert_awaited_once_with(chat_id=UPDATE.effective_chat.id)
+    assert await store.get_chat(UPDATE.effective_chat.id) is None
+    assert await store.get_counter("active_chats") == 5
+
+
+@pytest.mark.asyncio
+async def test_unblocking_the_bot_in_a_private_chat_is_not_counted():
+    my_chat_member = MagicMock()
+    my_chat_member.old_chat_member.status = ChatMember.BANNED
+    my_chat_member.new_chat_member.status = ChatMember.MEMBER
+    update = MagicMock(my_chat_member=my_chat_member)
+    update.effective_chat.id = "555"
+    update.effective_chat.type = Chat.PRIVATE
+    context = MagicMock()
+    context.bot.send_message = AsyncMock()
+    context.bot.leave_chat = AsyncMock()
+    store = InMemoryStorage()
+    store.counters["active_chats"] = 5
+
+    with patch("helpers.store", store), patch("config.MAXIMUM_CHATS", 5):
+        await bot_added_to_chat(update, context)
+
+    context.bot.leave_chat.assert_not_called()
+    context.bot.send_message.assert_not_called()
+    assert await store.get_chat("555") is None
+    assert await store.get_counter("active_chats") == 5
@@ -1,17 +1,16 @@
-import asyncio # Required for new tests
+from collections import OrderedDict
 from unittest.mock import AsyncMock, MagicMock, patch, call
 
 import pytest
-from google.cloud import translate_v2, firestore
-from google.cloud.firestore import Client
-from google.cloud.firestore_v1.document import DocumentSnapshot
 
+import clients
 import config
 import helpers
-import openai
+import openai_helper
 from helpers import increment_message_count, get_user_lang, validate_language, increment_active_chats
 from helpers import translate_and_send_messages
-from google.api_core.exceptions import FailedPrecondition
+from chat_state import ChatStates
+from storage import InMemoryStorage
 
 # Replace with your actual chat_id and user_id
 CHAT_ID = "123456"
@@ -19,6 +18,23 @@ USER_ID = "123"
 
 config.MESSAGE_LIMIT = 2
 
+
+@pytest.fixture
+def mock_translate_client():
+    # Installed in the registry rather than patched on the lazy proxy, which never builds the real client
+    client = MagicMock()
+    previous = clients.install("translate", client)
+    yield client
+    clients.install("translate", previous)
+
+
+@pytest.fixture
+def store():
+    with patch("helpers.store", InMemoryStorage()) as store, patch("helpers.chat_states", ChatStates()), \
+            patch("helpers.user_cache", {}), patch("replies._records", OrderedDict()):
+        yield store
+
+
 @pytest.mark.asyncio
 async def test_increment_message_count_new_chat():
     chat_id = "new_chat"
@@ -40,195 +56,132 @@ async def test_increment_message_count_multi_chat():
     assert await increment_message_count(chat_id2) == 2
 
 
-def test_get_user_lang_existing_user():
+@pytest.mark.asyncio
+async def test_get_user_lang_existing_user(store):
     chat_id = "chat1"
     user_id = "user1"
     user_lang = "en"
 
-    client = MagicMock(spec=Client)
-    client.collection().document().collection().document().get().exists = True
-    client.collection().document().collection().document().get().to_dict.return_value = {"preferred_language": user_lang}
-    helpers.db = client
-    result = get_user_lang(chat_id, user_id)
-
-    # Uncomment the following line if the function uses the Firestore client directly
-    # result = get_user_lang(chat_id, user_id, client)
+    await store.set_member(chat_id, user_id, {"preferred_language": user_lang})
+    result = await get_user_lang(chat_id, user_id)
 
     assert result == user_lang
 
-def test_get_user_lang_non_existing_user():
+@pytest.mark.asyncio
+async def test_get_user_lang_non_existing_user(store):
     chat_id = "chat1"
     user_id = "non_existing_user"
 
-    client = MagicMock(spec=Client)
-    client.collection().document().collection().document().get().exists = False
-    helpers.db = client
-
-    result = get_user_lang(chat_id, user_id)
-
-    # Uncomment the following line if the function uses the Firestore client directly
-    # result = get_user_lang(chat_id, user_id, client)
+    result = await get_user_lang(chat_id, user_id)
 
     assert result is None
 
-def test_validate_language():
-    assert validate_language("en") is True
-    assert validate_language("invalid_code") is False
+@pytest.mark.asyncio
+async def test_validate_language(mock_translate_client):
+    mock_translate_client.get_languages.return_value = [{"language": "en", "name": "English"}]
+
+    assert await validate_language("en") is True
+    assert await validate_language("invalid_code") is False
 
 @pytest.mark.asyncio
 async def test_get_openai_response():
-    response = await openai.get_openai_response("hello again")
-    print(response)
-
-
-@pytest.mark.asyncio
-async def test_increment_active_chats_first_chat_document_does_not_exist():
-    """Test case where the 'count' document doesn't exist."""
-    mock_db = MagicMock(spec=Client)
-    mock_transaction = AsyncMock(spec=firestore.AsyncTransaction)
-    mock_doc_ref = MagicMock()
-    mock_doc_snapshot = AsyncMock(spec=DocumentSnapshot)
-    mock_doc_snapshot.exists = False
-
-    mock_db.collection.return_value.document.return_value = mock_doc_ref
-    mock_db.transaction.return_value = mock_transaction
-    
-    # The transaction.get() is called inside the @firestore.async_transactional decorated function
-    # So we need to mock the result of the transaction.get() call
-    async def mock_transaction_get_side_effect(doc_ref_arg, **kwargs):
-        return mock_doc_snapshot
-    
-    mock_transaction.get = mock_transaction_get_side_effect
-
-    # Patch firestore.async_transactional to just run the inner function
-    # This allows us to avoid dealing with the complexities of the decorator
-    # and directly test the logic within _update_count
-    with patch("google.cloud.firestore.async_transactional", lambda x: x):
-        helpers.db = mock_db
-        config.MAXIMUM_CHATS = 5 # Ensure MAXIMUM_CHATS is >= 1
-        result = await increment_active_chats()
-
-    assert result is True
-    mock_transaction.set.assert_called_once_with(mock_doc_ref, {"count": 1})
+    messages = [{"role": "user", "content": "hello again"}]
+    reply = {"choices": [{"message": {"content": " Hello! \n"}}]}
+    with patch("openai.ChatCompletion.create", return_value=reply) as create:
+        response = await openai_helper.get_openai_response(messages)
+    assert response == "Hello!"
+    create.assert_called_once_with(model="gpt-3.5-turbo", messages=messages)
 
 
 @pytest.mark.asyncio
-async def test_increment_active_chats_count_less_than_max():
-    """Test case where count < MAXIMUM_CHATS."""
-    mock_db = MagicMock(spec=Client)
-    mock_transaction = AsyncMock(spec=firestore.AsyncTransaction)
-    mock_doc_ref = MagicMock()
-    mock_doc_snapshot = AsyncMock(spec=DocumentSnapshot)
-    mock_doc_snapshot.exists = True
-    mock_doc_snapshot.to_dict.return_value = {"count": 2}
+async def test_increment_active_chats_first_chat(store):
+    config.MAXIMUM_CHATS = 5
+    assert await increment_active_chats() is True
+    assert await store.get_counter("active_chats") == 1
 
-    mock_db.collection.return_value.document.return_value = mock_doc_ref
-    mock_db.transaction.return_value = mock_transaction
-    async def mock_transaction_get_side_effect(doc_ref_arg, **kwargs):
-        return mock_doc_snapshot
-    mock_transaction.get = mock_transaction_get_side_effect
-    
-    with patch("google.cloud.firestore.async_transactional", lambda x: x):
-        helpers.db = mock_db
-        config.MAXIMUM_CHATS = 5
-        result = await increment_active_chats()
 
-    assert result is True
-    mock_transaction.update.assert_called_once_with(mock_doc_ref, {"count": firestore.Increment(1)})
+@pytest.mark.asyncio
+async def test_increment_active_chats_count_equals_max(store):
+    config.MAXIMUM_CHATS = 5
+    store.counters["active_chats"] = 5
+    assert await increment_active_chats() is False
+    assert await store.get_counter("active_chats") == 5
 
 
 @pytest.mark.asyncio
-async def test_increment_active_chats_count_equals_max():
-    """Test case where count == MAXIMUM_CHATS."""
-    mock_db = MagicMock(spec=Client)
-    mock_transaction = AsyncMock(spec=firestore.AsyncTransaction)
-    mock_doc_ref = MagicMock()
-    mock_doc_snapshot = AsyncMock(spec=DocumentSnapshot)
-    mock_doc_snapshot.exists = True
-    mock_doc_snapshot.to_dict.return_value = {"count": 5}
+async def test_increment_active_chats_max_chats_zero(store):
+    config.MAXIMUM_CHATS = 0
+    assert await increment_active_chats() is False
+    assert await store.get_counter("active_chats") == 0
 
-    mock_db.collection.return_value.document.return_value = mock_doc_ref
-    mock_db.transaction.return_value = mock_transaction
-    async def mock_transaction_get_side_effect(doc_ref_arg, **kwargs):
-        return mock_doc_snapshot
-    mock_transaction.get = mock_transaction_get_side_effect
 
-    with patch("google.cloud.firestore.async_transactional", lambda x: x):
-        helpers.db = mock_db
+@pytest.mark.asyncio
+async def test_increment_active_chats_storage_exception():
+    """Test case where the storage backend raises an exception."""
+    failing_store = MagicMock(get_counter=AsyncMock(return_value=0),
+                              add_to_counter=AsyncMock(side_effect=Exception("Simulated write error")))
+    with patch("helpers.store", failing_store):
         config.MAXIMUM_CHATS = 5
         result = await increment_active_chats()
 
     assert result is False
-    mock_transaction.update.assert_not_called()
-    mock_transaction.set.assert_not_called()
 
 
 @pytest.mark.asyncio
-async def test_increment_active_chats_max_chats_zero_new_document():
-    """Test case where MAXIMUM_CHATS is 0 and document doesn't exist."""
-    mock_db = MagicMock(spec=Client)
-    mock_transaction = AsyncMock(spec=firestore.AsyncTransaction)
-    mock_doc_ref = MagicMock()
-    mock_doc_snapshot = AsyncMock(spec=DocumentSnapshot)
-    mock_doc_snapshot.exists = False
+async def test_admit_and_release_chat_count_each_chat_once(store):
+    config.MAXIMUM_CHATS = 1
+    assert await helpers.admit_chat("chat1") is True
+    assert await helpers.admit_chat("chat1") is True  # already counted
+    assert await helpers.admit_chat("chat2") is False
+    assert await store.get_chat("chat1") == {"counted": True}
+    assert await store.get_chat("chat2") is None
 
-    mock_db.collection.return_value.document.return_value = mock_doc_ref
-    mock_db.transaction.return_value = mock_transaction
-    async def mock_transaction_get_side_effect(doc_ref_arg, **kwargs):
-        return mock_doc_snapshot
-    mock_transaction.get = mock_transaction_get_side_effect
+    await helpers.release_chat("chat2")  # never counted
+    assert await store.get_counter("active_chats") == 1
+    await helpers.release_chat("chat1")
+    assert await store.get_counter("active_chats") == 0
+    assert await store.get_chat("chat1") is None
 
-    with patch("google.cloud.firestore.async_transactional", lambda x: x):
-        helpers.db = mock_db
-        config.MAXIMUM_CHATS = 0
-        result = await increment_active_chats()
 
-    assert result is False
-    mock_transaction.set.assert_not_called()
+@pytest.mark.asyncio
+async def test_chats_recorded_before_the_counted_flag_are_released_if_groups(store):
+    config.MAXIMUM_CHATS = 5
+    store.counters["active_chats"] = 2
+    await store.save_chat("group", {"title": "Group"})
+    await store.save_chat("private", {"title": None})
 
+    assert await helpers.admit_chat("group") is True
+    assert await store.get_counter("active_chats") == 2
 
-@pytest.mark.asyncio
-async def test_increment_active_chats_transaction_exception():
-    """Test case where the transaction raises an exception."""
-    mock_db = MagicMock(spec=Client)
-    mock_transaction = AsyncMock(spec=firestore.AsyncTransaction)
+    await helpers.release_chat("group")
+    await helpers.release_chat("private", group=False)
+    assert await store.get_counter("active_chats") == 1
+    assert await store.list_chat_ids() == []
 
-    mock_db.collection.return_value.document.return_value = MagicMock()
-    mock_db.transaction.return_value = mock_transaction
-    
-    async def mock_transaction_side_effect(transaction, doc_ref):
-        # This is to simulate the behavior of the decorated function
-        # It will call the actual _update_count which in turn calls transaction.get
-        # We want the transaction itself, or rather the execution of the transactional function, to fail
-        raise Exception("Simulated transaction error")
 
-    # We patch the decorator to essentially call our mock_transaction_side_effect
-    # which then simulates an error during the transaction's execution.
-    with patch("google.cloud.firestore.async_transactional", return_value=mock_transaction_side_effect):
-        helpers.db = mock_db
-        config.MAXIMUM_CHATS = 5
-        result = await increment_active_chats()
+@pytest.mark.asyncio
+async def test_reconcile_active_chats_applies_the_difference(store):
+    store.counters["active_chats"] = 7
+    await store.save_chat("chat1", {"title": "One"})
+    await store.save_chat("chat2", {"title": "Two"})
 
-    assert result is False
+    assert await helpers.reconcile_active_chats() == -5
+    assert await store.get_counter("active_chats") == 2
+    assert await helpers.reconcile_active_chats() == 0
 
 
 
 @pytest.mark.asyncio
-@patch("helpers.translate_client")
-@patch("helpers.db")
-async def test_translate_and_send_messages_and_skip_sender(mock_db, mock_translate_client):
-    # Set up the mock for the members stream
+async def test_translate_and_send_messages_and_skip_sender(mock_translate_client, store):
+    # Set up the chat members
     # user1 (sender) - English
     # user2 - French
     # user3 - Spanish
     # user4 - French (to test grouping)
-    mock_members = [
-        MagicMock(id="user1", to_dict=lambda: {"preferred_language": "en"}), # Sender
-        MagicMock(id="user2", to_dict=lambda: {"preferred_language": "fr"}),
-        MagicMock(id="user3", to_dict=lambda: {"preferred_language": "es"}),
-        MagicMock(id="user4", to_dict=lambda: {"preferred_language": "fr"}), # Shares language with user2
-    ]
-    mock_db.collection.return_value.document.return_value.collection.return_value.stream.return_value = mock_members
+    await store.set_member("chat1", "user1", {"preferred_language": "en"}) # Sender
+    await store.set_member("chat1", "user2", {"preferred_language": "fr"})
+    await store.set_member("chat1", "user3", {"preferred_language": "es"})
+    await store.set_member("chat1", "user4", {"preferred_language": "fr"}) # Shares language with user2
 
     # Set up the mock for the translate_client to return based on target_language
     def custom_translate_side_effect(message, target_language):
@@ -280,154 +233,345 @@ async def test_translate_and_send_messages_and_skip_sender(mock_db, mock_transla
 
 
 
-@pytest.fixture
-def firestore_mock():
-    with patch("helpers.firestore.Client") as mock_client:
-        yield mock_client
-
 @pytest.mark.asyncio
-async def test_get_previous_messages():
+async def test_get_previous_messages(store):
     chat_id = "chat1"
     user_id = "user1"
 
-    mock_doc_1 = MagicMock(id="1", to_dict=lambda: {"user_id": "user1", "message_text": "Test message 1", "role": "user", "timestamp": "2023-01-01"})
-    mock_doc_2 = MagicMock(id="2", to_dict=lambda: {"user_id": "user1", "message_text": "Test response 1", "role": "assistant", "timestamp": "2023-01-02"})
-    mock_doc_3 = MagicMock(id="2", to_dict=lambda: {"user_id": "user1", "message_text": "Test message 2", "role": "user", "timestamp": "2023-01-03"})
+    await store.add_message(chat_id, {"user_id": "user1", "message_text": "Test message 1", "role": "user"})
+    await store.add_message(chat_id, {"user_id": "user2", "message_text": "Other user", "role": "user"})
+    await store.add_message(chat_id, {"user_id": "user1", "message_text": "Test response 1", "role": "assistant"})
+    await store.add_message(chat_id, {"user_id": "user1", "message_text": "Test message 2", "role": "user"})
 
-    with patch('helpers.db') as mock_db:
-        mock_db.collection.return_value.document.return_value.collection.return_value.where.return_value.order_by.return_value.stream.return_value = [mock_doc_1, mock_doc_2, mock_doc_3]
-
-        result = await helpers.get_previous_messages(chat_id, user_id)
-        expected = [
-            {"role": "user", "content": "Test message 1"},
-            {"role": "assistant", "content": "Test response 1"},
-            {"role": "user", "content": "Test message 2"}
-        ]
+    result = await helpers.get_previous_messages(chat_id, user_id)
+    expected = [
+        {"role": "user", "content": "Test message 1"},
+        {"role": "assistant", "content": "Test response 1"},
+        {"role": "user", "content": "Test message 2"}
+    ]
 
-        assert result == expected
+    assert result == expected
 
 @pytest.mark.asyncio
-async def test_store_message_for_user():
+async def test_store_message_for_user(store):
     chat_id = "chat1"
     user_id = "user1"
     message_text = "Test message"
 
-    with patch('helpers.db') as mock_db:
-        await helpers.store_message(chat_id, user_id, message_text)
-        mock_db.collection.return_value.document.return_value.collection.return_value.add.assert_called_once_with({
-            'user_id': user_id,
-            'message_text': message_text,
-            'role': "user",
-            'timestamp': firestore.SERVER_TIMESTAMP
-        })
-
-# --- Tests for reset_message_count and start_reset_task ---
-
-@pytest.mark.asyncio
-@patch('helpers.asyncio.sleep', new_callable=AsyncMock) # Mock sleep to prevent actual sleeping
-@patch('helpers.db')
-async def test_reset_message_count_rebuilds_from_firestore(mock_db, mock_sleep):
-    """
-    Test that reset_message_count rebuilds message_counts based on active chats in Firestore,
-    and resets their counts to 0.
-    """
-    # Initial state: some chats exist, some don't match Firestore
-    helpers.message_counts = {"chat1": 10, "chat2": 5, "stale_chat": 100}
-
-    # Mock Firestore stream to return specific active chats
-    mock_chat_doc1 = MagicMock(id="chat1")
-    mock_chat_doc2 = MagicMock(id="chat2_new") # A new chat not previously in message_counts
-    
-    # Create an async iterable from the mock documents
-    async def mock_stream_generator():
-        yield mock_chat_doc1
-        yield mock_chat_doc2
-        
-    mock_db.collection.return_value.stream.return_value = mock_stream_generator()
-
-    # We need to run reset_message_count once, not its infinite loop.
-    # We can do this by making asyncio.sleep raise an exception after the first call.
-    mock_sleep.side_effect = asyncio.CancelledError # Stop the loop after one iteration
-
-    with pytest.raises(asyncio.CancelledError): # Expect CancelledError to break the loop
-        await helpers.reset_message_count()
-
-    # Assertions:
-    # - 'stale_chat' should be gone.
-    # - 'chat1' should be reset to 0.
-    # - 'chat2' (which was not in Firestore mock) should be gone.
-    # - 'chat2_new' (from Firestore mock) should be added and set to 0.
-    assert "stale_chat" not in helpers.message_counts
-    assert "chat2" not in helpers.message_counts
-    assert helpers.message_counts.get("chat1") == 0
-    assert helpers.message_counts.get("chat2_new") == 0
-    assert len(helpers.message_counts) == 2
-
-    # Ensure sleep was called (meaning one loop iteration started)
-    mock_sleep.assert_awaited_once_with(86400)
-    mock_db.collection.assert_called_once_with(u'chats')
-
-
-@pytest.mark.asyncio
-@patch('helpers.asyncio.sleep', new_callable=AsyncMock) # Mock sleep
-@patch('helpers.db')
-async def test_reset_message_count_firestore_error_fallback(mock_db, mock_sleep):
-    """
-    Test that reset_message_count falls back to clearing message_counts
-    if Firestore operations fail.
-    """
-    helpers.message_counts = {"chat1": 10, "chat2": 5} # Initial state
-
-    # Mock Firestore stream to raise an exception
-    mock_db.collection.return_value.stream.side_effect = Exception("Firestore unavailable")
-
-    mock_sleep.side_effect = asyncio.CancelledError # Stop the loop after one iteration
-
-    with pytest.raises(asyncio.CancelledError):
-        await helpers.reset_message_count()
-
-    # Assertions:
-    # - message_counts should be empty due to fallback.
-    assert helpers.message_counts == {}
-    mock_sleep.assert_awaited_once_with(86400)
-
-
-def test_start_reset_task_returns_task_object():
-    """
-    Test that start_reset_task creates and returns an asyncio.Task.
-    """
-    # We need an event loop to create a task, even if it's a mock one for this sync test part
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-    with patch('helpers.asyncio.create_task') as mock_create_task:
-        mock_task = MagicMock(spec=asyncio.Task)
-        mock_create_task.return_value = mock_task
-        
-        returned_task = helpers.start_reset_task()
-        
-        mock_create_task.assert_called_once_with(helpers.reset_message_count())
-        assert returned_task == mock_task
-
-    # Clean up the loop if we created one for this test
-    if not asyncio.get_event_loop().is_running(): # Check if we set a new loop that isn't running
-        asyncio.set_event_loop(None)
-        loop.close()
-
-@pytest.mark.asyncio
-async def test_store_message_for_assistant():
+    msg = await helpers.store_message(chat_id, user_id, message_text)
+
+    assert msg == {"role": "user", "content": message_text}
+    stored = await store.get_messages(chat_id, user_id)
+    assert len(stored) == 1
+    assert stored[0]['message_text'] == message_text
+    assert stored[0]['role'] == "user"
+
+@pytest.mark.asyncio
+async def test_store_message_for_assistant(store):
     chat_id = "chat1"
     user_id = "user1"
     message_text = "Test message"
 
-    with patch('helpers.db') as mock_db:
-        await helpers.store_message(chat_id, user_id, message_text, role='assistant')
-        mock_db.collection.return_value.document.return_value.collection.return_value.add.assert_called_once_with({
-            'user_id': user_id,
-            'message_text': message_text,
-            'role': "assistant",
-            'timestamp': firestore.SERVER_TIMESTAMP
-        })
+    msg = await helpers.store_message(chat_id, user_id, message_text, role='assistant')
+
+    assert msg == {"role": "assistant", "content": message_text}
+    stored = await store.get_messages(chat_id, user_id)
+    assert len(stored) == 1
+    assert stored[0]['message_text'] == message_text
+    assert stored[0]['role'] == "assistant"
+
+@pytest.mark.asyncio
+async def test_conversation_layout_reads_one_capped_record(store):
+    with patch("helpers.HISTORY_LAYOUT", "conversation"), patch("helpers.CONVERSATION_MAX_TURNS", 2):
+        await helpers.store_message("chat1", "user1", "first")
+        await helpers.store_message("chat1", "user1", "second", role="assistant")
+        await helpers.store_message("chat1", "user1", "third")
+
+        history = await helpers.get_previous_messages("chat1", "user1")
+
+    assert history == [{"role": "assistant", "content": "second"}, {"role": "user", "content": "third"}]
+    assert await store.get_messages("chat1", "user1") == []
+
+
+@pytest.mark.asyncio
+async def test_member_cache_reads_once_and_writes_through(store):
+    await store.set_member("chat1", "user1", {"preferred_language": "en"})
+
+    assert await get_user_lang("chat1", "user1") == "en"
+    await store.set_member("chat1", "user1", {"preferred_language": "de"})  # not through helpers
+    assert await get_user_lang("chat1", "user1") == "en"
+
+    await helpers.set_member("chat1", "user1", {"preferred_language": "fr"})
+    assert await get_user_lang("chat1", "user1") == "fr"
+    await helpers.remove_member("chat1", "user1")
+    assert await get_user_lang("chat1", "user1") is None
+    assert await store.get_member("chat1", "user1") is None
+
+    await helpers.forget_chat("chat1")
+    assert "chat1" not in helpers.chat_states
+
+
+@pytest.mark.asyncio
+async def test_member_count_is_cached_until_members_change(store):
+    bot = MagicMock()
+    bot.get_chat_member_count = AsyncMock(side_effect=[5, 6])
+
+    assert await helpers.get_member_count(bot, "chat1") == 5
+    assert await helpers.get_member_count(bot, "chat1") == 5
+    helpers.invalidate_member_count("chat1")
+    assert await helpers.get_member_count(bot, "chat1") == 6
+    assert bot.get_chat_member_count.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_warm_up_member_cache_loads_every_chat(store):
+    await store.save_chat("chat1", {"title": "One"})
+    await store.save_chat("chat2", {"title": "Two"})
+    await store.set_member("chat1", "user1", {"preferred_language": "en"})
+    await store.set_member("chat1", "user2", {"preferred_language": "fr"})
+
+    result = await helpers.warm_up_member_cache()
+
+    assert (result["chats"], result["members"]) == (2, 2)
+    assert helpers.chat_states.peek("chat1").members == {"user1": {"preferred_language": "en"},
+                                                         "user2": {"preferred_language": "fr"}}
+    assert helpers.chat_states.peek("chat2").members == {}
+
+
+@pytest.mark.asyncio
+async def test_warm_up_member_cache_loads_only_owned_chats(store):
+    await store.save_chat("chat1", {"title": "One"})
+    await store.save_chat("chat2", {"title": "Two"})
+
+    result = await helpers.warm_up_member_cache(owns=lambda chat_id: chat_id == "chat2")
+
+    assert result["chats"] == 1
+    assert "chat1" not in helpers.chat_states and "chat2" in helpers.chat_states
+
+
+@pytest.mark.asyncio
+async def test_translate_and_send_messages_skips_untranslatable_messages(mock_translate_client):
+    failing_store = MagicMock(list_members=AsyncMock(side_effect=AssertionError("members should not be read")))
+    update = MagicMock()
+    update.effective_chat.id = "chat1"
+    context = MagicMock()
+    context.bot.send_message = AsyncMock()
+
+    with patch("helpers.store", failing_store), patch("helpers.chat_states", ChatStates()):
+        await translate_and_send_messages(update, context, "https://example.com 😀")
+
+    mock_translate_client.translate.assert_not_called()
+    context.bot.send_message.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_translate_and_send_messages_keeps_links_untranslated(mock_translate_client, store):
+    await store.set_member("chat1", "user1", {"preferred_language": "en"})
+    await store.set_member("chat1", "user2", {"preferred_language": "fr"})
+    mock_translate_client.translate.side_effect = lambda texts, target_language: [
+        {"translatedText": f"<{text}>"} for text in texts]
+    update = MagicMock()
+    update.effective_chat.id = "chat1"
+    update.effective_user.id = "user1"
+    update.effective_message.message_id = 7
+    context = MagicMock()
+    context.bot.send_message = AsyncMock()
+
+    await translate_and_send_messages(update, context, "look at https://example.com now")
+
+    mock_translate_client.translate.assert_any_call(["look at", "now"], target_language="fr")
+    context.bot.send_message.assert_awaited_once_with(chat_id="chat1", text="<look at> https://example.com <now>",
+                                                      reply_to_message_id=7)
+
+
+@pytest.mark.asyncio
+async def test_translate_and_send_messages_skips_the_source_language(mock_translate_client, store):
+    await store.set_member("chat1", "user1", {"preferred_language": "fr"})
+    await store.set_member("chat1", "user2", {"preferred_language": "fr"})
+    await store.set_member("chat1", "user3", {"preferred_language": "en"})
+    mock_translate_client.translate.return_value = {"translatedText": "See you tonight at the beach"}
+    update = MagicMock()
+    update.effective_chat.id = "chat1"
+    update.effective_user.id = "user1"
+    update.effective_message.message_id = 7
+    context = MagicMock()
+    context.bot.send_message = AsyncMock()
+
+    await translate_and_send_messages(update, context, "On se voit ce soir à la plage")
+
+    mock_translate_client.translate.assert_called_once_with("On se voit ce soir à la plage", target_language="en")
+    context.bot.send_message.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_translate_and_send_messages_skips_chats_sharing_the_language(mock_translate_client, store):
+    await store.set_member("chat1", "user1", {"preferred_language": "sw"})
+    await store.set_member("chat1", "user2", {"preferred_language": "sw"})
+    update = MagicMock()
+    update.effective_chat.id = "chat1"
+    update.effective_user.id = "user1"
+    context = MagicMock()
+    context.bot.send_message = AsyncMock()
+
+    await translate_and_send_messages(update, context, "Habari za asubuhi, karibu sana")
+
+    mock_translate_client.translate.assert_not_called()
+    context.bot.send_message.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_validate_language_awaits_the_async_client(mock_translate_client):
+    mock_translate_client.get_languages = AsyncMock(return_value=[{"language": "sw", "name": "Swahili"}])
+
+    assert await validate_language("sw") is True
+    assert await validate_language("xx") is False
+
+
+@pytest.mark.asyncio
+async def test_translate_and_send_messages_replies_to_the_first_merged_message(mock_translate_client, store):
+    await store.set_member("chat1", "user1", {"preferred_language": "en"})
+    await store.set_member("chat1", "user2", {"preferred_language": "fr"})
+    mock_translate_client.translate.return_value = [{"translatedText": "Salut"}, {"translatedText": "Ça va ?"}]
+    update = MagicMock()
+    update.effective_chat.id = "chat1"
+    update.effective_user.id = "user1"
+    update.effective_message.message_id = 8
+    context = MagicMock()
+    context.bot.send_message = AsyncMock()
+
+    await translate_and_send_messages(update, context, "Hi\nHow are you?", parts={7: "Hi", 8: "How are you?"})
+
+    context.bot.send_message.assert_awaited_once_with(chat_id="chat1", text="Salut\nÇa va ?", reply_to_message_id=7)
+
+
+@pytest.mark.asyncio
+async def test_profile_language_is_the_default_in_every_chat(store):
+    await helpers.set_user_language("user1", "fr")
+    await store.set_member("chat1", "user1", {})
+    await store.set_member("chat2", "user1", {"preferred_language": "de"})
+
+    assert await get_user_lang("chat1", "user1") == "fr"
+    assert await get_user_lang("chat2", "user1") == "de"
+    assert await get_user_lang("chat3", "user1") == "fr"
+    assert await helpers.resolve_languages("chat1") == {"user1": "fr"}
+
+
+@pytest.mark.asyncio
+async def test_user_profiles_are_read_once_and_invalidated(store):
+    await store.set_user("user1", {"preferred_language": "fr"})
+    with patch.object(store, "load_users", wraps=store.load_users) as load_users:
+        assert await helpers.get_user_profile("user1") == {"preferred_language": "fr"}
+        assert await helpers.get_user_profile("user2") is None
+        assert await helpers.get_user_profiles(["user1", "user2"]) == {"user1": {"preferred_language": "fr"},
+                                                                       "user2": None}
+        assert load_users.await_count == 2
+
+        await store.set_user("user1", {"preferred_language": "es"})
+        helpers.invalidate_user("user1")
+        assert await helpers.get_user_profile("user1") == {"preferred_language": "es"}
+        assert load_users.await_count == 3
+
+
+@pytest.mark.asyncio
+async def test_user_cache_drops_the_least_recently_used_and_expired_users(store):
+    with patch("helpers.USER_CACHE_SIZE", 2), patch("helpers.time.monotonic", return_value=1000.0) as clock:
+        await helpers.get_user_profiles(["user1", "user2"])
+        await helpers.get_user_profile("user1")
+        await helpers.get_user_profile("user3")
+        assert list(helpers.user_cache) == ["user1", "user3"]
+
+        clock.return_value += helpers.USER_CACHE_TTL + 1
+        await helpers.set_user_language("user4", "fr")
+        assert list(helpers.user_cache) == ["user4"]
+
+
+@pytest.mark.asyncio
+async def test_join_chat_brings_the_profile_language_along(store):
+    await helpers.set_user_language("user1", "fr")
+
+    assert await helpers.join_chat("chat1", "user1") is True
+    assert await helpers.join_chat("chat1", "user1") is False
+    assert await helpers.join_chat("chat1", "user2") is False
+    assert await store.get_member("chat1", "user1") == {}
+    assert await helpers.resolve_languages("chat1") == {"user1": "fr"}
+
+
+@pytest.mark.asyncio
+async def test_edits_update_the_replies_and_translate_only_changed_lines(mock_translate_client, store):
+    await store.set_member("chat1", "user1", {"preferred_language": "en"})
+    await store.set_member("chat1", "user2", {"preferred_language": "fr"})
+    await store.set_member("chat1", "user3", {"preferred_language": "fr"})
+    mock_translate_client.translate.side_effect = lambda values, target_language: (
+        {"translatedText": f"<{values}>"} if isinstance(values, str)
+        else [{"translatedText": f"<{value}>"} for value in values])
+    update = MagicMock()
+    update.effective_chat.id = "chat1"
+    update.effective_user.id = "user1"
+    update.effective_message.message_id = 7
+    context = MagicMock()
+    context.bot.send_message = AsyncMock(side_effect=[MagicMock(message_id=100), MagicMock(message_id=101)])
+    context.bot.edit_message_text = AsyncMock()
+    await translate_and_send_messages(update, context, "See you at the beach\nBring teh food")
+    mock_translate_client.translate.reset_mock()
+
+    update.effective_message.text = "See you at the beach\nBring the food"
+    await helpers.translate_edited_message(update, context)
+
+    mock_translate_client.translate.assert_called_once_with("Bring the food", target_language="fr")
+    assert context.bot.send_message.await_count == 2
+    context.bot.edit_message_text.assert_has_awaits([
+        call(text="<See you at the beach>\n<Bring the food>", chat_id="chat1", message_id=100),
+        call(text="<See you at the beach>\n<Bring the food>", chat_id="chat1", message_id=101)])
+
+    # Editing it back needs no translation at all, nor does an edit of an unknown message
+    mock_translate_client.translate.reset_mock()
+    update.effective_message.text = "See you at the beach"
+    await helpers.translate_edited_message(update, context)
+    update.effective_message.message_id = 8
+    await helpers.translate_edited_message(update, context)
+    mock_translate_client.translate.assert_not_called()
+    assert context.bot.edit_message_text.await_count == 4
+
+
+@pytest.mark.asyncio
+async def test_long_messages_are_translated_in_parallel_chunks_and_sent_in_parts(mock_translate_client, store):
+    await store.set_member("chat1", "user1", {"preferred_language": "en"})
+    await store.set_member("chat1", "user2", {"preferred_language": "fr"})
+    # French comes out twice as long
+    mock_translate_client.translate.side_effect = lambda values, target_language: (
+        {"translatedText": values * 2} if isinstance(values, str)
+        else [{"translatedText": value * 2} for value in values])
+    update = MagicMock()
+    update.effective_chat.id = "chat1"
+    update.effective_user.id = "user1"
+    update.effective_message.message_id = 7
+    context = MagicMock()
+    context.bot.send_message = AsyncMock(side_effect=[MagicMock(message_id=100 + i) for i in range(10)])
+    text = "This is a long announcement about the beach party. " * 100
+
+    with patch("chunking.TRANSLATE_CHUNK_SIZE", 1000):
+        await translate_and_send_messages(update, context, text)
+
+    pieces = [c.args[0] for c in mock_translate_client.translate.call_args_list if c.kwargs["target_language"] == "fr"]
+    assert len(pieces) == 6 and all(len(piece) <= 1000 for piece in pieces)
+    sent = [c.kwargs["text"] for c in context.bot.send_message.await_args_list]
+    assert len(sent) == 3 and all(len(part) <= 4096 for part in sent)
+    assert len("".join(sent)) > 1.9 * len(text)
+    assert all(c.kwargs["reply_to_message_id"] == 7 for c in context.bot.send_message.await_args_list)
+
+
+@pytest.mark.asyncio
+async def test_edit_parts_sends_or_deletes_parts_when_the_length_changes():
+    context = MagicMock()
+    context.bot.edit_message_text = AsyncMock()
+    context.bot.send_message = AsyncMock(return_value=MagicMock(message_id=101))
+    context.bot.delete_message = AsyncMock()
+    reply_ids = [100]
+
+    await helpers.edit_parts(context, "chat1", reply_ids, "Jambo rafiki. " * 600, 7)
+    assert len(reply_ids) == 3 and context.bot.send_message.await_count == 2
+
+    await helpers.edit_parts(context, "chat1", reply_ids, "Jambo", 7)
+    assert reply_ids == [100]
+    assert context.bot.delete_message.await_count == 2
+    context.bot.edit_message_text.assert_awaited_with(text="Jambo", chat_id="chat1", message_id=100)
@@ -0,0 +1,68 @@
+import pytest
+
+import langid
+
+
+@pytest.mark.parametrize("text,lang", [
+    ("Hello everyone, what time is dinner tonight?", "en"),
+    ("Bonjour tout le monde, on se voit ce soir ?", "fr"),
+    ("Nos vemos mañana en la playa", "es"),
+    ("Wie spät ist es? Ich komme gleich.", "de"),
+    ("Habari za asubuhi rafiki yangu", "sw"),
+    ("这是我们的国家", "zh-CN"),
+    ("這是我們的國家", "zh-TW"),
+    ("Привіт, як справи?", "uk"),
+    ("こんにちは、元気ですか", "ja"),
+    ("안녕하세요", "ko"),
+])
+def test_detect_confidently(text, lang):
+    detected, confidence = langid.detect(text)
+
+    assert detected == lang
+    assert confidence >= 0.8
+
+
+def test_too_short_to_tell():
+    assert langid.detect("ok") == (None, 0.0)
+    assert langid.detect("😀 12") == (None, 0.0)
+
+
+def test_prior_settles_shared_scripts():
+    assert langid.detect("Привет, как дела?")[1] < 0.8
+    assert langid.detect("Привет, как дела?", prior="ru") == ("ru", 0.9)
+    assert langid.detect("中文", prior="zh-TW") == (None, 0.0)
+    assert langid.detect("中文字幕", prior="zh-TW") == ("zh-TW", 0.9)
+
+
+def test_prior_only_nudges_latin_text():
+    assert langid.detect("Bonjour tout le monde, on se voit ce soir ?", prior="en")[0] == "fr"
+    assert langid.detect("merci", prior="fr")[0] == "fr"
+
+
+@pytest.mark.parametrize("text", [
+    "Hej alle sammen, hvordan har I det i dag? Vi ses på stranden i morgen",  # Danish
+    "Jeg kommer lidt senere i aften, vi ses på stranden i morgen tidlig",  # Danish
+    "Bon dia a tothom, com estàs avui? Ens veiem demà a la platja",  # Catalan
+    "Hyvää huomenta kaikille, nähdään huomenna rannalla",  # Finnish
+    "Bună dimineața tuturor, ne vedem mâine la plajă",  # Romanian
+])
+def test_languages_without_a_profile_are_not_confident(text):
+    assert langid.detect(text)[1] < 0.8
+
+
+def test_a_poor_fit_is_not_identified():
+    assert langid.detect("Hyvää huomenta kaikille, nähdään huomenna rannalla") == (None, 0.0)
+
+
+def test_prior_does_not_raise_the_confidence():
+    # Spanish, but short and ambiguous enough that Portuguese fits about as well
+    assert langid.detect("Ya nos vemos", prior="pt")[1] == langid.detect("Ya nos vemos")[1] < 0.8
+    assert langid.detect("Nos vemos mañana en la playa", prior="pt")[0] == "es"
+
+
+def test_same_language():
+    assert langid.same_language("fr", "fr")
+    assert langid.same_language("iw", "he")
+    assert not langid.same_language("zh-CN", "zh")
+    assert not langid.same_language("zh-TW", "zh-CN")
+    assert not langid.same_language("en", None)
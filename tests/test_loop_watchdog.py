@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import pytest
+
+import profiling
+from loop_watchdog import LagHistogram, LoopWatchdog, format_stats
+
+
+def test_histogram_buckets_and_percentiles():
+    histogram = LagHistogram(buckets=(1, 10, 100))
+    for seconds in [0.0005] * 98 + [0.05, 0.3]:
+        histogram.add(seconds)
+
+    stats = histogram.as_dict()
+    assert stats["buckets"] == {"le_1": 98, "le_10": 0, "le_100": 1, "gt_100": 1}
+    assert (stats["p50_ms"], stats["p99_ms"], stats["max_ms"]) == (1.0, 100.0, 300.0)
+    assert histogram.percentile(100) == 300.0
+    assert LagHistogram().as_dict()["p99_ms"] == 0.0
+
+
+def block_the_loop(seconds):
+    time.sleep(seconds)
+
+
+async def translate_message(update, context):
+    await asyncio.sleep(0.01)
+    block_the_loop(0.2)
+
+
+@pytest.mark.asyncio
+async def test_a_blocking_call_is_logged_with_its_stack_and_handler():
+    logged = []
+    watchdog = LoopWatchdog(interval=0.01, threshold=0.05, log=logged.append).start()
+    try:
+        await profiling.profiled(translate_message)(None, None)
+        await asyncio.sleep(0.03)
+    finally:
+        watchdog.stop()
+
+    assert watchdog.stats()["blocked"] == 1
+    assert watchdog.stats()["blocked_by_handler"] == {"translate_message": 1}
+    assert "in handler translate_message" in logged[0]
+    assert "block_the_loop" in logged[0] and "time.sleep(seconds)" in logged[0]
+    assert watchdog.stats()["lag"]["max_ms"] >= 150
+    assert "1 block(s) (translate_message 1)" in format_stats(watchdog.stats())
+
+
+@pytest.mark.asyncio
+async def test_awaiting_does_not_count_as_blocking():
+    logged = []
+    watchdog = LoopWatchdog(interval=0.01, threshold=0.05, log=logged.append).start()
+    try:
+        await asyncio.gather(*(asyncio.sleep(0.1) for _ in range(10)), asyncio.to_thread(time.sleep, 0.1))
+    finally:
+        watchdog.stop()
+
+    assert logged == []
+    assert watchdog.stats()["blocked"] == 0
+    assert watchdog.stats()["lag"]["samples"] > 0
+
+
+def test_active_handler_is_none_outside_handlers():
+    import sys
+
+    assert profiling.active_handler(sys._getframe()) is None
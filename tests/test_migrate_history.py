@@ -0,0 +1,50 @@
+import pytest
+
+from migrate_history import migrate
+from storage import InMemoryStorage
+
+
+@pytest.mark.asyncio
+async def test_migrate_groups_messages_by_user():
+    store = InMemoryStorage()
+    await store.save_chat(-100, {"title": "Group"})
+    await store.add_message(-100, {"user_id": 1, "message_text": "hi", "role": "user"})
+    await store.add_message(-100, {"user_id": 2, "message_text": "hello", "role": "user"})
+    await store.add_message(-100, {"user_id": 1, "message_text": "Mambo!", "role": "assistant"})
+
+    assert await migrate(store, max_turns=10) == 2
+    assert await store.get_conversation(-100, 1) == [{"role": "user", "content": "hi"},
+                                                     {"role": "assistant", "content": "Mambo!"}]
+    assert await store.get_conversation(-100, 2) == [{"role": "user", "content": "hello"}]
+
+
+@pytest.mark.asyncio
+async def test_migrate_covers_chats_without_a_chat_record():
+    store = InMemoryStorage()
+    await store.add_message(555, {"user_id": 555, "message_text": "hi", "role": "user"})
+    await store.add_message(555, {"user_id": 555, "message_text": "Mambo!", "role": "assistant"})
+
+    assert await migrate(store, max_turns=10) == 1
+    assert await store.get_conversation(555, 555) == [{"role": "user", "content": "hi"},
+                                                      {"role": "assistant", "content": "Mambo!"}]
+
+
+@pytest.mark.asyncio
+async def test_migrate_dry_run_writes_nothing():
+    store = InMemoryStorage()
+    await store.save_chat(-100, {"title": "Group"})
+    await store.add_message(-100, {"user_id": 1, "message_text": "hi", "role": "user"})
+
+    assert await migrate(store, max_turns=10, dry_run=True) == 1
+    assert await store.get_conversation(-100, 1) == []
+
+
+@pytest.mark.asyncio
+async def test_migrate_drops_stored_persona():
+    store = InMemoryStorage()
+    await store.save_chat(-100, {"title": "Group"})
+    await store.add_message(-100, {"user_id": 1, "message_text": "hi", "role": "user"})
+    await store.add_message(-100, {"user_id": 1, "message_text": "You are Said.", "role": "system"})
+
+    assert await migrate(store, max_turns=10) == 1
+    assert await store.get_conversation(-100, 1) == [{"role": "user", "content": "hi"}]
@@ -0,0 +1,29 @@
+import persona
+
+
+def test_prepend_puts_the_current_persona_first():
+    history = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "Mambo!"}]
+
+    messages = persona.prepend(history)
+
+    assert messages == [{"role": "system", "content": persona.prompt}] + history
+    assert len(history) == 2
+
+
+def test_prepend_drops_stored_copies_of_the_persona():
+    history = [{"role": "system", "content": "an old persona"}, {"role": "user", "content": "hi"}]
+
+    assert persona.prepend(history) == [{"role": "system", "content": persona.prompt},
+                                        {"role": "user", "content": "hi"}]
+
+
+def test_version_follows_the_prompt(tmp_path):
+    path = tmp_path / "persona.txt"
+    path.write_text("You are Said.\n", encoding="utf-8")
+
+    prompt, version = persona.load(path=str(path))
+
+    assert prompt == "You are Said."
+    assert version == persona.load(prompt="You are Said.", path=None)[1]
+    assert version != persona.load(prompt="You are Amina.", path=None)[1]
+    assert persona.load(prompt="You are Said.", path=None, version="2024-05")[1] == "2024-05"
@@ -0,0 +1,41 @@
+import pytest
+
+import prefilter
+
+
+@pytest.mark.parametrize("text", [
+    "https://example.com/page?id=1",
+    "😀🎉",
+    "12 345,50",
+    "/start@OtherBot",
+    "@alice @bob",
+    "```\nfor i in range(3): print(i)\n```",
+    "x = foo(bar); y[0] = 1;",
+    "!!! ...",
+])
+def test_untranslatable_messages(text):
+    assert not prefilter.is_translatable(text)
+
+
+@pytest.mark.parametrize("text", ["Hello, world!", "ok", "Habari za asubuhi? 😀", "I'll be there at 5 (maybe)"])
+def test_translatable_messages(text):
+    assert prefilter.is_translatable(text)
+
+
+def test_split_protects_links_mentions_and_code():
+    text = "@bob see https://example.com, and run `pip install x` now"
+    segments = prefilter.split(text)
+
+    assert segments == [("@bob", False), (" ", False), ("see", True), (" ", False), ("https://example.com", False),
+                        (", and run", True), (" ", False), ("`pip install x`", False), (" ", False), ("now", True)]
+    assert "".join(segment for segment, _ in segments) == text
+
+
+def test_join_puts_translations_back_in_place():
+    segments = prefilter.split("see https://example.com now")
+    assert prefilter.join(segments, ["regarde", "maintenant"]) == "regarde https://example.com maintenant"
+
+
+def test_lines_are_separate_segments():
+    assert prefilter.split("Hi\nHow are you?  \n\n  ok 👍") == [
+        ("Hi", True), ("\n", False), ("How are you?", True), ("  \n\n  ", False), ("ok 👍", True)]
@@ -0,0 +1,128 @@
+import asyncio
+import pstats
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+import profiling
+
+
+@pytest.fixture(autouse=True)
+def clean_profiler():
+    profiling.reset()
+    yield
+    profiling.disable()
+    profiling.reset()
+
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+async def translate_message(update, context):
+    await asyncio.sleep(0)
+    spin(0.05)
+    return "done"
+
+
+@pytest.mark.asyncio
+async def test_handlers_run_unprofiled_by_default():
+    handler = profiling.profiled(translate_message)
+
+    assert await handler(None, None) == "done"
+    assert profiling.summary() == {}
+
+
+@pytest.mark.asyncio
+async def test_samples_are_collapsed_stacks_per_handler(tmp_path):
+    profiling.enable(1.0, "sample", interval=0.001)
+    handler = profiling.profiled(translate_message)
+
+    assert await handler(None, None) == "done"
+    profiling.disable()
+
+    stacks = profiling.stacks["translate_message"]
+    assert any(stack.startswith("translate_message;") and stack.endswith("test_profiling.py:spin")
+               for stack in stacks)
+    assert profiling.summary()["translate_message"]["invocations"] == 1
+    [path] = profiling.dump(str(tmp_path))
+    assert path.endswith("translate_message.collapsed")
+    stack, count = open(path).readline().rsplit(" ", 1)
+    assert stack.startswith("translate_message;") and int(count) > 0
+
+
+@pytest.mark.asyncio
+async def test_other_coroutines_are_not_charged_to_a_sampled_handler():
+    async def set_lang(update, context):
+        await asyncio.sleep(0.05)
+
+    async def busy():
+        await asyncio.sleep(0.005)
+        spin(0.03)
+
+    profiling.enable(1.0, "sample", interval=0.001)
+    await asyncio.gather(profiling.profiled(set_lang)(None, None), busy())
+    profiling.disable()
+
+    assert not any("spin" in stack for stack in profiling.stacks.get("set_lang", {}))
+
+
+@pytest.mark.asyncio
+async def test_cprofile_mode_merges_stats_per_handler(tmp_path):
+    profiling.enable(1.0, "cprofile")
+    handler = profiling.profiled(translate_message)
+    await handler(None, None)
+    await handler(None, None)
+
+    assert profiling.summary()["translate_message"]["invocations"] == 2
+    [path] = profiling.dump(str(tmp_path))
+    assert path.endswith("translate_message.pstats")
+    assert any(name == "spin" for _, _, name in pstats.Stats(path).stats)
+
+
+@pytest.mark.asyncio
+async def test_only_the_sampled_fraction_is_profiled():
+    async def my_lang(update, context):
+        pass
+
+    profiling.enable(0.5, "cprofile")
+    handler = profiling.profiled(my_lang)
+    with patch("profiling.random.random", side_effect=[0.2, 0.7, 0.4, 0.9]):
+        for _ in range(4):
+            await handler(None, None)
+
+    assert profiling.invocations["my_lang"] == 2
+
+
+def make_command(user_id, *args):
+    update = MagicMock()
+    update.effective_chat.id = "chat1"
+    update.effective_user.id = user_id
+    context = MagicMock()
+    context.args = list(args)
+    context.bot.send_message = AsyncMock()
+    return update, context
+
+
+@pytest.mark.asyncio
+async def test_profile_command_is_for_admins_only():
+    with patch("profiling.ADMIN_USER_IDS", {"42"}):
+        update, context = make_command(7, "on", "1")
+        await profiling.profile_command(update, context)
+        assert not profiling.enabled()
+        context.bot.send_message.assert_not_called()
+
+        update, context = make_command(42, "on", "0.25", "cprofile")
+        await profiling.profile_command(update, context)
+        assert (profiling.rate, profiling.mode) == (0.25, "cprofile")
+
+        update, context = make_command(42, "on", "1", "flame")
+        await profiling.profile_command(update, context)
+        assert "Unknown profiling mode" in context.bot.send_message.await_args.kwargs["text"]
+
+        update, context = make_command(42, "off")
+        await profiling.profile_command(update, context)
+        assert not profiling.enabled()
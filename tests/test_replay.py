@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+import replay
+from benchmark import make_update
+from fakes import FakeBot, FakeContext
+from replay import UpdateRecorder, fan_out, pseudonymize_id, remap_chats, scrub_text, scrub_update
+
+SALT = "test-salt"
+
+
+def recorded_update(text="Hello John, call me at 555 1234", chat_id=-1001, user_id=42, update_id=7):
+    return make_update(FakeBot(), update_id, chat_id, user_id, 3, text=text).to_dict()
+
+
+def test_pseudonymize_id_is_stable_and_keeps_sign():
+    assert pseudonymize_id(-1001, SALT) == pseudonymize_id(-1001, SALT)
+    assert pseudonymize_id(-1001, SALT) < 0
+    assert pseudonymize_id(42, SALT) > 0
+    assert pseudonymize_id(42, SALT) != 42
+
+
+def test_scrub_text_keeps_length_commands_and_bot_mention():
+    assert scrub_text("Hello John 42!") == "Xxxxx Xxxx 00!"
+    assert scrub_text("/setlang fr") == "/setlang fr"
+    assert scrub_text("@MisterSaidBot tell me", keep=("@MisterSaidBot",)) == "@MisterSaidBot xxxx xx"
+
+
+def test_scrub_update_removes_personal_data():
+    data = scrub_update(recorded_update(), SALT)
+    message = data["message"]
+
+    assert message["from"]["id"] == pseudonymize_id(42, SALT)
+    assert message["chat"]["id"] == pseudonymize_id(-1001, SALT)
+    assert "User" not in message["from"]["first_name"]
+    assert message["text"] == "Xxxxx Xxxx, xxxx xx xx 000 0000"
+    assert message["message_id"] == 3
+    assert data["update_id"] == 7
+
+
+def test_fan_out_moves_copies_to_disjoint_chats():
+    data = recorded_update()
+    assert fan_out(data, 0) is data
+
+    clone = fan_out(data, 2)
+    assert clone["update_id"] != data["update_id"]
+    assert clone["message"]["chat"]["id"] < 0
+    assert clone["message"]["chat"]["id"] != data["message"]["chat"]["id"]
+    assert clone["message"]["from"]["id"] != data["message"]["from"]["id"]
+
+
+def test_remap_chats_spreads_recorded_chats_over_staging_chats():
+    mapping = {}
+    first = remap_chats(recorded_update(chat_id=-1), [-500, -600], mapping)
+    second = remap_chats(recorded_update(chat_id=-2), [-500, -600], mapping)
+    again = remap_chats(recorded_update(chat_id=-1), [-500, -600], mapping)
+
+    assert first["message"]["chat"]["id"] == -500
+    assert second["message"]["chat"]["id"] == -600
+    assert again["message"]["chat"]["id"] == -500
+
+
+@pytest.mark.asyncio
+async def test_recorder_appends_scrubbed_json_lines(tmp_path):
+    path = tmp_path / "updates.jsonl"
+    bot = FakeBot()
+    recorder = UpdateRecorder(str(path), salt=SALT)
+
+    await recorder(make_update(bot, 1, -1001, 42, 1, text="@MisterSaidBot hi"), FakeContext(bot))
+    await recorder(make_update(bot, 2, -1001, 42, 2, text="bye"), FakeContext(bot))
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line["update"]["update_id"] for line in lines] == [1, 2]
+    assert lines[0]["update"]["message"]["text"] == "@MisterSaidBot xx"
+
+
+@pytest.mark.asyncio
+async def test_replay_against_fakes(tmp_path):
+    path = tmp_path / "updates.jsonl"
+    with open(path, "w") as f:
+        for i in range(6):
+            data = scrub_update(recorded_update(text="Hello there", chat_id=-10 - i % 2, user_id=i, update_id=i + 1),
+                                SALT)
+            f.write(json.dumps({"t": 100 + i, "update": data}) + "\n")
+
+    args = replay.parse_args([str(path), "--speed", "1000", "--fanout", "2", "--seed-languages", "en,fr,es"])
+    result = await replay.run_replay(args)
+
+    assert result["updates"] == 12
+    assert result["errors"] == 0
+    assert result["calls"]["translate.translate"] > 0
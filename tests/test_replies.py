@@ -0,0 +1,20 @@
+from unittest.mock import patch
+
+import replies
+
+
+def test_records_are_bounded_and_shared_by_merged_messages():
+    with patch("replies.REPLY_MAP_SIZE", 3), patch("replies._records", replies._records.__class__()):
+        burst = replies.Record({1: "hi", 2: "there"})
+        replies.remember("chat1", burst)
+        assert replies.lookup("chat1", 2) is burst and burst.text == "hi\nthere"
+
+        replies.remember("chat1", replies.Record({3: "one"}))
+        replies.remember("chat2", replies.Record({3: "two"}))
+
+        assert replies.size() == 3
+        assert replies.lookup("chat1", 1) is None
+        assert replies.lookup("chat2", 3).text == "two"
+
+        replies.forget_chat("chat2")
+        assert replies.lookup("chat2", 3) is None
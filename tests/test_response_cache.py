@@ -0,0 +1,71 @@
+from unittest.mock import patch
+
+import pytest
+
+import response_cache
+from storage import InMemoryStorage
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    response_cache.clear()
+    with patch("response_cache.RESPONSE_CACHE_VARIETY", 2):
+        yield
+    response_cache.clear()
+
+
+def opener(text):
+    return [{"role": "user", "content": text}]
+
+
+def test_keys_ignore_case_punctuation_and_persona_turns():
+    assert response_cache.key(opener("Who are you?")) == response_cache.key(opener("  who ARE you "))
+    assert response_cache.key([{"role": "system", "content": "old persona"}] + opener("hi")) == \
+        response_cache.key(opener("hi"))
+    assert response_cache.key(opener("hi"), version="1") != response_cache.key(opener("hi"), version="2")
+
+
+def test_long_or_ongoing_conversations_are_not_cached():
+    assert response_cache.key(opener("x " * 100)) is None
+    assert response_cache.key(opener("?!")) is None
+    assert response_cache.key(opener("hi") + [{"role": "assistant", "content": "Mambo!"}] + opener("hi")) is None
+    assert response_cache.key([]) is None
+
+
+@pytest.mark.asyncio
+async def test_answers_come_from_the_pool_once_it_is_full():
+    assert await response_cache.get(opener("hi")) is None
+    await response_cache.put(opener("hi"), "Mambo!")
+    assert await response_cache.get(opener("Hi!")) is None
+    await response_cache.put(opener("Hi!"), "Poa!")
+    await response_cache.put(opener("hi"), "Karibu!")  # the pool is full
+
+    answers = {await response_cache.get(opener("hi")) for _ in range(50)}
+
+    assert answers == {"Mambo!", "Poa!"}
+    assert response_cache.stats() == {"entries": 1, "hits": 50, "misses": 2}
+
+
+@pytest.mark.asyncio
+async def test_entries_expire_and_are_evicted_least_recently_used_first():
+    with patch("response_cache.RESPONSE_CACHE_SIZE", 2), patch("response_cache.RESPONSE_CACHE_VARIETY", 1):
+        for text in ["hi", "hello", "mambo"]:
+            await response_cache.put(opener(text), text.upper())
+        assert await response_cache.get(opener("hi")) is None
+        assert await response_cache.get(opener("hello")) == "HELLO"
+
+        with patch("response_cache.RESPONSE_CACHE_TTL", -1):
+            assert await response_cache.get(opener("hello")) is None
+        assert response_cache.stats()["entries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_pools_are_persisted_when_enabled():
+    store = InMemoryStorage()
+    with patch("response_cache.store", store), patch("response_cache.RESPONSE_CACHE_PERSIST", True):
+        await response_cache.put(opener("hi"), "Mambo!")
+        await response_cache.put(opener("hi"), "Poa!")
+        response_cache.clear()  # e.g. a restart
+
+        assert await response_cache.get(opener("hi")) in {"Mambo!", "Poa!"}
+    assert list(store.cached_responses.values())[0]["answers"] == ["Mambo!", "Poa!"]
@@ -0,0 +1,77 @@
+from unittest.mock import patch
+
+import pytest
+
+import helpers
+import retention
+from fakes import FakeFirestore, FakeQuery
+from storage import FirestoreStorage, InMemoryStorage
+
+
+@pytest.fixture
+def store():
+    with patch("helpers.store", InMemoryStorage()) as store:
+        yield store
+
+
+@pytest.mark.asyncio
+async def test_compact_reports_reclaimed_messages(store):
+    for chat_id in ("chat1", "chat2"):
+        await store.save_chat(chat_id, {"title": chat_id})
+        for i in range(5):
+            await store.add_message(chat_id, {"user_id": "user1", "message_text": f"msg {i}", "role": "user"})
+    store.messages["chat1"][0]["timestamp"] -= 10 * 86400
+
+    report = await retention.compact(max_age_days=7, keep_per_user=3, page_size=2)
+
+    assert (report["chats"], report["deleted"]) == (2, 4)
+    assert [m["message_text"] for m in await store.get_chat_messages("chat1")] == ["msg 2", "msg 3", "msg 4"]
+
+
+@pytest.mark.asyncio
+async def test_compact_covers_chats_without_a_chat_record(store):
+    # A private chat: messages, but no MY_CHAT_MEMBER update ever saved the chat
+    for i in range(5):
+        await store.add_message("555", {"user_id": "555", "message_text": f"msg {i}", "role": "user"})
+
+    report = await retention.compact(keep_per_user=2)
+
+    assert (report["chats"], report["deleted"]) == (1, 3)
+    assert [m["message_text"] for m in await store.get_chat_messages("555")] == ["msg 3", "msg 4"]
+
+
+@pytest.mark.asyncio
+async def test_firestore_pages_are_capped_and_stream_the_chat_once():
+    store = FirestoreStorage(FakeFirestore())
+    for turn in range(2):
+        for user in range(600):
+            await store.add_message("chat1", {"user_id": user, "message_text": f"msg {turn}", "role": "user"})
+    consumed = []
+    stream = FakeQuery.stream
+
+    def counting_stream(query, *args, **kwargs):
+        for doc in stream(query, *args, **kwargs):
+            consumed.append(doc.id)
+            yield doc
+
+    with patch("helpers.store", store), patch.object(FakeQuery, "stream", counting_stream):
+        # Firestore deletes at most 500 per page, fewer than asked for
+        assert await retention.compact_chat("chat1", keep_per_user=1, page_size=1000) == 600
+
+    assert {m["message_text"] for m in await store.get_chat_messages("chat1")} == {"msg 1"}
+    assert len(consumed) == 1200
+
+
+@pytest.mark.asyncio
+async def test_store_message_sets_expire_at_with_a_retention_policy(store):
+    with patch("helpers.MESSAGE_RETENTION_DAYS", 30), patch("helpers.time.time", return_value=1000.0):
+        await helpers.store_message("chat1", "user1", "hello")
+
+    assert (await store.get_messages("chat1", "user1"))[0]["expire_at"] == 1000.0 + 30 * 86400
+
+
+def test_policy_configured():
+    with patch("helpers.MESSAGE_RETENTION_DAYS", None), patch("retention.MESSAGE_RETENTION_PER_USER", None):
+        assert not retention.policy_configured()
+    with patch("helpers.MESSAGE_RETENTION_DAYS", 30):
+        assert retention.policy_configured()
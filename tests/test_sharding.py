@@ -0,0 +1,215 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+import sharding
+from sharding import Dispatcher, HashRing, Shard, Worker
+
+CHAT_IDS = [-100000 - i for i in range(5000)]
+
+
+def test_ring_spreads_chats_over_all_nodes():
+    ring = HashRing(range(4))
+    owners = [ring.node_for(chat_id) for chat_id in CHAT_IDS]
+
+    assert owners == [ring.node_for(chat_id) for chat_id in CHAT_IDS]
+    for node in range(4):
+        assert 0.15 < owners.count(node) / len(CHAT_IDS) < 0.35
+
+
+def test_adding_a_node_only_moves_chats_to_it():
+    ring = HashRing(range(4))
+    before = {chat_id: ring.node_for(chat_id) for chat_id in CHAT_IDS}
+    ring.add(4)
+    moved = [chat_id for chat_id in CHAT_IDS if ring.node_for(chat_id) != before[chat_id]]
+
+    assert all(ring.node_for(chat_id) == 4 for chat_id in moved)
+    assert 0.1 < len(moved) / len(CHAT_IDS) < 0.3
+
+
+def test_removing_a_node_only_moves_its_chats():
+    ring = HashRing(range(4))
+    before = {chat_id: ring.node_for(chat_id) for chat_id in CHAT_IDS}
+    ring.remove(2)
+
+    assert ring.nodes == [0, 1, 3]
+    for chat_id in CHAT_IDS:
+        if before[chat_id] != 2:
+            assert ring.node_for(chat_id) == before[chat_id]
+
+
+def test_shard_owns_the_chats_routed_to_it():
+    shards = [Shard(index, range(3)) for index in range(3)]
+    for chat_id in CHAT_IDS[:100]:
+        assert sum(shard.owns(chat_id) for shard in shards) == 1
+    assert shards[0].primary and not shards[1].primary
+
+
+def test_a_ring_change_releases_the_chats_that_moved_away():
+    from chat_state import ChatStates
+
+    shard = Shard(0, range(2))
+    states = ChatStates()
+    owned = [chat_id for chat_id in CHAT_IDS[:200] if shard.owns(chat_id)]
+    for chat_id in owned:
+        states.get(chat_id)
+
+    shard.set_nodes(range(3))
+    released = shard.release(states)
+
+    kept = [chat_id for chat_id in owned if shard.owns(chat_id)]
+    assert 0 < released == len(owned) - len(kept)
+    assert all(chat_id in states for chat_id in kept)
+    assert len(states) == len(kept)
+    assert states.stats()["bytes"] == sum(state.size for state in states.values())
+
+
+def make_update(chat_id, update_id):
+    update = MagicMock()
+    update.effective_chat.id = chat_id
+    update.to_dict.return_value = {"update_id": update_id, "chat": chat_id}
+    return update
+
+
+def spawn_fake(index, nodes, inbox):
+    worker = Worker(index, inbox)
+    worker.nodes = nodes
+    return worker
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = Dispatcher(spawn=spawn_fake)
+    dispatcher.start(3)
+    return dispatcher
+
+
+def drain(worker):
+    items = []
+    while not worker.inbox.empty():
+        items.append(worker.inbox.get_nowait())
+    return items
+
+
+def test_workers_start_with_the_full_ring(dispatcher):
+    shards = [Shard(index, worker.nodes) for index, worker in dispatcher.workers.items()]
+    for chat_id in CHAT_IDS[:1000]:
+        owners = [shard.index for shard in shards if shard.owns(chat_id)]
+        assert owners == [dispatcher.ring.node_for(chat_id)]
+
+
+def test_ring_changes_reach_the_running_workers(dispatcher):
+    dispatcher.add_worker()
+    dispatcher.remove_worker(1)
+
+    shards = []
+    for index, worker in dispatcher.workers.items():
+        shard = Shard(index, worker.nodes)
+        for item in drain(worker):
+            shard.set_nodes(item["ring"])
+        shards.append(shard)
+    for chat_id in CHAT_IDS[:1000]:
+        owners = [shard.index for shard in shards if shard.owns(chat_id)]
+        assert owners == [dispatcher.ring.node_for(chat_id)]
+
+
+@pytest.mark.asyncio
+async def test_a_chat_goes_to_one_worker_in_order(dispatcher):
+    for update_id in range(20):
+        await dispatcher.route(make_update(CHAT_IDS[update_id % 4], update_id))
+
+    received = {index: drain(worker) for index, worker in dispatcher.workers.items()}
+    for chat_id in CHAT_IDS[:4]:
+        holders = [index for index, items in received.items() if any(item["chat"] == chat_id for item in items)]
+        assert holders == [dispatcher.ring.node_for(chat_id)]
+        ids = [item["update_id"] for item in received[holders[0]] if item["chat"] == chat_id]
+        assert ids == sorted(ids) and len(ids) == 5
+
+
+@pytest.mark.asyncio
+async def test_removed_worker_drains_and_its_chats_move(dispatcher):
+    chat_id = next(chat_id for chat_id in CHAT_IDS if dispatcher.ring.node_for(chat_id) == 1)
+    removed = dispatcher.workers[1]
+    await dispatcher.route(make_update(chat_id, 1))
+
+    assert dispatcher.remove_worker(1)
+    await dispatcher.route(make_update(chat_id, 2))
+
+    assert drain(removed) == [{"update_id": 1, "chat": chat_id}, None]
+    assert sorted(dispatcher.workers) == [0, 2]
+    assert sum(worker.routed for worker in dispatcher.workers.values()) == 1
+
+
+def test_the_last_worker_is_never_removed():
+    dispatcher = Dispatcher(spawn=spawn_fake)
+    dispatcher.start(1)
+    assert not dispatcher.remove_worker(0)
+    assert not dispatcher.remove_worker(7)
+
+
+@pytest.mark.asyncio
+async def test_load_reports_routed_updates_and_worker_reports(dispatcher):
+    for update_id in range(30):
+        await dispatcher.route(make_update(CHAT_IDS[update_id], update_id))
+    dispatcher.reports.put({"index": 0, "pending": 2, "chats": 11})
+
+    load = dispatcher.load()
+
+    assert sum(stats["routed"] for stats in load.values()) == 30
+    assert all(stats["backlog"] == stats["routed"] for stats in load.values())
+    assert (load[0]["pending"], load[0]["chats"]) == (2, 11)
+    assert load[1]["chats"] is None
+
+
+@pytest.mark.asyncio
+async def test_dead_workers_are_restarted_in_place(dispatcher):
+    dead = MagicMock(exitcode=1)
+    dead.is_alive.return_value = False
+    dispatcher.workers[2].process = dead
+    chat_id = next(chat_id for chat_id in CHAT_IDS if dispatcher.ring.node_for(chat_id) == 2)
+    await dispatcher.route(make_update(chat_id, 1))
+    nodes = dispatcher.ring.nodes
+
+    dispatcher.restart_dead_workers()
+
+    assert dispatcher.workers[2].process is None
+    assert dispatcher.ring.nodes == nodes
+    # The restarted worker picks up what the dead one had not handled
+    assert drain(dispatcher.workers[2]) == [{"update_id": 1, "chat": chat_id}]
+
+
+
+def test_the_front_records_every_update(monkeypatch, tmp_path):
+    import main
+    from telegram.ext import ApplicationBuilder, TypeHandler
+
+    from replay import UpdateRecorder
+
+    front = MagicMock()
+    monkeypatch.setattr(ApplicationBuilder, "build", lambda builder: front)
+    monkeypatch.setattr(main, "RECORD_UPDATES_PATH", str(tmp_path / "updates.jsonl"))
+
+    sharding.run(workers=2)
+
+    recorders = [call for call in front.add_handler.call_args_list
+                 if isinstance(call.args[0], TypeHandler) and isinstance(call.args[0].callback, UpdateRecorder)]
+    assert len(recorders) == 1
+    assert recorders[0].kwargs == {"group": -1}
+    front.run_polling.assert_called_once()
+
+
+def test_workers_importing_main_build_no_other_application(monkeypatch):
+    import importlib
+
+    import main
+    from telegram.ext import ApplicationBuilder
+
+    built = []
+    monkeypatch.setattr(ApplicationBuilder, "build", lambda builder: built.append(builder) or MagicMock())
+
+    importlib.reload(main)
+    assert built == []
+
+    application = main.build_application()
+    assert len(built) == 1
+    assert application.add_handler.called
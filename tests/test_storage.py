@@ -0,0 +1,284 @@
+import asyncio
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+from google.cloud import firestore
+from google.cloud.firestore import Client
+
+from fakes import FakeFirestore
+from storage import FirestoreStorage, InMemoryStorage, SqliteStorage, cap_turns, create_storage
+
+
+@pytest.fixture(params=["memory", "sqlite", "firestore"])
+def store(request):
+    if request.param == "memory":
+        return InMemoryStorage()
+    if request.param == "sqlite":
+        return SqliteStorage(":memory:")
+    return FirestoreStorage(FakeFirestore())
+
+
+@pytest.mark.asyncio
+async def test_chats(store):
+    await store.save_chat(-100, {"title": "Group"})
+    await store.save_chat(-100, {"counted": True})
+    await store.save_chat(-200, {"title": "Other"})
+
+    assert await store.get_chat(-100) == {"title": "Group", "counted": True}
+    assert sorted(await store.list_chat_ids()) == ["-100", "-200"]
+
+    await store.delete_chat(-100)
+    assert await store.get_chat(-100) is None
+    assert await store.list_chat_ids() == ["-200"]
+
+
+@pytest.mark.asyncio
+async def test_list_message_chat_ids_includes_chats_without_a_record(store):
+    await store.save_chat(-100, {"title": "Group"})
+    await store.add_message(-100, {"user_id": "1", "message_text": "hi", "role": "user"})
+    await store.add_message(555, {"user_id": "555", "message_text": "hi", "role": "user"})
+
+    assert sorted(await store.list_message_chat_ids()) == ["-100", "555"]
+    assert await store.list_chat_ids() == ["-100"]
+
+
+@pytest.mark.asyncio
+async def test_delete_chat_data_is_paged(store):
+    for user_id in range(3):
+        await store.set_member(-100, user_id, {"preferred_language": "en"})
+        await store.add_message(-100, {"user_id": user_id, "message_text": "hi", "role": "user"})
+    await store.set_conversation(-100, 1, [{"role": "user", "content": "hi"}])
+    await store.set_member(-200, 1, {"preferred_language": "fr"})
+
+    assert await store.delete_chat_data(-100, 4) == 4
+    assert await store.delete_chat_data(-100, 4) == 3
+    assert await store.delete_chat_data(-100, 4) == 0
+    assert await store.get_member(-200, 1) == {"preferred_language": "fr"}
+
+
+@pytest.mark.asyncio
+async def test_cleanup_jobs(store):
+    await store.save_cleanup_job(-100, {"deleted": 0})
+    await store.save_cleanup_job(-100, {"deleted": 20})
+
+    assert await store.get_cleanup_job(-100) == {"deleted": 20}
+    assert await store.list_cleanup_jobs() == ["-100"]
+    await store.delete_cleanup_job(-100)
+    assert await store.get_cleanup_job(-100) is None
+
+
+@pytest.mark.asyncio
+async def test_cached_responses(store):
+    assert await store.get_cached_response("v1:abc") is None
+    await store.save_cached_response("v1:abc", {"answers": ["Mambo!"], "created": 10.0})
+    await store.save_cached_response("v1:abc", {"answers": ["Mambo!", "Poa!"], "created": 10.0})
+    assert await store.get_cached_response("v1:abc") == {"answers": ["Mambo!", "Poa!"], "created": 10.0}
+
+
+@pytest.mark.asyncio
+async def test_claim_update(store):
+    with patch("storage.time.time", return_value=1000.0):
+        assert await store.claim_update("message:-100:5", 2000.0)
+        assert not await store.claim_update("message:-100:5", 3000.0)
+        assert await store.claim_update("message:-100:6", 2000.0)
+    # An expired claim can be taken again
+    with patch("storage.time.time", return_value=2500.0):
+        assert await store.claim_update("message:-100:5", 3500.0)
+        assert not await store.claim_update("message:-100:5", 3500.0)
+
+
+@pytest.mark.asyncio
+async def test_members(store):
+    await store.set_member(-100, 1, {"preferred_language": "en"})
+    await store.set_member(-100, 2, {"preferred_language": "fr"})
+    await store.set_member(-100, 2, {"preferred_language": "es"})
+    await store.set_member(-200, 1, {"preferred_language": "sw"})
+
+    assert await store.get_member(-100, 1) == {"preferred_language": "en"}
+    assert await store.get_member("-100", "2") == {"preferred_language": "es"}
+    assert sorted(await store.list_members(-100)) == [("1", {"preferred_language": "en"}),
+                                                      ("2", {"preferred_language": "es"})]
+
+    await store.delete_member(-100, 1)
+    assert await store.get_member(-100, 1) is None
+    assert await store.get_member(-200, 1) == {"preferred_language": "sw"}
+
+
+@pytest.mark.asyncio
+async def test_users(store):
+    await store.set_user(7, {"preferred_language": "fr"})
+    await store.set_user(7, {"preferred_language": "de"})
+    await store.set_user(8, {"preferred_language": "sw"})
+
+    assert await store.get_user(7) == {"preferred_language": "de"}
+    assert await store.get_user(9) is None
+    assert await store.load_users([7, "8", 9]) == {"7": {"preferred_language": "de"}, "8": {"preferred_language": "sw"}}
+    assert await store.load_users([]) == {}
+
+
+@pytest.mark.asyncio
+async def test_load_members_reads_every_requested_chat(store):
+    await store.set_member(-100, 1, {"preferred_language": "en"})
+    await store.set_member(-100, 2, {"preferred_language": "fr"})
+    await store.set_member(-200, 3, {"preferred_language": "sw"})
+    progress = []
+
+    loaded = await store.load_members([-100, "-300"], progress=lambda done, total: progress.append((done, total)))
+
+    assert loaded == {"-100": {"1": {"preferred_language": "en"}, "2": {"preferred_language": "fr"}}, "-300": {}}
+    assert progress[-1] == (2, 2)
+
+
+@pytest.mark.asyncio
+async def test_firestore_calls_leave_the_event_loop_free():
+    store = FirestoreStorage(FakeFirestore(latency=0.1))
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    await asyncio.gather(store.get_member(-100, 1), store.set_member(-100, 2, {}),
+                         store.add_message(-100, {"user_id": "1", "message_text": "hi", "role": "user"}),
+                         store.claim_update("update:1", time.time() + 60), store.get_counter("active_chats"))
+
+    # Run one after the other on the loop, these would take at least 0.5s
+    assert loop.time() - start < 0.4
+
+
+@pytest.mark.asyncio
+async def test_firestore_load_members_falls_back_to_per_chat_reads():
+    from google.api_core.exceptions import FailedPrecondition
+
+    db = FakeFirestore()
+    store = FirestoreStorage(db)
+    await store.set_member(-100, 1, {"preferred_language": "en"})
+    await store.set_member(-200, 2, {"preferred_language": "fr"})
+
+    with patch.object(db, "collection_group", side_effect=FailedPrecondition("index missing")):
+        loaded = await store.load_members([-100, -200], concurrency=2)
+
+    assert loaded == {"-100": {"1": {"preferred_language": "en"}}, "-200": {"2": {"preferred_language": "fr"}}}
+
+
+@pytest.mark.asyncio
+async def test_messages_are_filtered_by_user_and_ordered(store):
+    await store.add_message(-100, {"user_id": 1, "message_text": "hi", "role": "user"})
+    await store.add_message(-100, {"user_id": 2, "message_text": "other", "role": "user"})
+    await store.add_message(-100, {"user_id": 1, "message_text": "Mambo!", "role": "assistant"})
+
+    messages = await store.get_messages(-100, 1)
+    assert [(m["role"], m["message_text"]) for m in messages] == [("user", "hi"), ("assistant", "Mambo!")]
+    assert await store.get_messages(-200, 1) == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("stored, queried", [(1, "1"), ("1", 1), (1, 1)])
+async def test_messages_match_int_and_string_user_ids(store, stored, queried):
+    await store.add_message(-100, {"user_id": stored, "message_text": "hi", "role": "user"})
+    await store.add_message(-100, {"user_id": 2, "message_text": "other", "role": "user"})
+
+    assert [m["message_text"] for m in await store.get_messages(-100, queried)] == ["hi"]
+
+
+@pytest.mark.asyncio
+async def test_compact_messages(store):
+    import time
+
+    for i in range(4):
+        await store.add_message(-100, {"user_id": 1, "message_text": f"one {i}", "role": "user"})
+    await store.add_message(-100, {"user_id": 2, "message_text": "two", "role": "user"})
+
+    assert await store.compact_messages(-100, before=time.time() - 3600) == 0
+    assert await store.compact_messages(-100, keep_per_user=2, limit=1) == 1
+    assert await store.compact_messages(-100, keep_per_user=2) == 1
+    assert [m["message_text"] for m in await store.get_chat_messages(-100)] == ["one 2", "one 3", "two"]
+
+    assert await store.compact_messages(-100, before=time.time() + 1) == 3
+    assert await store.get_chat_messages(-100) == []
+
+
+@pytest.mark.asyncio
+async def test_conversations_are_capped(store):
+    persona = {"role": "system", "content": "You are Said."}
+    await store.append_conversation(-100, 1, [persona], max_turns=3)
+    for i in range(4):
+        await store.append_conversation(-100, 1, [{"role": "user", "content": f"msg {i}"}], max_turns=3)
+
+    assert await store.get_conversation(-100, 1) == [persona, {"role": "user", "content": "msg 2"},
+                                                     {"role": "user", "content": "msg 3"}]
+    assert await store.get_conversation(-100, 2) == []
+
+    await store.set_conversation(-100, 2, [{"role": "user", "content": "hi"}])
+    assert await store.get_conversation(-100, 2) == [{"role": "user", "content": "hi"}]
+
+
+def test_cap_turns_keeps_leading_system_turns():
+    turns = [{"role": "system", "content": "s"}] + [{"role": "user", "content": str(i)} for i in range(5)]
+    assert cap_turns(turns, 3) == [turns[0], turns[4], turns[5]]
+    assert cap_turns(turns, 1) == [turns[0]]
+    assert cap_turns(turns[1:], 10) == turns[1:]
+
+
+@pytest.mark.asyncio
+async def test_add_to_counter_sums_across_shards(store):
+    assert await store.get_counter("active_chats") == 0
+    await store.add_to_counter("active_chats")
+    for _ in range(5):
+        await store.add_to_counter("active_chats", 1, shards=3)
+    await store.add_to_counter("active_chats", -2, shards=3)
+    assert await store.get_counter("active_chats") == 4
+
+
+@pytest.mark.asyncio
+async def test_firestore_add_to_counter_writes_a_shard_only():
+    db = FakeFirestore()
+    store = FirestoreStorage(db)
+    for _ in range(20):
+        await store.add_to_counter("active_chats", 1, shards=4)
+
+    shards = db.collection("active_chats").document("count").collection("shards").get()
+    assert 1 < len(shards) <= 4
+    assert sum(shard.to_dict()["count"] for shard in shards) == 20
+    assert not db.collection("active_chats").document("count").get().exists
+
+
+def test_sqlite_storage_persists_to_file(tmp_path):
+    import asyncio
+
+    path = str(tmp_path / "bot.db")
+    asyncio.run(SqliteStorage(path).set_member(-1, 2, {"preferred_language": "fr"}))
+    assert asyncio.run(SqliteStorage(path).get_member(-1, 2)) == {"preferred_language": "fr"}
+
+
+def test_create_storage():
+    assert isinstance(create_storage("memory"), InMemoryStorage)
+    assert isinstance(create_storage("sqlite", sqlite_path=":memory:"), SqliteStorage)
+    with pytest.raises(ValueError):
+        create_storage("redis")
+
+
+# --- Firestore specifics ---
+
+@pytest.mark.asyncio
+async def test_firestore_add_message_uses_server_timestamp():
+    mock_db = MagicMock(spec=Client)
+    await FirestoreStorage(mock_db).add_message("chat1", {"user_id": "user1", "message_text": "Test", "role": "user"})
+
+    mock_db.collection.return_value.document.return_value.collection.return_value.add.assert_called_once_with({
+        'user_id': "user1",
+        'message_text': "Test",
+        'role': "user",
+        'timestamp': firestore.SERVER_TIMESTAMP
+    })
+
+
+@pytest.mark.asyncio
+async def test_firestore_add_message_stores_expire_at_as_timestamp():
+    from datetime import datetime, timezone
+
+    db = FakeFirestore()
+    await FirestoreStorage(db).add_message("chat1", {"user_id": "user1", "message_text": "Test", "role": "user",
+                                                     "expire_at": 86400})
+
+    stored = db.collection("chats").document("chat1").collection("messages").get()[0].to_dict()
+    assert stored["expire_at"] == datetime(1970, 1, 2, tzinfo=timezone.utc)
+
@@ -0,0 +1,87 @@
+import json
+from urllib.parse import parse_qs
+
+import httpx
+import pytest
+
+import translate_rest
+from translate_rest import AsyncTranslateClient, TranslateAPIError
+
+
+def make_client(handler, **kwargs):
+    requests = []
+
+    def record(request):
+        requests.append(request)
+        return handler(request)
+
+    client = AsyncTranslateClient("secret", http2=False, transport=httpx.MockTransport(record), **kwargs)
+    return client, requests
+
+
+def translate_handler(request):
+    form = parse_qs(request.content.decode())
+    translations = [{"translatedText": f"[{form['target'][0]}] {text}", "detectedSourceLanguage": "sw"}
+                    for text in form["q"]]
+    return httpx.Response(200, json={"data": {"translations": translations}})
+
+
+@pytest.mark.asyncio
+async def test_translate_returns_what_the_sdk_returns():
+    client, requests = make_client(translate_handler)
+
+    assert await client.translate("Habari", target_language="en") == {
+        "translatedText": "[en] Habari", "detectedSourceLanguage": "sw", "input": "Habari"}
+    results = await client.translate(["Habari", "yako"], target_language="fr")
+    assert [result["translatedText"] for result in results] == ["[fr] Habari", "[fr] yako"]
+
+    request = requests[0]
+    assert request.method == "POST" and request.url.path == "/language/translate/v2"
+    assert request.url.params["key"] == "secret"
+    assert "gzip" in request.headers["accept-encoding"]
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_large_lists_are_split_into_batches():
+    client, requests = make_client(translate_handler)
+    texts = [f"text {i}" for i in range(translate_rest.MAX_SEGMENTS + 5)]
+
+    results = await client.translate(texts, target_language="en")
+
+    assert [result["input"] for result in results] == texts
+    assert len(requests) == 2
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_errors_raise_with_the_api_message():
+    client, _ = make_client(lambda request: httpx.Response(
+        403, json={"error": {"code": 403, "message": "API key not valid"}}))
+
+    with pytest.raises(TranslateAPIError) as error:
+        await client.translate("Habari", target_language="en")
+
+    assert error.value.status == 403 and "API key not valid" in str(error.value)
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_get_languages():
+    client, requests = make_client(lambda request: httpx.Response(
+        200, content=json.dumps({"data": {"languages": [{"language": "en", "name": "English"}]}})))
+
+    assert await client.get_languages("en") == [{"language": "en", "name": "English"}]
+    assert requests[0].url.path == "/language/translate/v2/languages"
+    assert requests[0].url.params["target"] == "en"
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_connections_are_shared_and_pooled():
+    client, _ = make_client(translate_handler, pool_size=4)
+
+    http = client._client()
+    assert client._client() is http
+    await client.aclose()
+    assert client._http is None
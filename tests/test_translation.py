@@ -0,0 +1,184 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+import translation
+from translation import CircuitBreaker, LatencyTracker, Route, Router, StubBackend, TranslationError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FailingBackend(translation.Backend):
+    name = "failing"
+
+    def __init__(self):
+        self.calls = 0
+
+    async def translate_texts(self, texts, target):
+        self.calls += 1
+        raise RuntimeError("service unavailable")
+
+
+class SlowBackend(translation.Backend):
+    name = "slow"
+
+    async def translate_texts(self, texts, target):
+        await asyncio.sleep(1)
+        return texts
+
+
+def test_breaker_opens_after_consecutive_failures_and_lets_one_trial_through():
+    clock = Clock()
+    breaker = CircuitBreaker(failures=3, reset_after=30, clock=clock)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow()
+
+    clock.now = 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.now = 60
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.failures == 0
+
+
+def test_latency_tracker_adapts_the_timeout():
+    tracker = LatencyTracker(min_timeout=0.5, max_timeout=10)
+    assert tracker.timeout() == 10
+    for _ in range(50):
+        tracker.record(0.1)
+    assert tracker.timeout() == 0.5
+    for _ in range(50):
+        tracker.record(2.0)
+    assert 2.0 <= tracker.timeout() < 10
+
+
+@pytest.mark.asyncio
+async def test_router_falls_back_and_keeps_the_shape():
+    failing = FailingBackend()
+    router = Router([failing, StubBackend()])
+
+    assert await router.translate("Habari", "en") == "[en] Habari"
+    assert await router.translate(["Habari", "yako"], "en") == ["[en] Habari", "[en] yako"]
+    assert router.stats()["failing"]["failures"] == 2
+
+
+@pytest.mark.asyncio
+async def test_router_bypasses_an_open_breaker():
+    failing = FailingBackend()
+    router = Router([Route(failing, CircuitBreaker(failures=2)), StubBackend()])
+
+    for _ in range(5):
+        await router.translate("Habari", "en")
+
+    assert failing.calls == 2
+    assert router.stats()["failing"]["state"] == CircuitBreaker.OPEN
+
+
+@pytest.mark.asyncio
+async def test_router_times_out_slow_backends():
+    router = Router([Route(SlowBackend(), latency=LatencyTracker(max_timeout=0.01)), StubBackend()])
+
+    assert await router.translate("Habari", "sw") == "[sw] Habari"
+    assert router.stats()["slow"]["failures"] == 1
+
+
+def test_router_prefers_the_faster_backend():
+    fast, slow = Route(StubBackend()), Route(translation.GoogleBackend(MagicMock))
+    fast.latency.record(0.05)
+    slow.latency.record(0.5)
+    router = Router([slow, fast])
+
+    assert router.order() == [fast, slow]
+
+
+@pytest.mark.asyncio
+async def test_a_healthy_primary_is_not_passed_over_for_an_unmeasured_fallback():
+    client = MagicMock()
+    client.translate.return_value = {"translatedText": "hello"}
+    fallback = MagicMock(spec=StubBackend, weight=1.0)
+    fallback.name = "fallback"
+    router = Router([translation.GoogleBackend(lambda: client), fallback])
+
+    for _ in range(3):
+        assert await router.translate("hola", "en") == "hello"
+
+    fallback.translate_texts.assert_not_called()
+    assert router.stats()["fallback"]["latency"] is None
+
+
+@pytest.mark.asyncio
+async def test_router_raises_when_every_backend_fails():
+    with pytest.raises(TranslationError):
+        await Router([FailingBackend()]).translate("Habari", "en")
+
+
+@pytest.mark.asyncio
+async def test_google_backend_sends_single_texts_as_a_string():
+    client = MagicMock()
+    client.translate.return_value = {"translatedText": "Hello"}
+    backend = translation.GoogleBackend(lambda: client)
+
+    assert await backend.translate_texts(["Habari"], "en") == ["Hello"]
+    client.translate.assert_called_once_with("Habari", target_language="en")
+
+
+@pytest.mark.asyncio
+async def test_a_cancelled_trial_lets_the_next_one_through():
+    clock = Clock()
+    route = Route(SlowBackend(), breaker=CircuitBreaker(failures=1, reset_after=30, clock=clock))
+    route.breaker.record_failure()
+    clock.now = 30
+    router = Router([route])
+
+    task = asyncio.ensure_future(router.translate("Habari", "en"))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert route.breaker.allow()
+
+
+@pytest.mark.asyncio
+async def test_a_blocking_openai_call_is_timed_out():
+    def create(**kwargs):
+        time.sleep(0.3)
+        return {"choices": [{"message": {"content": "Hello"}}]}
+
+    router = Router([Route(translation.OpenAIBackend(), latency=LatencyTracker(max_timeout=0.05))])
+    with patch("openai.ChatCompletion.create", create):
+        start = time.perf_counter()
+        with pytest.raises(TranslationError):
+            await router.translate("Habari", "en")
+        assert time.perf_counter() - start < 0.2
+
+
+@pytest.mark.asyncio
+async def test_openai_backend_asks_for_the_translation_only():
+    with patch("openai_helper.get_openai_response", AsyncMock(return_value="Hello")) as get_response:
+        assert await translation.OpenAIBackend().translate_texts(["Habari"], "en") == ["Hello"]
+
+    messages = get_response.call_args.args[0]
+    assert "'en'" in messages[0]["content"] and messages[1] == {"role": "user", "content": "Habari"}
+
+
+def test_build_rejects_unknown_backends():
+    assert [route.backend.name for route in translation.build(["google", "stub"]).routes] == ["google", "stub"]
+    with pytest.raises(ValueError):
+        translation.build(["deepl"])
@@ -0,0 +1,108 @@
+"""Native async client for the Translate v2 REST API.
+
+`google.cloud.translate_v2.Client` is synchronous and opens its own
+connections, so every translation either blocked the event loop or occupied a
+worker thread. `AsyncTranslateClient` talks to the same endpoints over one
+shared `httpx.AsyncClient`: keep-alive connections, gzip responses and, when
+the optional `h2` package is installed (`pip install httpx[http2]`), HTTP/2,
+which multiplexes the concurrent requests of all chats over a single
+connection. Its `translate()` and `get_languages()` take and return the same
+values as the SDK's, only awaited:
+
+    client = AsyncTranslateClient(config.GOOGLE_API_KEY)
+    result = await client.translate("Habari", target_language="en")
+    result["translatedText"]
+
+`clients.py` builds it as the "translate" client unless `TRANSLATE_TRANSPORT`
+is set to "sdk".
+"""
+import asyncio
+
+import config
+
+TRANSLATE_POOL_SIZE = getattr(config, 'TRANSLATE_POOL_SIZE', 20)
+TRANSLATE_HTTP_TIMEOUT = getattr(config, 'TRANSLATE_HTTP_TIMEOUT', 10.0)
+
+BASE_URL = "https://translation.googleapis.com/language/translate/"
+# The API rejects requests with more text segments than this
+MAX_SEGMENTS = 128
+
+
+class TranslateAPIError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class AsyncTranslateClient:
+    def __init__(self, api_key, pool_size=TRANSLATE_POOL_SIZE, timeout=TRANSLATE_HTTP_TIMEOUT, http2=None,
+                 base_url=BASE_URL, transport=None):
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.http2 = http2_available() if http2 is None else http2
+        self.base_url = base_url
+        self._transport = transport
+        self._http = None
+
+    def _client(self):
+        # Created on first use, inside the running event loop the connections belong to
+        if self._http is None:
+            import httpx
+
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                http2=self.http2,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                timeout=self.timeout,
+                headers={"Accept-Encoding": "gzip", "User-Agent": "mister-said (gzip)"},
+                transport=self._transport,
+            )
+        return self._http
+
+    async def _request(self, method, path, params=None, **kwargs):
+        params = {"key": self.api_key, **(params or {})}
+        response = await self._client().request(method, path, params=params, **kwargs)
+        if response.status_code != 200:
+            try:
+                message = response.json()["error"]["message"]
+            except Exception:
+                message = response.text
+            raise TranslateAPIError(f"{method} {path}: {response.status_code} {message}", response.status_code)
+        return response.json()["data"]
+
+    async def _translate_batch(self, texts, target_language, format_, source_language, model):
+        data = {"q": texts, "target": target_language}
+        for name, value in (("format", format_), ("source", source_language), ("model", model)):
+            if value is not None:
+                data[name] = value
+        translations = (await self._request("POST", "v2", data=data))["translations"]
+        for text, translation in zip(texts, translations):
+            translation["input"] = text
+        return translations
+
+    async def translate(self, values, target_language=None, format_=None, source_language=None, model=None):
+        texts = [values] if isinstance(values, str) else list(values)
+        # Large lists are split to fit the API's limit and sent concurrently over the shared pool
+        batches = await asyncio.gather(*(
+            self._translate_batch(texts[i:i + MAX_SEGMENTS], target_language, format_, source_language, model)
+            for i in range(0, len(texts), MAX_SEGMENTS)))
+        results = [translation for batch in batches for translation in batch]
+        return results[0] if isinstance(values, str) else results
+
+    async def get_languages(self, target_language=None):
+        params = {"target": target_language} if target_language else None
+        return (await self._request("GET", "v2/languages", params=params))["languages"]
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
@@ -0,0 +1,236 @@
+"""Translation backends behind a circuit breaker, with fallback between them.
+
+Google Translate used to be called directly, so a slow or failing API held
+every message for the full timeout. `Router` now tries its backends in order
+of health and measured latency:
+
+    router = build(["google", "openai"], google_client=lambda: translate_client)
+    text = await router.translate("Habari", "en")            # str in, str out
+    texts = await router.translate(["Habari", "yako"], "en")  # list in, list out
+
+Each backend has a `CircuitBreaker`, which stops sending it requests after
+`BREAKER_FAILURES` failures in a row and lets a single trial request through
+once `BREAKER_RESET` seconds have passed, and a `LatencyTracker`, whose
+moving average and deviation set the backend's timeout and its place in the
+routing order. When every backend fails, `TranslationError` is raised.
+"""
+import asyncio
+import time
+
+import clients
+import config
+
+TRANSLATION_BACKENDS = getattr(config, 'TRANSLATION_BACKENDS', ['google'])
+TRANSLATION_MIN_TIMEOUT = getattr(config, 'TRANSLATION_MIN_TIMEOUT', 1.0)
+TRANSLATION_MAX_TIMEOUT = getattr(config, 'TRANSLATION_MAX_TIMEOUT', 10.0)
+BREAKER_FAILURES = getattr(config, 'BREAKER_FAILURES', 5)
+BREAKER_RESET = getattr(config, 'BREAKER_RESET', 30.0)
+
+
+class TranslationError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failures=BREAKER_FAILURES, reset_after=BREAKER_RESET, clock=time.monotonic):
+        self.max_failures = failures
+        self.reset_after = reset_after
+        self._clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if self._clock() - self.opened_at >= self.reset_after:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        """Whether a request may be sent; in the half-open state only one trial request is let through."""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def end_trial(self):
+        """Lets the next request through as a trial again, e.g. when the last one was cancelled."""
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.opened_at is not None or self.failures >= self.max_failures:
+            # A failed trial opens the breaker again for another reset period
+            self.opened_at = self._clock()
+
+
+class LatencyTracker:
+    """Moving average and mean deviation of a backend's latency, the way TCP estimates round trip times."""
+
+    def __init__(self, min_timeout=TRANSLATION_MIN_TIMEOUT, max_timeout=TRANSLATION_MAX_TIMEOUT,
+                 alpha=0.125, beta=0.25):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.alpha = alpha
+        self.beta = beta
+        self.mean = None
+        self.deviation = 0.0
+
+    def record(self, seconds):
+        if self.mean is None:
+            self.mean, self.deviation = seconds, seconds / 2
+        else:
+            self.deviation += self.beta * (abs(seconds - self.mean) - self.deviation)
+            self.mean += self.alpha * (seconds - self.mean)
+
+    def timeout(self):
+        if self.mean is None:
+            return self.max_timeout
+        return min(max(self.mean + 4 * self.deviation, self.min_timeout), self.max_timeout)
+
+
+class Backend:
+    """A translation service. `weight` scales its measured latency when routing; higher is less preferred."""
+
+    name = None
+    weight = 1.0
+
+    async def translate_texts(self, texts, target):
+        raise NotImplementedError
+
+
+class GoogleBackend(Backend):
+    name = "google"
+
+    def __init__(self, get_client=None):
+        self._get_client = get_client or (lambda: clients.get("translate"))
+
+    async def translate_texts(self, texts, target):
+        client = self._get_client()
+        # Single texts are sent as a string, as the bot always has
+        values = texts[0] if len(texts) == 1 else texts
+        if asyncio.iscoroutinefunction(client.translate):
+            results = await client.translate(values, target_language=target)
+        else:
+            # The blocking SDK client (TRANSLATE_TRANSPORT = 'sdk'); keep it off the event loop
+            results = await asyncio.to_thread(client.translate, values, target_language=target)
+        if len(texts) == 1:
+            return [results['translatedText']]
+        return [result['translatedText'] for result in results]
+
+
+class OpenAIBackend(Backend):
+    """Translates with the chat model; slower and pricier than Google, so it is mostly a fallback."""
+
+    name = "openai"
+    weight = 3.0
+
+    async def translate_one(self, text, target):
+        from openai_helper import get_openai_response
+
+        reply = await get_openai_response([
+            {"role": "system", "content": f"Translate the user's message into the language with the code "
+                                          f"'{target}'. Reply with the translation only."},
+            {"role": "user", "content": text},
+        ])
+        if reply is None:
+            raise TranslationError("no reply from OpenAI")
+        return reply
+
+    async def translate_texts(self, texts, target):
+        return list(await asyncio.gather(*(self.translate_one(text, target) for text in texts)))
+
+
+class StubBackend(Backend):
+    """Marks the text with the target language instead of translating it, for development without API keys."""
+
+    name = "stub"
+
+    async def translate_texts(self, texts, target):
+        return [f"[{target}] {text}" for text in texts]
+
+
+class Route:
+    __slots__ = ("backend", "breaker", "latency")
+
+    def __init__(self, backend, breaker=None, latency=None):
+        self.backend = backend
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = latency or LatencyTracker()
+
+    def cost(self):
+        return (self.latency.mean or 0.0) * self.backend.weight
+
+
+class Router:
+    def __init__(self, backends):
+        self.routes = [backend if isinstance(backend, Route) else Route(backend) for backend in backends]
+
+    def order(self):
+        """Closed breakers before open ones, each group by weighted latency once every backend has been
+        measured; until then, and on ties, in the configured order."""
+        # A fallback that was never called has no latency; it must not jump ahead of a healthy primary
+        measured = all(route.latency.mean is not None for route in self.routes)
+        return sorted(self.routes, key=lambda route: (route.breaker.state == CircuitBreaker.OPEN,
+                                                      route.cost() if measured else 0.0))
+
+    async def translate(self, values, target):
+        texts = [values] if isinstance(values, str) else list(values)
+        errors = []
+        for route in self.order():
+            if not route.breaker.allow():
+                continue
+            name = route.backend.name
+            start = time.perf_counter()
+            try:
+                translated = await asyncio.wait_for(route.backend.translate_texts(texts, target),
+                                                    timeout=route.latency.timeout())
+            except asyncio.TimeoutError:
+                route.latency.record(route.latency.timeout())
+                route.breaker.record_failure()
+                errors.append(f"{name} timed out")
+                print(f"[ERROR] Translation to {target} by {name} timed out, trying the next backend.")
+                continue
+            except Exception as e:
+                route.breaker.record_failure()
+                errors.append(f"{name}: {e}")
+                print(f"[ERROR] Translation to {target} by {name} failed: {e}")
+                continue
+            finally:
+                # A cancelled trial has no outcome; without this the half-open breaker never allows another
+                route.breaker.end_trial()
+            route.latency.record(time.perf_counter() - start)
+            route.breaker.record_success()
+            return translated[0] if isinstance(values, str) else translated
+        raise TranslationError(f"no translation backend available for {target}: {'; '.join(errors) or 'all open'}")
+
+    def stats(self):
+        return {route.backend.name: {"state": route.breaker.state, "failures": route.breaker.failures,
+                                     "latency": route.latency.mean, "timeout": route.latency.timeout()}
+                for route in self.routes}
+
+
+BACKENDS = {"google": GoogleBackend, "openai": OpenAIBackend, "stub": StubBackend}
+
+
+def build(names=None, google_client=None):
+    """A router over the named backends, in order of preference."""
+    backends = []
+    for name in names or TRANSLATION_BACKENDS:
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown translation backend {name!r}, expected one of {sorted(BACKENDS)}")
+        backends.append(GoogleBackend(google_client) if name == "google" else BACKENDS[name]())
+    return Router(backends)